@@ -0,0 +1,324 @@
+from bisect import bisect_left, insort
+from datetime import date, datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import fx
+import perf
+import storage
+from insurers import get_registry
+from matching import CURRENCIES, normalize_insurer
+from money import to_cents
+
+# (label, more than N days overdue, up to N days overdue)
+BUCKETS = (
+    ("≤ 6 months", None, 180),
+    ("6 - 12 months", 180, 365),
+    ("12 - 18 months", 365, 540),
+    ("> 18 months", 540, None),
+)
+ALL = (None, None)
+# Third part of the histogram keys that count each insurer share once, in the
+# currency it is priced in: USD when the share has a USD amount (the MYR one
+# follows from it), else its own currency. Revaluation starts from these.
+PRICED = "priced"
+# The invoice fields add_invoice reads; a columnar store reads only these.
+AGING_FIELDS = ("invoice_no", "Date of invoice", "Status", "insurer amounts(MYR)", "insurer amounts(USD)",
+                "verified_insurers")
+
+_aging = None
+
+
+@lru_cache(maxsize=8192)
+def invoice_day(value):
+    # Date of invoice as a day ordinal, or None when it cannot be parsed (such
+    # invoices fall in no bucket, as with pd.to_datetime(errors="coerce")).
+    text = str(value or "").strip()
+    if not text:
+        return None
+    for fmt in ("%Y-%m-%d", "%Y/%m/%d", "%d-%b-%Y"):
+        try:
+            return datetime.strptime(text, fmt).toordinal()
+        except ValueError:
+            pass
+    parsed = pd.to_datetime(text, errors="coerce")
+    return None if pd.isna(parsed) else parsed.date().toordinal()
+
+
+def _owed(payments, invoice_no, currency, insurer, cents):
+    # Cents still owed on a verified share; it stays listed under its insurer
+    # at zero once settled or in a currency it was not paid in.
+    balance = payments.share_balance(invoice_no, currency, insurer, cents, True)
+    return max(balance, 0) if balance is not None else 0
+
+
+class AgingAggregates:
+    # Open (outstanding or partially paid) invoices folded into per-day [count, cents] histograms for
+    # every (insurer, currency) key, plus (None, currency) per-currency totals
+    # and ALL for plain invoice counts; amounts are what is still owed on each
+    # share (PaymentLedger.share_balance). An invoice's shares are kept as
+    # (currency, insurer, owed cents, share cents).
+    # Buckets for a reference date are sums over day ranges, so rolling to the
+    # next day never revisits an invoice.
+    def __init__(self):
+        self.days = {}
+        self.refs = {}
+        self.contributions = {}
+        self.case_invoices = {}
+        self.revision = 0
+        self._summaries = {}
+
+    @classmethod
+    def from_store(cls, store):
+        from ledger import get_ledger
+
+        aggregates = cls()
+        payments = get_ledger()
+        with perf.span("aging.build"):
+            for case_no, inv in store.open_invoices(AGING_FIELDS):
+                aggregates.add_invoice(case_no, inv, payments)
+        return aggregates
+
+    def _add(self, key, day, ref, cents):
+        histogram = self.days.setdefault(key, {})
+        refs = self.refs.setdefault(key, {})
+        if day not in histogram:
+            histogram[day] = [0, 0]
+            insort(refs.setdefault("__days__", []), day)
+        histogram[day][0] += 1
+        histogram[day][1] += cents
+        refs.setdefault(day, set()).add(ref)
+
+    def _remove(self, key, day, ref, cents):
+        histogram = self.days.get(key, {})
+        if day not in histogram:
+            return
+        histogram[day][0] -= 1
+        histogram[day][1] -= cents
+        self.refs[key][day].discard(ref)
+        if histogram[day][0] <= 0:
+            del histogram[day]
+            del self.refs[key][day]
+            days = self.refs[key]["__days__"]
+            del days[bisect_left(days, day)]
+
+    def _contribution(self, shares):
+        # Histogram keys an invoice counts towards, with its cents for each.
+        contribution = {ALL: 0}
+        priced = {}
+        for currency, insurer, cents, _ in shares:
+            name = normalize_insurer(insurer)
+            for key in ((name, currency), (None, currency)):
+                contribution[key] = contribution.get(key, 0) + cents
+            if currency == fx.SOURCE_CURRENCY or insurer not in priced:
+                priced[insurer] = (currency, cents)
+        for insurer, (currency, cents) in priced.items():
+            for key in ((normalize_insurer(insurer), currency, PRICED), (None, currency, PRICED)):
+                contribution[key] = contribution.get(key, 0) + cents
+        return contribution.items()
+
+    def _store(self, ref, day, shares):
+        for key, cents in self._contribution(shares):
+            self._add(key, day, ref, cents)
+        self.contributions[ref] = (day, shares)
+        self.case_invoices.setdefault(ref[0], set()).add(ref[1])
+        self.revision += 1
+
+    def add_invoice(self, case_no, inv, payments=None):
+        from ledger import get_ledger
+
+        if not storage.is_open(inv):
+            return
+        day = invoice_day(inv.get("Date of invoice"))
+        if day is None:
+            return
+        verified = inv.get("verified_insurers", {}) or {}
+        if verified and payments is None:
+            payments = get_ledger()
+        shares = []
+        for currency in CURRENCIES:
+            for insurer, amount in inv.get(f"insurer amounts({currency})", {}).items():
+                cents = to_cents(amount)
+                owed = cents
+                if insurer in verified:
+                    owed = _owed(payments, inv.get("invoice_no"), currency, insurer, cents)
+                shares.append((currency, insurer, owed, cents))
+        self._store((case_no, inv.get("invoice_no")), day, shares)
+
+    def remove_invoice(self, case_no, invoice_no):
+        ref = (case_no, invoice_no)
+        if ref not in self.contributions:
+            return None
+        day, shares = self.contributions.pop(ref)
+        for key, cents in self._contribution(shares):
+            self._remove(key, day, ref, cents)
+        self.case_invoices[case_no].discard(invoice_no)
+        if not self.case_invoices[case_no]:
+            del self.case_invoices[case_no]
+        self.revision += 1
+        return day, shares
+
+    def refresh_invoice(self, case_no, inv):
+        self.remove_invoice(case_no, inv.get("invoice_no"))
+        self.add_invoice(case_no, inv)
+
+    def set_status(self, case_no, invoice_no, status):
+        if not storage.is_open_status(status):
+            self.remove_invoice(case_no, invoice_no)
+
+    def verify(self, case_no, invoice_no, insurer):
+        # The invoice stays open until its status changes; the verified share
+        # drops to what is still owed on it.
+        from ledger import get_ledger
+
+        removed = self.remove_invoice(case_no, invoice_no)
+        if removed is not None:
+            day, shares = removed
+            payments = get_ledger()
+            self._store((case_no, invoice_no), day,
+                        [(c, name, _owed(payments, invoice_no, c, name, full) if name == insurer else owed, full)
+                         for c, name, owed, full in shares])
+
+    def remove_case(self, case_no):
+        for invoice_no in list(self.case_invoices.get(case_no, ())):
+            self.remove_invoice(case_no, invoice_no)
+
+    def rename_case(self, case_no, new_case_no):
+        for invoice_no in list(self.case_invoices.get(case_no, ())):
+            day, shares = self.remove_invoice(case_no, invoice_no)
+            self._store((new_case_no, invoice_no), day, shares)
+
+    def _day_range(self, label, reference_date):
+        today = (reference_date or date.today()).toordinal()
+        for bucket_label, above, up_to in BUCKETS:
+            if bucket_label == label:
+                first = today - up_to if up_to is not None else None
+                last = today - above - 1 if above is not None else None
+                return first, last
+        raise KeyError(label)
+
+    def _days_in(self, key, label, reference_date):
+        days = self.refs.get(key, {}).get("__days__", [])
+        first, last = self._day_range(label, reference_date)
+        lo = 0 if first is None else bisect_left(days, first)
+        hi = len(days) if last is None else bisect_left(days, last + 1)
+        return days[lo:hi]
+
+    def _bucket(self, key, label, reference_date):
+        histogram = self.days.get(key, {})
+        count = 0
+        cents = 0
+        for day in self._days_in(key, label, reference_date):
+            count += histogram[day][0]
+            cents += histogram[day][1]
+        return count, cents
+
+    def buckets(self, insurer=None, reference_date=None, priced=False):
+        # [(label, invoice count, {currency: outstanding amount})]; ``priced``
+        # counts each share in one currency only (PRICED).
+        reference_date = reference_date or date.today()
+        memo_key = ("buckets", normalize_insurer(insurer) if insurer else None, reference_date, priced,
+                    self.revision)
+        tail = (PRICED,) if priced else ()
+        if memo_key not in self._summaries:
+            rows = []
+            for label, _, _ in BUCKETS:
+                if insurer:
+                    name = normalize_insurer(insurer)
+                    counts = {c: self._bucket((name, c) + tail, label, reference_date) for c in CURRENCIES}
+                    refs = set()
+                    for c in CURRENCIES:
+                        for day in self._days_in((name, c), label, reference_date):
+                            refs |= self.refs[(name, c)][day]
+                    count = len(refs)
+                else:
+                    counts = {c: self._bucket((None, c) + tail, label, reference_date) for c in CURRENCIES}
+                    count = self._bucket(ALL, label, reference_date)[0]
+                rows.append((label, count, {c: counts[c][1] / 100 for c in CURRENCIES}))
+            if any(key[-1] != self.revision for key in self._summaries):
+                self._summaries.clear()
+            self._summaries[memo_key] = rows
+        return self._summaries[memo_key]
+
+    def insurer_summary(self, reference_date=None, priced=False):
+        # One row per insurer and currency with the outstanding amount per
+        # bucket; ``priced`` counts each share in one currency only (PRICED).
+        reference_date = reference_date or date.today()
+        rows = []
+        size = 3 if priced else 2
+        for key in sorted(k for k in self.days if k[0] is not None and len(k) == size):
+            name, currency = key[:2]
+            row = {"Insurer": get_registry().display_name(name), "Currency": currency}
+            total = 0
+            for label, _, _ in BUCKETS:
+                count, cents = self._bucket(key, label, reference_date)
+                row[label] = cents / 100
+                total += cents
+            if total:
+                row["Total outstanding"] = total / 100
+                rows.append(row)
+        return rows
+
+    def bucket_invoices(self, label, insurer=None, reference_date=None):
+        # (case_no, invoice_no) of one bucket only, oldest first.
+        keys = [(normalize_insurer(insurer), c) for c in CURRENCIES] if insurer else [ALL]
+        refs = []
+        seen = set()
+        for key in keys:
+            for day in self._days_in(key, label, reference_date):
+                for ref in sorted(self.refs[key][day], key=str):
+                    if ref not in seen:
+                        seen.add(ref)
+                        refs.append((day, ref))
+        return [ref for _, ref in sorted(refs, key=lambda r: (r[0], str(r[1])))]
+
+
+def aging_report(insurer=None, reference_date=None, reporting=None):
+    # (bucket rows, per-insurer rows) for the outstanding view and reports.
+    # With ``reporting`` each share is revalued into that currency at
+    # ``reference_date`` from the currency it is priced in (PRICED), and the
+    # currencies are added up.
+    aggregates = get_aging()
+    reference_date = reference_date or date.today()
+    if reporting is None:
+        return aggregates.buckets(insurer, reference_date), aggregates.insurer_summary(reference_date)
+    buckets = aggregates.buckets(insurer, reference_date, priced=True)
+    amounts = np.array([[totals[c] for c in CURRENCIES] for _, _, totals in buckets], dtype=float).reshape(-1)
+    revalued = fx.revalue(amounts, list(CURRENCIES) * len(buckets), reporting, reference_date)
+    # a currency with nothing outstanding needs no rate
+    revalued = np.where(amounts == 0, 0.0, revalued).reshape(len(buckets), len(CURRENCIES)).sum(axis=1)
+    buckets = [(label, count, {reporting: float(amount)}) for (label, count, _), amount in zip(buckets, revalued)]
+    frame = pd.DataFrame(aggregates.insurer_summary(reference_date, priced=True))
+    if not frame.empty:
+        amount_columns = [label for label, _, _ in BUCKETS] + ["Total outstanding"]
+        revalued = fx.revalue_frame(frame, amount_columns, reporting, reference_date)
+        for column in amount_columns:
+            revalued[column] = revalued[column].where(frame[column].fillna(0) != 0, 0.0)
+        # an insurer owed in several currencies gets one row; a missing rate
+        # stays NaN instead of dropping out of the sum
+        frame = revalued.groupby(["Insurer", "Currency"], sort=False, as_index=False)[amount_columns].agg(
+            lambda column: column.sum(skipna=False))
+    return buckets, frame.to_dict("records")
+
+
+def get_aging():
+    global _aging
+    if _aging is None:
+        _aging = AgingAggregates.from_store(storage.get_store())
+    return _aging
+
+
+def _on_change(changes):
+    global _aging
+    if _aging is None:
+        return
+    if changes is None:
+        _aging = None
+        return
+    for record in changes:
+        storage.dispatch_change(_aging, record)
+
+
+storage.add_listener(_on_change)
@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from money import allocate, fx_convert, split_amount
+
+# Synthetic books for timing the app's workflows headlessly, e.g.
+#   python bench.py --cases 10000 --invoices-per-case 3 --output bench.json
+#   python bench.py --cases 10000 --invoices-per-case 3 --compare bench.json
+# Results are JSON so runs from different commits can be compared.
+BENCHMARKS = ("save_full", "load_cold", "load_cached", "save_change", "import_workbook", "match_build",
+              "match_queries", "aging_build", "aging_report", "search_cases", "page_cases")
+OFFICES = ("ABL KL", "ABL SG", "ABL LDN")
+CLIENTS = ("Marsh", "Aon", "WTW", "Gallagher", "Lockton", "Howden")
+REGRESSION_THRESHOLD = 1.25
+
+
+def generate_book(cases, invoices_per_case, insurers, seed=0, today=None):
+    # {case_no: case} with ``invoices_per_case`` invoices on average. Insurer
+    # popularity and shares are uneven, invoices are billed in MYR or USD,
+    # most are recent (ages fall off exponentially) and most are outstanding.
+    rng = random.Random(seed)
+    today = today or date.today()
+    names = [f"Insurer {i:04d} Berhad" if i % 3 == 0 else f"Insurer {i:04d}" for i in range(insurers)]
+    popularity = [1 / (i + 1) for i in range(insurers)]
+    book = {}
+    for c in range(cases):
+        case_no = f"ABL-{c:07d}"
+        count = min(insurers, int(rng.paretovariate(2.0)) + rng.randint(0, 1))
+        chosen = []
+        while len(chosen) < count:
+            name = rng.choices(names, popularity)[0]
+            if name not in chosen:
+                chosen.append(name)
+        weights = [rng.paretovariate(1.5) for _ in chosen]
+        shares = {name: bp / 100 for name, bp in zip(chosen, allocate(10000, weights))}
+        loss = today - timedelta(days=rng.randint(30, 2000))
+        invoices = []
+        for i in range(int(rng.expovariate(1 / invoices_per_case) + 0.5) if invoices_per_case else 0):
+            rate = round(rng.uniform(4.2, 4.8), 4)
+            amount = round(rng.lognormvariate(8, 1.2), 2)
+            if rng.random() < 0.6:
+                usd, myr = amount, fx_convert(amount, rate)
+            else:
+                myr, usd = amount, fx_convert(amount, rate, divide=True)
+            inv = {
+                "invoice_no": f"INV-{c:07d}-{i:02d}",
+                "Date of invoice": (today - timedelta(days=min(2000, int(rng.expovariate(1 / 200))))).isoformat(),
+                "Status": "Outstanding",
+                "issuing office": rng.choice(OFFICES),
+                "Total amount(MYR)": myr,
+                "Total amount(USD)": usd,
+                "exchange rate": rate,
+                "insurer amounts(MYR)": split_amount(myr, shares),
+                "insurer amounts(USD)": split_amount(usd, shares),
+            }
+            roll = rng.random()
+            if roll < 0.2:
+                paid = list(shares) if roll < 0.15 else list(shares)[:max(1, len(shares) // 2)]
+                inv["verified_insurers"] = {
+                    name: {"Received Amount": inv["insurer amounts(USD)"][name], "Payment to": rng.choice(OFFICES),
+                           "currency": "USD", "verified": True}
+                    for name in paid}
+                if len(paid) == len(shares):
+                    inv["Status"] = "Paid"
+            invoices.append(inv)
+        book[case_no] = {
+            "clients": rng.choice(CLIENTS),
+            "insured": f"Insured {rng.randint(1, cases)}",
+            "case_title": f"Claim {c}",
+            "date_of_loss": loss.strftime("%d-%b-%Y"),
+            "insurers": shares,
+            "invoices": invoices,
+        }
+    return book
+
+
+def write_workbook(book, path, sheets=1):
+    # The book as an import workbook: a title row, the header, then one row
+    # per invoice, spread over ``sheets`` sheets.
+    from openpyxl import Workbook
+
+    from importer import IMPORT_COLUMNS
+
+    rows = []
+    for case_no, case in book.items():
+        insurers = ", ".join(case["insurers"])
+        for inv in case["invoices"]:
+            rows.append([case_no, inv["invoice_no"], case["clients"], case["insured"], case["case_title"],
+                         case["date_of_loss"], insurers, inv["Date of invoice"], inv["issuing office"],
+                         inv["Status"], inv["Total amount(MYR)"], inv["Total amount(USD)"], inv["exchange rate"],
+                         json.dumps(inv["insurer amounts(MYR)"]), json.dumps(inv["insurer amounts(USD)"])])
+    workbook = Workbook(write_only=True)
+    per_sheet = -(-len(rows) // sheets) if rows else 0
+    for s in range(sheets):
+        sheet = workbook.create_sheet(f"Sheet{s + 1}")
+        sheet.append(["Synthetic import"])
+        sheet.append(IMPORT_COLUMNS)
+        for row in rows[s * per_sheet:(s + 1) * per_sheet]:
+            sheet.append(row)
+    workbook.save(path)
+    return len(rows)
+
+
+def _reset():
+    # Drops every process-level cache so the next call starts cold.
+    import storage
+
+    storage._store = None
+    storage.invalidate_cache()
+    storage._notify(None)
+
+
+def _cold():
+    _reset()
+    return ()
+
+
+def _timed(run, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        started = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - started)
+    return {"min": round(min(times), 6), "median": round(statistics.median(times), 6), "repeat": repeat}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(book, repeat=3, queries=200, skip=(), sheets=1, workers=1, seed=0):
+    # Times each workflow on ``book``; must run in a scratch directory.
+    import storage
+    from aging import get_aging
+    from importer import import_workbook
+    from matching import CURRENCIES, get_matcher
+
+    rng = random.Random(seed)
+    results = {}
+    wanted = [name for name in BENCHMARKS if name not in skip]
+
+    def bench(name, run, setup=None, times=repeat, warm=False):
+        # ``warm``: one untimed run first, so lazily built indexes (insurer
+        # registry, name lookups) are not charged to the first repeat
+        if name in wanted:
+            if warm:
+                run()
+            results[name] = _timed(run, times, setup)
+
+    bench("save_full", lambda: storage.save_data(book))
+    storage.save_data(book)
+    bench("load_cold", storage.load_data, setup=_cold)
+    data = storage.load_data()
+    bench("load_cached", storage.load_data)
+
+    cases = list(data)
+    refs = [(case_no, inv) for case_no in cases for inv in data[case_no]["invoices"]]
+    if refs:
+        def save_change():
+            case_no, inv = rng.choice(refs)
+            storage.save_data(data, [storage.invoice_upsert(case_no, dict(inv))])
+        bench("save_change", save_change, times=max(repeat, 20))
+
+    if "import_workbook" in wanted:
+        workbook = os.path.abspath("bench_import.xlsx")
+        rows = write_workbook(book, workbook, sheets)
+        home = os.getcwd()
+
+        def import_setup():
+            os.chdir(tempfile.mkdtemp(dir=home))
+            return _cold()
+
+        results["import_workbook"] = _timed(lambda: import_workbook(workbook, {}, workers), repeat, import_setup)
+        results["import_workbook"]["rows"] = rows
+        os.chdir(home)
+        _reset()
+        data = storage.load_data()
+
+    bench("match_build", get_matcher, setup=_cold)
+    shares = [(currency, insurer, amount)
+              for _, inv in refs[:20000] if inv.get("Status") != "Paid"
+              for currency in CURRENCIES
+              for insurer, amount in inv.get(f"insurer amounts({currency})", {}).items()]
+    if shares:
+        sample = [rng.choice(shares) for _ in range(queries)]
+
+        def match_queries():
+            matcher = get_matcher()
+            for currency, insurer, amount in sample:
+                exact, close = matcher.match(currency, insurer, amount)
+                for case_no, invoice_no, _, _ in exact + close:
+                    storage.lookup_invoice(data, case_no, invoice_no)
+        bench("match_queries", match_queries, warm=True)
+
+    bench("aging_build", get_aging, setup=_cold)
+    today = date.today()
+
+    def aging_report():
+        aging = get_aging()
+        # distinct reference dates so the per-date memo does not answer
+        for offset in range(10):
+            aging.buckets(None, today + timedelta(days=offset))
+        aging.insurer_summary(today)
+    bench("aging_report", aging_report, warm=True)
+
+    needles = [str(rng.choice(cases))[-rng.randint(2, 6):] for _ in range(queries)] if cases else []
+    store = storage.get_store()
+    bench("search_cases", lambda: [store.search_cases(needle) for needle in needles], warm=True)
+    bench("page_cases", lambda: [store.page_cases(needle, "date_of_loss", False, 0, 50) for needle in needles],
+          warm=True)
+    return results
+
+
+def compare(results, previous, threshold=REGRESSION_THRESHOLD):
+    # Adds "ratio" (this run's min over the previous one's) per benchmark and
+    # returns the names slower than ``threshold``.
+    slower = []
+    for name, result in results.items():
+        before = previous.get("results", {}).get(name)
+        if before and before.get("min"):
+            result["ratio"] = round(result["min"] / before["min"], 3)
+            if result["ratio"] > threshold:
+                slower.append(name)
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the case book workflows on a synthetic book.")
+    parser.add_argument("--cases", type=int, default=1000)
+    parser.add_argument("--invoices-per-case", type=float, default=1.0)
+    parser.add_argument("--insurers", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=200, help="match/search queries per run")
+    parser.add_argument("--backend", choices=("json", "parquet", "sqlite"), default="json")
+    parser.add_argument("--sheets", type=int, default=1, help="sheets in the import workbook")
+    parser.add_argument("--workers", type=int, default=1, help="import worker processes")
+    parser.add_argument("--skip", nargs="*", default=[], choices=BENCHMARKS)
+    parser.add_argument("--dir", help="scratch directory (default: a new temporary one)")
+    parser.add_argument("--output", "-o", help="write the JSON here as well as to stdout")
+    parser.add_argument("--compare", help="previous JSON result to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--write-book", help="only write the synthetic book as JSON to this file")
+    parser.add_argument("--write-workbook", help="only write the synthetic import workbook to this file")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    book = generate_book(args.cases, args.invoices_per_case, args.insurers, args.seed)
+    generated = round(time.perf_counter() - started, 3)
+    if args.write_book or args.write_workbook:
+        if args.write_book:
+            with open(args.write_book, "w") as f:
+                json.dump(book, f, indent=4)
+        if args.write_workbook:
+            write_workbook(book, args.write_workbook, args.sheets)
+        return 0
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+    # storage picks its backend and file names at import, relative to the cwd
+    os.environ["CASES_BACKEND"] = args.backend
+    os.chdir(args.dir or tempfile.mkdtemp(prefix="case-bench-"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    results = run_benchmarks(book, args.repeat, args.queries, set(args.skip), args.sheets, args.workers, args.seed)
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": args.backend,
+        "cases": len(book),
+        "invoices": sum(len(case["invoices"]) for case in book.values()),
+        "insurers": args.insurers,
+        "seed": args.seed,
+        "generate_seconds": generated,
+        "results": results,
+    }
+    slower = compare(results, previous, args.threshold) if previous else []
+    if previous:
+        report["compared_to"] = previous.get("commit")
+        report["regressions"] = slower
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if slower else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
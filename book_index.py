@@ -0,0 +1,108 @@
+from collections.abc import Mapping
+
+# Shortest query a trigram index can answer; shorter ones are scanned. Shared
+# by the case, insurer and SQLite text indexes.
+MIN_GRAM_QUERY = 3
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class BookIndex:
+    # Lookup structures over a book: invoice_no -> {case_no: position}, case
+    # numbers in book order and a trigram index over the lowercased case
+    # numbers for substring search.
+    def __init__(self):
+        self.order = {}
+        self.seq = 0
+        self.grams = {}
+        self.case_invoices = {}
+        self.invoices = {}
+
+    @classmethod
+    def from_book(cls, data):
+        index = cls()
+        for case_no, case in data.items():
+            if isinstance(case, Mapping):
+                index.index_case(case_no, case)
+        return index
+
+    def _add_case(self, case_no, seq=None):
+        if case_no in self.order:
+            return
+        if seq is None:
+            self.seq += 1
+            seq = self.seq
+        self.order[case_no] = seq
+        for gram in trigrams(str(case_no).lower()):
+            self.grams.setdefault(gram, set()).add(case_no)
+
+    def remove_case(self, case_no):
+        if case_no not in self.order:
+            return
+        del self.order[case_no]
+        for gram in trigrams(str(case_no).lower()):
+            self.grams[gram].discard(case_no)
+        for invoice_no in self.case_invoices.pop(case_no, []):
+            owners = self.invoices.get(invoice_no, {})
+            owners.pop(case_no, None)
+            if not owners:
+                self.invoices.pop(invoice_no, None)
+
+    def index_case(self, case_no, case, seq=None):
+        # (Re)indexes the invoices of one case from its current list; ``seq``
+        # places a new case in book order (default: last).
+        self._add_case(case_no, seq)
+        for invoice_no in self.case_invoices.get(case_no, []):
+            owners = self.invoices.get(invoice_no, {})
+            owners.pop(case_no, None)
+            if not owners:
+                self.invoices.pop(invoice_no, None)
+        invoices = case.get("invoices", [])
+        numbers = []
+        for position, inv in enumerate(invoices if isinstance(invoices, list) else []):
+            invoice_no = inv.get("invoice_no")
+            numbers.append(invoice_no)
+            self.invoices.setdefault(invoice_no, {}).setdefault(case_no, position)
+        self.case_invoices[case_no] = numbers
+
+    def update(self, data, record):
+        # Brings the index in line with ``data`` after ``record`` was applied.
+        op = record.get("op")
+        case_no = record.get("case_no")
+        if op == "case_delete":
+            self.remove_case(case_no)
+        elif op == "case_rename":
+            if record["new_case_no"] in data and case_no not in data:
+                # a renamed case keeps its place (see storage.apply_change)
+                seq = self.order.get(case_no)
+                self.remove_case(case_no)
+                self.index_case(record["new_case_no"], data[record["new_case_no"]], seq)
+        elif op in ("case_upsert", "invoice_upsert", "invoice_delete") and case_no in data:
+            self.index_case(case_no, data[case_no])
+
+    def locate(self, invoice_no):
+        # (case_no, position) of an invoice number, or None.
+        owners = self.invoices.get(invoice_no)
+        if not owners:
+            return None
+        case_no = min(owners, key=self.order.get)
+        return case_no, owners[case_no]
+
+    def search(self, query):
+        # Case numbers containing ``query`` (case-insensitive), in book order.
+        query = query.lower()
+        if not query:
+            return list(self.order)
+        if len(query) < MIN_GRAM_QUERY:
+            found = [case_no for case_no in self.order if query in str(case_no).lower()]
+        else:
+            candidates = None
+            for gram in trigrams(query):
+                cases = self.grams.get(gram, set())
+                candidates = set(cases) if candidates is None else candidates & cases
+                if not candidates:
+                    break
+            found = [case_no for case_no in candidates or () if query in str(case_no).lower()]
+        return sorted(found, key=self.order.get)
@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+# Exit codes: the command ran and found nothing to report (OK), failed
+# (ERROR), was called wrongly (USAGE, as argparse), or ran but left rows that
+# need a person to look at them (ATTENTION: skipped duplicates, unmatched
+# statement lines).
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_ATTENTION = 3
+
+# Commands import their modules when they run so that ``--help`` and small
+# jobs start quickly; nothing here imports streamlit.
+
+
+def _date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected YYYY-MM-DD, got {value!r}")
+
+
+def cmd_import(args):
+    from importer import import_workbook, stream_import, sync_workbook
+    from storage import load_data
+
+    if args.sync:
+        if args.stream:
+            raise ValueError("--sync reads the whole workbook; it cannot be combined with --stream")
+        stats = sync_workbook(args.workbook, load_data(), args.workers, args.overwrite)
+        return stats, EXIT_ATTENTION if stats["conflicts"] or stats["duplicate_invoices"] else EXIT_OK
+    if args.stream:
+        stats = stream_import(args.workbook, chunk_size=args.chunk_size)
+    else:
+        stats = import_workbook(args.workbook, load_data(), args.workers)
+    attention = stats["duplicate_cases"] or stats["duplicate_invoices"]
+    return stats, EXIT_ATTENTION if attention else EXIT_OK
+
+
+def cmd_reconcile(args):
+    from reconcile import plan_reconciliation, read_statement, reconcile, summarize
+    from storage import load_data
+
+    data = load_data()
+    if args.dry_run:
+        report = plan_reconciliation(data, read_statement(args.statement), not args.no_resolve)
+        summary = summarize(report)
+    else:
+        summary, report = reconcile(data, args.statement, resolve_ambiguous=not args.no_resolve)
+    result = {"summary": summary, "dry_run": args.dry_run, "lines": report}
+    attention = summary["unmatched"] or summary["ambiguous"]
+    return result, EXIT_ATTENTION if attention else EXIT_OK
+
+
+def cmd_aging(args):
+    from aging import aging_report
+    from insurers import get_registry
+
+    insurer = None
+    if args.insurer:
+        found = get_registry().search(args.insurer)
+        if not found:
+            raise LookupError(f"No insurer matches {args.insurer!r}")
+        insurer = found[0]
+    buckets, insurers = aging_report(insurer, args.date, args.currency)
+    return {
+        "reference_date": (args.date or datetime.today().date()).isoformat(),
+        "insurer": get_registry().display_name(insurer) if insurer else None,
+        "currency": args.currency,
+        "buckets": [{"bucket": label, "invoices": count, "amounts": totals} for label, count, totals in buckets],
+        "insurers": insurers,
+    }, EXIT_OK
+
+
+def cmd_export(args):
+    import csv
+
+    from records import json_default
+    from storage import get_store
+
+    if args.format in ("xlsx", "parquet") or args.dataset:
+        return _export_pack(args)
+
+    _, rows = get_store().page_invoices(args.status, args.query, args.sort, args.descending)
+    records = []
+    for case_no, inv in rows:
+        record = {"Case No": case_no}
+        record.update(inv)
+        for column in ("insurer amounts(MYR)", "insurer amounts(USD)", "verified_insurers"):
+            if args.format == "csv" and column in record:
+                record[column] = json.dumps(record[column], default=json_default)
+        records.append(record)
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        if args.format == "csv":
+            fields = []
+            for record in records:
+                fields.extend(field for field in record if field not in fields)
+            writer = csv.DictWriter(out, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            for record in records:
+                out.write(json.dumps(record, default=json_default) + "\n")
+    finally:
+        if args.output:
+            out.close()
+    # the rows themselves are the output; a summary only goes with --output
+    return ({"invoices": len(records), "output": args.output} if args.output else None), EXIT_OK
+
+
+def _export_pack(args):
+    # Whole datasets through the exporter (chunked, several per workbook).
+    from exporter import DATASETS, export
+
+    if not args.output:
+        raise ValueError(f"{args.format} exports need --output")
+    if args.format == "jsonl":
+        raise ValueError("--dataset exports are written as csv, xlsx or parquet")
+    if args.query or args.sort:
+        raise ValueError("--query and --sort only apply to invoice rows written without --dataset")
+    datasets = args.dataset or (list(DATASETS) if args.format == "xlsx" else ["invoices"])
+    result = export(args.output, datasets, args.format, args.chunk_size, args.status, args.date, args.currency)
+    return result, EXIT_OK
+
+
+def cmd_ledger(args):
+    from ledger import backfill, get_ledger
+    from storage import load_data
+
+    added = backfill(load_data()) if args.backfill else 0
+    payments = get_ledger()
+    filters = {"insurer": args.insurer, "bank": args.bank, "currency": args.currency, "start": args.start,
+               "end": args.end}
+    result = {"backfilled": added, "receipts": len(payments.receipts_for(**filters)),
+              "report": payments.cash_report(args.by, **filters)}
+    if args.invoice:
+        result["invoice"] = [dict(receipt, allocations=[allocation])
+                             for receipt, allocation in payments.invoice_receipts(args.invoice)]
+    return result, EXIT_OK
+
+
+def cmd_compact(args):
+    import storage
+
+    store = storage.get_store()
+    journal_file = getattr(store, "journal_file", None)
+    before = os.path.getsize(journal_file) if journal_file and os.path.exists(journal_file) else 0
+    storage.compact()
+    after = os.path.getsize(journal_file) if journal_file and os.path.exists(journal_file) else 0
+    return {"backend": storage.BACKEND, "journal_bytes_before": before, "journal_bytes_after": after}, EXIT_OK
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cli.py", description="Case book batch jobs (JSON output).")
+    parser.add_argument("--dir", help="directory holding the case book files (default: current)")
+    parser.add_argument("--backend", choices=("json", "parquet", "sqlite"),
+                        help="storage backend (default: $CASES_BACKEND or json)")
+    parser.add_argument("--pretty", action="store_true", help="indent the JSON output")
+    parser.add_argument("--perf", action="store_true", help="add timing spans and counters to the output")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="import an Excel workbook")
+    command.add_argument("workbook")
+    command.add_argument("--stream", action="store_true", help="read row by row and commit in chunks")
+    command.add_argument("--chunk-size", type=int, default=2000)
+    command.add_argument("--sync", action="store_true",
+                         help="apply changed rows to existing cases and invoices (row fingerprints)")
+    command.add_argument("--overwrite", action="store_true",
+                         help="with --sync, let the workbook win over rows edited in the book")
+    command.add_argument("--workers", type=int,
+                         help="processes parsing sheets in parallel, 0 for one per CPU (default: $IMPORT_WORKERS or 1)")
+    command.set_defaults(run=cmd_import)
+
+    command = commands.add_parser("reconcile", help="match a bank statement against outstanding invoices")
+    command.add_argument("statement", help="CSV or XLSX statement")
+    command.add_argument("--dry-run", action="store_true", help="report the matches without saving them")
+    command.add_argument("--no-resolve", action="store_true",
+                         help="leave ambiguous lines unapplied instead of using the oldest invoice")
+    command.set_defaults(run=cmd_reconcile)
+
+    command = commands.add_parser("aging", help="outstanding amounts by age bucket and insurer")
+    command.add_argument("--insurer", help="insurer name or part of it")
+    command.add_argument("--date", type=_date, help="reference date, YYYY-MM-DD (default: today)")
+    command.add_argument("--currency", help="revalue amounts into this currency from the FX table")
+    command.set_defaults(run=cmd_aging)
+
+    command = commands.add_parser("export", help="write invoices as CSV or JSON lines, or datasets as "
+                                                 "CSV, XLSX or Parquet files")
+    command.add_argument("--status", help="only invoices (and their payments) with this status")
+    command.add_argument("--query", default="", help="invoice number substring")
+    command.add_argument("--sort", help="invoice field to sort by")
+    command.add_argument("--descending", action="store_true")
+    command.add_argument("--format", choices=("csv", "jsonl", "xlsx", "parquet"), default="csv")
+    command.add_argument("--dataset", action="append",
+                         choices=("invoices", "cases", "payments", "aging", "aging_buckets"),
+                         help="dataset to write (repeatable; default for xlsx: all, one sheet each)")
+    command.add_argument("--date", type=_date, help="aging reference date, YYYY-MM-DD (default: today)")
+    command.add_argument("--currency", help="revalue aging amounts into this currency")
+    command.add_argument("--chunk-size", type=int, default=5000, help="rows written per chunk")
+    command.add_argument("--output", "-o", help="file to write (default: stdout)")
+    command.set_defaults(run=cmd_export)
+
+    command = commands.add_parser("ledger", help="cash received per bank or insurer from the payment ledger")
+    command.add_argument("--by", choices=("bank", "insurer"), default="bank")
+    command.add_argument("--insurer", help="receipts paid by or allocated to this insurer")
+    command.add_argument("--bank", help="receipts into this account, e.g. \"ABL KL\"")
+    command.add_argument("--currency")
+    command.add_argument("--from", dest="start", type=_date, help="first receipt date, YYYY-MM-DD")
+    command.add_argument("--to", dest="end", type=_date, help="last receipt date, YYYY-MM-DD")
+    command.add_argument("--invoice", help="also list the receipts allocated to this invoice number")
+    command.add_argument("--backfill", action="store_true",
+                         help="first record verified payments the ledger does not have yet")
+    command.set_defaults(run=cmd_ledger)
+
+    command = commands.add_parser("compact", help="fold the journal into the snapshot")
+    command.set_defaults(run=cmd_compact)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.dir:
+        os.chdir(args.dir)
+    if args.backend:
+        os.environ["CASES_BACKEND"] = args.backend
+    if args.perf:
+        import perf
+        perf.begin_run(True)
+    try:
+        result, code = args.run(args)
+        if args.perf and isinstance(result, dict):
+            result["perf"] = perf.snapshot()
+    except BrokenPipeError:
+        # output piped into e.g. head; stop quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return EXIT_OK
+    except Exception as e:
+        result, code = {"error": type(e).__name__, "message": str(e)}, EXIT_ERROR
+    if result is not None:
+        stream = sys.stderr if code == EXIT_ERROR else sys.stdout
+        stream.write(json.dumps(result, indent=2 if args.pretty else None, default=str) + "\n")
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
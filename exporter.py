@@ -0,0 +1,263 @@
+import csv
+import json
+import os
+import time
+from collections.abc import Mapping
+from datetime import date
+from itertools import islice
+
+import perf
+import storage
+from aging import BUCKETS, aging_report
+from importer import IMPORT_COLUMNS, insurer_amount_column
+from matching import CURRENCIES
+from records import json_default
+
+# Month-end packs and backups. Each dataset is a header plus a lazily built
+# row iterator that the writers consume EXPORT_CHUNK_SIZE rows at a time, so
+# no export holds a full table of the book. The XLSX pack is laid out for
+# import_workbook: the invoices and cases sheets use the import columns (the
+# cases sheet brings back cases without invoices); the other sheets have no
+# case reference column and are skipped on import.
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+DATASETS = ("invoices", "cases", "payments", "aging", "aging_buckets")
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", "5000"))
+SHEET_TITLES = {
+    "invoices": "Invoices",
+    "cases": "Cases",
+    "payments": "Payments",
+    "aging": "Aging by insurer",
+    "aging_buckets": "Aging buckets",
+}
+CASE_EXPORT_COLUMNS = ["ABL SG Case Ref.", "Clients/ Brokers", "Insured", "Case Title", "Date of loss", "Insurers",
+                       "Invoices"]
+PAYMENT_EXPORT_COLUMNS = ["Case No", "Invoice No", "Invoice Status", "Insurer", "Received Amount", "Currency",
+                          "Payment to", "Verified"]
+# Column kinds for typed (Parquet) output; other columns are text.
+NUMBER_COLUMNS = {"Invoice Amount (MYR)", "Invoice Amount (USD)", "Fx Rate", "Received Amount",
+                  "Total outstanding"} | {label for label, _, _ in BUCKETS}
+COUNT_COLUMNS = {"Invoices"}
+
+
+class Dataset:
+    def __init__(self, name, columns, rows, numbers=()):
+        self.name = name
+        self.columns = columns
+        self.rows = rows
+        self.numbers = NUMBER_COLUMNS | set(numbers)
+
+    def kind(self, column):
+        if column in COUNT_COLUMNS:
+            return "count"
+        return "number" if column in self.numbers else "text"
+
+
+def _json(value):
+    return json.dumps(value, default=json_default) if value else None
+
+
+def _case_details(store):
+    return {case_no: details for case_no, details, _ in store.search_cases("")}
+
+
+def invoice_dataset(store, status=None, cases=None):
+    # Import columns, with insurer amounts one "<insurer> [<currency>]" column
+    # each instead of the JSON dicts; insurer names are collected in a first
+    # pass so the header is known before the first row is written.
+    cases = _case_details(store) if cases is None else cases
+    names = {currency: {} for currency in CURRENCIES}
+    for _, inv in store.iter_invoices(status):
+        for currency in CURRENCIES:
+            names[currency].update(dict.fromkeys(inv.get(f"insurer amounts({currency})", {}) or {}))
+    amount_columns = [(currency, name) for currency in CURRENCIES for name in names[currency]]
+    split_columns = [insurer_amount_column(name, currency) for currency, name in amount_columns]
+    columns = [c for c in IMPORT_COLUMNS if not c.startswith("Insurer Amounts")] + split_columns
+
+    def rows():
+        for case_no, inv in store.iter_invoices(status):
+            case = cases.get(case_no, {})
+            amounts = {currency: inv.get(f"insurer amounts({currency})", {}) or {} for currency in CURRENCIES}
+            yield [case_no, inv.get("invoice_no"), case.get("clients"), case.get("insured"), case.get("case_title"),
+                   case.get("date_of_loss"), _json(case.get("insurers")), inv.get("Date of invoice"),
+                   inv.get("issuing office"), inv.get("Status"), inv.get("Total amount(MYR)"),
+                   inv.get("Total amount(USD)"), inv.get("exchange rate"),
+                   _json(inv.get("verified_insurers"))] + [amounts[currency].get(name)
+                                                           for currency, name in amount_columns]
+
+    return Dataset("invoices", columns, rows(), split_columns)
+
+
+def case_dataset(store, cases=None):
+    def rows():
+        counts = {}
+        for case_no, _ in store.iter_invoices():
+            counts[case_no] = counts.get(case_no, 0) + 1
+        for case_no, case in (_case_details(store) if cases is None else cases).items():
+            yield [case_no, case.get("clients"), case.get("insured"), case.get("case_title"),
+                   case.get("date_of_loss"), _json(case.get("insurers")), counts.get(case_no, 0)]
+
+    return Dataset("cases", CASE_EXPORT_COLUMNS, rows())
+
+
+def payment_dataset(store, status=None):
+    # One row per verified insurer share.
+    def rows():
+        for case_no, inv in store.iter_invoices(status):
+            for insurer, payment in (inv.get("verified_insurers", {}) or {}).items():
+                payment = payment if isinstance(payment, Mapping) else {}
+                yield [case_no, inv.get("invoice_no"), inv.get("Status"), insurer, payment.get("Received Amount"),
+                       payment.get("currency"), payment.get("Payment to"), payment.get("verified")]
+
+    return Dataset("payments", PAYMENT_EXPORT_COLUMNS, rows())
+
+
+def aging_datasets(reference_date=None, reporting=None):
+    buckets, insurers = aging_report(None, reference_date, reporting)
+    currencies = [reporting] if reporting else list(CURRENCIES)
+    labels = [label for label, _, _ in BUCKETS]
+    summary = Dataset("aging", ["Insurer", "Currency"] + labels + ["Total outstanding"],
+                      ([row.get(column) for column in ["Insurer", "Currency"] + labels + ["Total outstanding"]]
+                       for row in insurers))
+    bucket_rows = Dataset("aging_buckets", ["Bucket", "Invoices"] + currencies,
+                          ([label, count] + [totals.get(c) for c in currencies] for label, count, totals in buckets),
+                          currencies)
+    return summary, bucket_rows
+
+
+def build_datasets(names=DATASETS, status=None, reference_date=None, reporting=None):
+    store = storage.get_store()
+    unknown = [name for name in names if name not in DATASETS]
+    if unknown:
+        raise ValueError(f"Unknown dataset(s): {', '.join(unknown)}")
+    cases = _case_details(store) if "invoices" in names or "cases" in names else None
+    built = {}
+    if "invoices" in names:
+        built["invoices"] = invoice_dataset(store, status, cases)
+    if "cases" in names:
+        built["cases"] = case_dataset(store, cases)
+    if "payments" in names:
+        built["payments"] = payment_dataset(store, status)
+    if "aging" in names or "aging_buckets" in names:
+        summary, buckets = aging_datasets(reference_date, reporting)
+        built["aging"], built["aging_buckets"] = summary, buckets
+    return [built[name] for name in names]
+
+
+def chunks(rows, size=EXPORT_CHUNK_SIZE):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _cell(value):
+    # Plain cell value: containers (a malformed field) are written as JSON.
+    if isinstance(value, (Mapping, list)):
+        return json.dumps(value, default=json_default)
+    return value
+
+
+def write_xlsx(path, datasets, chunk_size=EXPORT_CHUNK_SIZE):
+    # Write-only workbook: rows go straight to the file's sheet streams. Each
+    # sheet starts with a title row, as import_workbook skips one.
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    written = {}
+    for dataset in datasets:
+        sheet = workbook.create_sheet(SHEET_TITLES[dataset.name])
+        sheet.append([f"{SHEET_TITLES[dataset.name]} exported {date.today().isoformat()}"])
+        sheet.append(dataset.columns)
+        written[dataset.name] = 0
+        for chunk in chunks(dataset.rows, chunk_size):
+            for row in chunk:
+                sheet.append([_cell(value) for value in row])
+            written[dataset.name] += len(chunk)
+            perf.count("export.rows", len(chunk))
+    workbook.save(path)
+    return written
+
+
+def write_csv(path, dataset, chunk_size=EXPORT_CHUNK_SIZE):
+    written = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(dataset.columns)
+        for chunk in chunks(dataset.rows, chunk_size):
+            writer.writerows([_cell(value) for value in row] for row in chunk)
+            written += len(chunk)
+            perf.count("export.rows", len(chunk))
+    return written
+
+
+def _typed(value, kind):
+    if value is None or value == "":
+        return None
+    if kind == "text":
+        return value if isinstance(value, str) else str(_cell(value))
+    try:
+        return int(value) if kind == "count" else float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def write_parquet(path, dataset, chunk_size=EXPORT_CHUNK_SIZE):
+    # One row group per chunk; values a numeric column cannot hold are null.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"text": pa.string(), "number": pa.float64(), "count": pa.int64()}
+    kinds = [dataset.kind(column) for column in dataset.columns]
+    schema = pa.schema([(column, types[kind]) for column, kind in zip(dataset.columns, kinds)])
+    written = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for chunk in chunks(dataset.rows, chunk_size):
+            arrays = [pa.array([_typed(row[i], kind) for row in chunk], type=types[kind])
+                      for i, kind in enumerate(kinds)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            written += len(chunk)
+            perf.count("export.rows", len(chunk))
+        if not written:
+            writer.write_table(schema.empty_table())
+    return written
+
+
+def export_paths(path, names, fmt):
+    # CSV and Parquet hold one dataset per file: "<stem>_<dataset><ext>" when
+    # there are several.
+    if fmt == "xlsx" or len(names) == 1:
+        return {name: path for name in names}
+    stem, ext = os.path.splitext(path)
+    return {name: f"{stem}_{name}{ext or '.' + fmt}" for name in names}
+
+
+def export_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Cannot export to {fmt or path!r}; use one of {', '.join(EXPORT_FORMATS)}")
+    return fmt
+
+
+def export(path, datasets=DATASETS, fmt=None, chunk_size=EXPORT_CHUNK_SIZE, status=None, reference_date=None,
+           reporting=None):
+    # Writes ``datasets`` to ``path`` (format from ``fmt`` or the extension)
+    # and returns {"format", "files", "rows": {dataset: rows}, "seconds"}.
+    started = time.perf_counter()
+    fmt = export_format(path, fmt)
+    datasets = list(datasets)
+    paths = export_paths(path, datasets, fmt)
+    with perf.span("export.write"):
+        built = build_datasets(datasets, status, reference_date, reporting)
+        if fmt == "xlsx":
+            rows = write_xlsx(path, built, chunk_size)
+        else:
+            writer = write_csv if fmt == "csv" else write_parquet
+            rows = {dataset.name: writer(paths[dataset.name], dataset, chunk_size) for dataset in built}
+    return {
+        "format": fmt,
+        "files": sorted(set(paths.values())),
+        "rows": rows,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
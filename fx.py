@@ -0,0 +1,141 @@
+import csv
+import os
+from datetime import date, datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from money import fx_round
+
+# Daily rates as "date,currency,rate" rows, the rate being BASE_CURRENCY per
+# one unit of the currency (the same quote as an invoice's "exchange rate").
+FX_FILE = "fx_rates.csv"
+BASE_CURRENCY = "MYR"
+# Invoices are priced in USD; their MYR amounts follow from the invoice's own
+# rate, so revaluation starts from the USD amounts.
+SOURCE_CURRENCY = "USD"
+DATE_FORMATS = ("%Y-%m-%d", "%d-%b-%Y", "%d/%m/%Y")
+
+_rates = None
+_rates_mtime = None
+
+
+def to_day(value):
+    # Day ordinal of a date, datetime or date string.
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, date):
+        return value.toordinal()
+    text = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).toordinal()
+        except ValueError:
+            pass
+    raise ValueError(f"Unrecognised rate date: {value!r}")
+
+
+class RateTable:
+    # Per-currency rate series sorted by day; a lookup returns the latest rate
+    # on or before the requested day.
+    def __init__(self, rows=()):
+        series = {}
+        for day, currency, rate in rows:
+            series.setdefault(currency.strip().upper(), {})[day] = rate
+        self.days = {}
+        self.rates = {}
+        for currency, by_day in series.items():
+            days = sorted(by_day)
+            self.days[currency] = np.array(days, dtype=np.int64)
+            self.rates[currency] = np.array([by_day[day] for day in days], dtype=float)
+
+    @classmethod
+    def from_csv(cls, path=FX_FILE):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, newline="", encoding="utf-8") as file:
+            rows = [(to_day(row["date"]), row["currency"], float(row["rate"]))
+                    for row in csv.DictReader(file) if (row.get("rate") or "").strip()]
+        return cls(rows)
+
+    def currencies(self):
+        return [BASE_CURRENCY] + sorted(c for c in self.days if c != BASE_CURRENCY)
+
+    def rates_on(self, currency, days):
+        # As-of rates for an array of day ordinals; NaN before the first rate.
+        days = np.asarray(days, dtype=np.int64)
+        currency = currency.upper()
+        if currency == BASE_CURRENCY:
+            return np.ones(len(days))
+        if currency not in self.days:
+            return np.full(len(days), np.nan)
+        positions = np.searchsorted(self.days[currency], days, side="right") - 1
+        rates = self.rates[currency][np.clip(positions, 0, None)]
+        return np.where(positions >= 0, rates, np.nan)
+
+    def rate(self, currency, day):
+        value = self.rates_on(currency, [day])[0]
+        return None if np.isnan(value) else float(value)
+
+
+def get_rates():
+    # The table is re-read when the CSV changes on disk.
+    global _rates, _rates_mtime
+    mtime = os.path.getmtime(FX_FILE) if os.path.exists(FX_FILE) else None
+    if _rates is None or mtime != _rates_mtime:
+        _rates = RateTable.from_csv()
+        _rates_mtime = mtime
+        _cross_rate.cache_clear()
+    return _rates
+
+
+@lru_cache(maxsize=4096)
+def _cross_rate(currency, reporting, day):
+    source = _rates.rate(currency, day)
+    target = _rates.rate(reporting, day)
+    if source is None or not target:
+        return None
+    return source / target
+
+
+def rate(currency, on=None, reporting=BASE_CURRENCY):
+    # Units of ``reporting`` per unit of ``currency`` as of ``on`` (today by
+    # default), or None when the table has no rate yet.
+    get_rates()
+    return _cross_rate(currency.upper(), reporting.upper(), to_day(on or date.today()))
+
+
+def invoice_rate(on=None, currency=SOURCE_CURRENCY):
+    # Default "exchange rate" for a new invoice dated ``on``.
+    value = rate(currency, on)
+    return None if value is None else fx_round(value)
+
+
+def revalue(amounts, currencies, reporting, on=None):
+    # Converts parallel arrays of amounts and currency codes to ``reporting``
+    # at one date, or at per-row day ordinals (historical rates) when ``on``
+    # is an array. Rows without a rate come back as NaN.
+    table = get_rates()
+    amounts = np.asarray(amounts, dtype=float)
+    currencies = np.asarray(currencies, dtype=object)
+    if on is None or isinstance(on, (date, str)):
+        days = np.full(len(amounts), to_day(on or date.today()), dtype=np.int64)
+    else:
+        days = np.asarray(on, dtype=np.int64)
+    target = table.rates_on(reporting, days)
+    result = np.full(len(amounts), np.nan)
+    for currency in pd.unique(currencies):
+        rows = currencies == currency
+        result[rows] = amounts[rows] * table.rates_on(str(currency), days[rows]) / target[rows]
+    return result
+
+
+def revalue_frame(frame, columns, reporting, on=None, currency_column="Currency"):
+    # Copy of ``frame`` with the amount ``columns`` converted to ``reporting``.
+    frame = frame.copy()
+    currencies = frame[currency_column].to_numpy()
+    for column in columns:
+        frame[column] = revalue(frame[column].fillna(0).to_numpy(), currencies, reporting, on).round(2)
+    frame[currency_column] = reporting
+    return frame
@@ -0,0 +1,614 @@
+import hashlib
+import io
+import json
+import os
+import re
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from datetime import date, datetime
+
+import pandas as pd
+
+import perf
+from insurers import canonical_shares, get_registry
+from money import equal_shares
+from records import plain_copy
+from storage import (save_data, apply_changes, get_store, case_upsert, editable_copy, invoice_upsert,
+                     lookup_invoice)
+
+IMPORT_COLUMNS = [
+    "ABL SG Case Ref.", "Invoice No", "Clients/ Brokers", "Insured", "Case Title", "Date of loss",
+    "Insurers", "Date of Invoice", "Issuing Office", "Status", "Invoice Amount (MYR)",
+    "Invoice Amount (USD)", "Fx Rate", "Insurer Amounts (MYR)", "Insurer Amounts (USD)", "Verified Payments",
+]
+# Insurer amounts may also come one column per insurer and currency, headed
+# e.g. "AXA [USD]" (the exporter's layout); a row's blank cells are insurers
+# not on that invoice.
+INSURER_AMOUNT_COLUMN = re.compile(r"^(.*\S)\s*\[(MYR|USD)\]$")
+INVOICE_DATE_FORMATS = ("%d-%b-%Y", "%Y-%m-%d")
+STREAM_CHUNK_SIZE = 2000
+# Workers are spawned, not forked, as the app runs threads (see import_workers).
+IMPORT_START_METHOD = "spawn"
+# Content hashes of the case and invoice rows last imported, next to the book;
+# a sync compares each row's hash against them (see sync_workbook).
+FINGERPRINT_FILE = "cases_data.fingerprints.json"
+SYNC_CASE_FIELDS = ("clients", "insured", "case_title", "date_of_loss", "insurers")
+SYNC_INVOICE_FIELDS = ("Date of invoice", "issuing office", "Status", "Total amount(MYR)", "Total amount(USD)",
+                       "exchange rate", "insurer amounts(MYR)", "insurer amounts(USD)")
+
+
+def normalize_columns(df):
+    canonical = {" ".join(c.lower().split()): c for c in IMPORT_COLUMNS}
+    renamed = {}
+    for column in df.columns:
+        key = " ".join(str(column).lower().split())
+        renamed[column] = canonical.get(key, column)
+    df = df.rename(columns=renamed)
+    for column in IMPORT_COLUMNS:
+        if column not in df.columns:
+            df[column] = ""
+    return df
+
+
+def is_import_sheet(columns):
+    # Sheets without a case reference column (e.g. an export's payments and
+    # aging sheets) hold no import rows.
+    key = " ".join(IMPORT_COLUMNS[0].lower().split())
+    return any(" ".join(str(column).lower().split()) == key for column in columns)
+
+
+def insurer_amount_column(insurer, currency):
+    return f"{insurer} [{currency}]"
+
+
+def pro_insurers_data(insurers):
+    insurers_str = str(insurers).strip()
+    if insurers_str.startswith("{") and insurers_str.endswith("}"):
+        try:
+            return json.loads(insurers_str)
+        except json.JSONDecodeError:
+            pass
+        try:
+            insurers_dict = json.loads(insurers_str.replace("'", "\""))
+            return insurers_dict
+        except json.JSONDecodeError:
+            return {}
+    else:
+        insurers_list = [name.strip() for name in insurers_str.split(",") if name.strip()]
+        if not insurers_list:
+            return {}
+        return dict(zip(insurers_list, equal_shares(len(insurers_list))))
+
+
+def parse_json_or_default(value):
+    try:
+        return json.loads(value) if isinstance(value, str) and value.startswith("{") else {}
+    except json.JSONDecodeError:
+        return {}
+
+
+def _map_unique(s, func):
+    # Parse each distinct value once; insurer strings and amount dicts repeat
+    # across every invoice row of a case.
+    codes, uniques = pd.factorize(s.astype(str), sort=False)
+    parsed = [func(value) for value in uniques]
+    return [parsed[code] if code >= 0 else func("") for code in codes]
+
+
+def _parse_dates(s, formats):
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    parsed = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns]")
+    is_datetime = s.map(type).isin((pd.Timestamp, datetime, date))
+    if is_datetime.any():
+        parsed[is_datetime] = pd.to_datetime(s[is_datetime], errors="coerce")
+    is_str = s.map(type).eq(str) & s.ne("")
+    for fmt in formats:
+        todo = is_str & parsed.isna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(s[todo], format=fmt, errors="coerce")
+    return parsed
+
+
+def _amounts_from_columns(df, currency):
+    # JSON amount dicts rebuilt from the "<insurer> [<currency>]" columns, or
+    # None when the sheet has none.
+    columns = {}
+    for column in df.columns:
+        match = INSURER_AMOUNT_COLUMN.match(str(column))
+        if match and match.group(2) == currency:
+            columns[column] = match.group(1)
+    if not columns:
+        return None
+    values = df[list(columns)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    names = list(columns.values())
+    return pd.Series([json.dumps({name: float(v) for name, v in zip(names, row) if v == v}) if (row == row).any()
+                      else "" for row in values], index=df.index)
+
+
+def _format_dates(s, formats, out_format, keep_raw):
+    parsed = _parse_dates(s, formats)
+    formatted = parsed.dt.strftime(out_format)
+    fallback = (s if keep_raw else s.astype(str)).where(s.notna(), "")
+    return formatted.where(parsed.notna(), fallback)
+
+
+def parse_sheet(sheet_df):
+    # Column-wise normalization of one sheet. Insurer columns stay raw text:
+    # resolving names needs the insurer registry, which only the merging
+    # process has.
+    if not is_import_sheet(sheet_df.columns):
+        sheet_df = sheet_df.iloc[0:0]
+    df = normalize_columns(sheet_df)
+    frame = pd.DataFrame(index=df.index)
+    frame["date_of_loss"] = _format_dates(df["Date of loss"], (), "%d-%b-%Y", keep_raw=False)
+    frame["invoice_date"] = _format_dates(df["Date of Invoice"], INVOICE_DATE_FORMATS, "%Y-%m-%d", keep_raw=True)
+    df = df.fillna("")
+    frame["case_no"] = df["ABL SG Case Ref."].astype(str).str.strip()
+    frame["invoice_no"] = df["Invoice No"].astype(str).str.strip()
+    frame["clients"] = df["Clients/ Brokers"]
+    frame["insured"] = df["Insured"]
+    frame["case_title"] = df["Case Title"]
+    frame["insurers"] = df["Insurers"].astype(str).str.strip()
+    frame["office"] = df["Issuing Office"]
+    frame["status"] = df["Status"]
+    for column, source in (("total_myr", "Invoice Amount (MYR)"), ("total_usd", "Invoice Amount (USD)"),
+                           ("fx", "Fx Rate")):
+        frame[column] = pd.to_numeric(df[source], errors="coerce").fillna(0.0).astype(float)
+    for currency, column in (("MYR", "amounts_myr"), ("USD", "amounts_usd")):
+        frame[column] = df[f"Insurer Amounts ({currency})"]
+        split = _amounts_from_columns(df, currency)
+        if split is not None:
+            frame[column] = frame[column].where(frame[column].astype(str).str.strip() != "", split)
+    frame["payments"] = df["Verified Payments"]
+    return frame
+
+
+def canonical_payments(payments):
+    # verified_insurers keyed by canonical spelling, like the amount dicts
+    registry = get_registry()
+    return {registry.resolve(name): payment for name, payment in payments.items() if isinstance(payment, dict)}
+
+
+def resolve_insurers(frame):
+    frame["insurers"] = _map_unique(frame["insurers"],
+                                    lambda v: canonical_shares({k: float(x) for k, x in pro_insurers_data(v).items()}))
+    frame["amounts_myr"] = _map_unique(frame["amounts_myr"], lambda v: canonical_shares(parse_json_or_default(v)))
+    frame["amounts_usd"] = _map_unique(frame["amounts_usd"], lambda v: canonical_shares(parse_json_or_default(v)))
+    frame["payments"] = [canonical_payments(parse_json_or_default(v)) if v else {} for v in frame["payments"]]
+    return frame
+
+
+def normalize_sheet(sheet_df):
+    return resolve_insurers(parse_sheet(sheet_df))
+
+
+def _parse_workbook_sheet(source, sheet_name):
+    # Worker task: read and parse a single sheet of the workbook.
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    return parse_sheet(pd.read_excel(source, sheet_name=sheet_name, engine="openpyxl", skiprows=1))
+
+
+def import_workers():
+    # Worker processes for parsing sheets in parallel, from $IMPORT_WORKERS
+    # when an import starts (1, the default: parse in this process; 0: one
+    # per CPU). Spawning workers only pays off for workbooks with several
+    # large sheets, so it is opt-in; a value that is not a number means 1.
+    try:
+        return int(os.environ.get("IMPORT_WORKERS", "1"))
+    except ValueError:
+        return 1
+
+
+def parse_workbook(source, workers=None):
+    # Parsed sheets in workbook order. With several workers each sheet is read
+    # and parsed in its own process; results are collected in sheet order, so
+    # the outcome does not depend on which worker finishes first.
+    workers = import_workers() if workers is None else workers
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        sheets = pd.read_excel(source, sheet_name=None, engine="openpyxl", skiprows=1)
+        return [parse_sheet(sheet_df) for sheet_df in sheets.values()]
+
+    from openpyxl import load_workbook
+
+    if not isinstance(source, (str, os.PathLike)):
+        # uploaded file: ship its bytes to the workers
+        source.seek(0)
+        source = source.read()
+    workbook = load_workbook(io.BytesIO(source) if isinstance(source, bytes) else source, read_only=True)
+    sheet_names = workbook.sheetnames
+    workbook.close()
+    if len(sheet_names) <= 1:
+        return [_parse_workbook_sheet(source, name) for name in sheet_names]
+    with ProcessPoolExecutor(min(workers, len(sheet_names)), mp_context=get_context(IMPORT_START_METHOD)) as pool:
+        return list(pool.map(_parse_workbook_sheet, [source] * len(sheet_names), sheet_names))
+
+
+def _plain(value):
+    # Hash-stable form: numbers as floats (100 and 100.0 are the same amount),
+    # missing and blank alike; json.dumps sorts the dict keys.
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, Mapping):
+        return {str(k): _plain(v) for k, v in value.items()}
+    return str(value)
+
+
+def fingerprint(record, fields, owner=None):
+    values = [owner] + [_plain(record.get(field)) for field in fields]
+    return hashlib.blake2b(json.dumps(values, sort_keys=True).encode(), digest_size=12).hexdigest()
+
+
+class Fingerprints:
+    # {case_no: hash} and {invoice_no: hash} of the rows as last imported.
+    def __init__(self, path=FINGERPRINT_FILE):
+        self.path = path
+        self.cases = {}
+        self.invoices = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                saved = json.load(f)
+            self.cases = saved.get("cases", {})
+            self.invoices = saved.get("invoices", {})
+
+    def save(self):
+        tmp_file = self.path + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"cases": self.cases, "invoices": self.invoices}, f)
+        os.replace(tmp_file, self.path)
+
+
+def new_stats():
+    return {
+        "sheets": 0,
+        "rows": 0,
+        "cases_added": 0,
+        "invoices_added": 0,
+        "skipped_rows": 0,
+        "duplicate_cases": set(),
+        "duplicate_invoices": set(),
+        "seconds": 0.0,
+    }
+
+
+def build_index(data):
+    return {case_no: {inv.get("invoice_no") for inv in case.get("invoices", [])}
+            for case_no, case in data.items() if isinstance(case, Mapping)}
+
+
+def invoice_owners(index):
+    # invoice_no -> case_no, so an invoice number is only ever imported once
+    # across the whole book.
+    return {invoice_no: case_no for case_no, invoices in index.items() for invoice_no in invoices}
+
+
+def _frame_rows(frame):
+    # (case_no, invoice_no, case record, invoice record) per sheet row
+    for row in zip(frame["case_no"], frame["invoice_no"], frame["clients"], frame["insured"],
+                   frame["case_title"], frame["date_of_loss"], frame["insurers"], frame["invoice_date"],
+                   frame["office"], frame["status"], frame["total_myr"], frame["total_usd"], frame["fx"],
+                   frame["amounts_myr"], frame["amounts_usd"], frame["payments"]):
+        (case_no, invoice_no, clients, insured, case_title, date_of_loss, insurers, invoice_date,
+         office, status, total_myr, total_usd, fx, amounts_myr, amounts_usd, payments) = row
+        case = {
+            "clients": clients,
+            "insured": insured,
+            "case_title": case_title,
+            "date_of_loss": date_of_loss,
+            "insurers": insurers,
+        }
+        invoice = {
+            "invoice_no": invoice_no,
+            "Date of invoice": invoice_date,
+            "issuing office": office,
+            "Status": status,
+            "Total amount(MYR)": total_myr,
+            "Total amount(USD)": total_usd,
+            "exchange rate": fx,
+            "insurer amounts(MYR)": dict(amounts_myr),
+            "insurer amounts(USD)": dict(amounts_usd)
+        }
+        if payments:
+            invoice["verified_insurers"] = dict(payments)
+        yield case_no, invoice_no, case, invoice
+
+
+def _editable_case(data, case_no, copied):
+    # ``data`` is a copy of the book's top level; a case of the shared book is
+    # copied into it the first time an import changes it.
+    if case_no not in copied:
+        data[case_no] = plain_copy(data[case_no])
+        copied.add(case_no)
+    return data[case_no]
+
+
+def merge_frame(frame, data, index, owners, existing_cases, stats, changes, prints=None, copied=None):
+    # Adds new cases and invoices; ``prints`` (Fingerprints) records what was
+    # imported as the baseline for later syncs. ``copied`` holds the existing
+    # cases already copied out of the shared book (see _editable_case).
+    copied = set() if copied is None else copied
+    stats["rows"] += len(frame)
+    for case_no, invoice_no, case, invoice_data in _frame_rows(frame):
+        if not case_no:
+            stats["skipped_rows"] += 1
+            continue
+
+        if case_no in existing_cases:
+            stats["duplicate_cases"].add(case_no)
+        elif case_no not in index:
+            data[case_no] = dict(case, invoices=[])
+            copied.add(case_no)
+            index[case_no] = set()
+            changes.append(case_upsert(case_no, data[case_no]))
+            stats["cases_added"] += 1
+            if prints is not None:
+                prints.cases[case_no] = fingerprint(case, SYNC_CASE_FIELDS)
+
+        case_data = data.get(case_no)
+        if case_data is not None and not isinstance(case_data.get("invoices", []), list):
+            case_data = _editable_case(data, case_no, copied)
+            case_data["invoices"] = []
+            index[case_no] = set()
+
+        if invoice_no:
+            if invoice_no in owners:
+                stats["duplicate_invoices"].add(invoice_no)
+                continue
+            if case_data is not None:
+                _editable_case(data, case_no, copied).setdefault("invoices", []).append(invoice_data)
+            index[case_no].add(invoice_no)
+            owners[invoice_no] = case_no
+            changes.append(invoice_upsert(case_no, invoice_data))
+            stats["invoices_added"] += 1
+            if prints is not None:
+                prints.invoices[invoice_no] = fingerprint(invoice_data, SYNC_INVOICE_FIELDS, case_no)
+
+
+def import_workbook(source, data, workers=None):
+    # Parses every sheet (in parallel with ``workers`` processes), then merges
+    # them into a copy of ``data`` in sheet order and persists all new cases
+    # and invoices with a single save.
+    started = time.perf_counter()
+    with perf.span("import.parse"):
+        frames = parse_workbook(source, workers)
+    stats = new_stats()
+    index = build_index(data)
+    owners = invoice_owners(index)
+    existing_cases = set(index)
+    prints = Fingerprints()
+    changes = []
+    data = editable_copy(data)
+    copied = set()
+    with perf.span("import.merge"):
+        for frame in frames:
+            stats["sheets"] += 1
+            merge_frame(resolve_insurers(frame), data, index, owners, existing_cases, stats, changes, prints,
+                        copied)
+    perf.count("import.rows", stats["rows"])
+    save_data(data, changes)
+    prints.save()
+    stats["duplicate_cases"] = sorted(stats["duplicate_cases"])
+    stats["duplicate_invoices"] = sorted(stats["duplicate_invoices"])
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def stream_import(source, chunk_size=STREAM_CHUNK_SIZE, progress=None):
+    # Reads the workbook row by row with openpyxl in read-only mode and commits
+    # every chunk of ``chunk_size`` rows as soon as it is normalized, so the
+    # workbook side never holds more than one chunk. ``progress`` is called as
+    # progress(sheet_name, chunk_no, rows_in_sheet, stats) after each chunk.
+    from openpyxl import load_workbook
+
+    started = time.perf_counter()
+    index = get_store().invoice_index()
+    owners = invoice_owners(index)
+    existing_cases = set(index)
+    prints = Fingerprints()
+    stats = new_stats()
+    workbook = load_workbook(source, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            stats["sheets"] += 1
+            rows = sheet.iter_rows(values_only=True)
+            next(rows, None)
+            header = next(rows, None)
+            if header is None:
+                continue
+            columns = [str(c) if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)]
+            width = len(columns)
+            chunk_no = 0
+            sheet_rows = 0
+            while True:
+                chunk = [tuple(row[:width]) + (None,) * (width - len(row)) for row in islice(rows, chunk_size)]
+                if not chunk:
+                    break
+                chunk_no += 1
+                sheet_rows += len(chunk)
+                changes = []
+                with perf.span("import.parse"):
+                    frame = normalize_sheet(pd.DataFrame(chunk, columns=columns))
+                with perf.span("import.merge"):
+                    merge_frame(frame, {}, index, owners, existing_cases, stats, changes, prints)
+                perf.count("import.rows", len(chunk))
+                apply_changes(changes)
+                if progress is not None:
+                    progress(sheet.title, chunk_no, sheet_rows, stats)
+    finally:
+        workbook.close()
+        prints.save()
+    stats["duplicate_cases"] = sorted(stats["duplicate_cases"])
+    stats["duplicate_invoices"] = sorted(stats["duplicate_invoices"])
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def new_sync_stats():
+    stats = {"sheets": 0, "rows": 0, "skipped_rows": 0, "duplicate_invoices": set(), "conflicts": [], "seconds": 0.0}
+    for kind in ("cases", "invoices"):
+        for outcome in ("inserted", "updated", "unchanged", "conflicting"):
+            stats[f"{kind}_{outcome}"] = 0
+    return stats
+
+
+class _SyncState:
+    def __init__(self, data, prints, overwrite):
+        # a copy of the book's top level; changed cases are copied into it
+        self.data = editable_copy(data)
+        self.copied = set()
+        self.prints = prints
+        self.overwrite = overwrite
+        self.seen_cases = set()
+        self.seen_invoices = set()
+        self.recorded = 0
+        self._owners = None
+
+    def editable(self, case_no):
+        return _editable_case(self.data, case_no, self.copied)
+
+    def record(self, prints, key, digest):
+        prints[key] = digest
+        self.recorded += 1
+
+    @property
+    def owners(self):
+        # invoice_no -> case_no of the book, only built once a row has changed
+        if self._owners is None:
+            self._owners = invoice_owners(build_index(self.data))
+        return self._owners
+
+
+def _conflict(stats, kind, case_no, invoice_no, reason):
+    stats[f"{kind}_conflicting"] += 1
+    stats["conflicts"].append({"case_no": case_no, "invoice_no": invoice_no, "reason": reason})
+
+
+def _sync_case(state, case_no, case, stats, changes):
+    digest = fingerprint(case, SYNC_CASE_FIELDS)
+    stored = state.prints.cases.get(case_no)
+    if digest == stored:
+        stats["cases_unchanged"] += 1
+        return
+    current = state.data.get(case_no)
+    if not isinstance(current, Mapping):
+        if stored is not None and not state.overwrite:
+            _conflict(stats, "cases", case_no, None, "deleted in the book since the last import")
+            return
+        state.data[case_no] = dict(case, invoices=[])
+        state.copied.add(case_no)
+        changes.append(case_upsert(case_no, state.data[case_no]))
+        stats["cases_inserted"] += 1
+    else:
+        book = fingerprint(current, SYNC_CASE_FIELDS)
+        if book == digest:
+            stats["cases_unchanged"] += 1
+        elif book == stored or state.overwrite:
+            current = state.editable(case_no)
+            current.update(case)
+            changes.append(case_upsert(case_no, current))
+            stats["cases_updated"] += 1
+        else:
+            _conflict(stats, "cases", case_no, None, "changed in the book since the last import" if stored
+                      else "differs from the book and was not imported before")
+            return
+    state.record(state.prints.cases, case_no, digest)
+
+
+def _sync_invoice(state, case_no, invoice, stats, changes):
+    invoice_no = invoice["invoice_no"]
+    digest = fingerprint(invoice, SYNC_INVOICE_FIELDS, case_no)
+    stored = state.prints.invoices.get(invoice_no)
+    if digest == stored:
+        stats["invoices_unchanged"] += 1
+        return
+    owner = state.owners.get(invoice_no)
+    if owner is None:
+        if stored is not None and not state.overwrite:
+            _conflict(stats, "invoices", case_no, invoice_no, "deleted in the book since the last import")
+            return
+        case = state.data.get(case_no)
+        if not isinstance(case, Mapping):
+            _conflict(stats, "invoices", case_no, invoice_no, "its case is not in the book")
+            return
+        state.editable(case_no).setdefault("invoices", []).append(invoice)
+        state.owners[invoice_no] = case_no
+        changes.append(invoice_upsert(case_no, invoice))
+        stats["invoices_inserted"] += 1
+    else:
+        current = lookup_invoice(state.data, owner, invoice_no)
+        book = fingerprint(current, SYNC_INVOICE_FIELDS, owner)
+        if book == digest:
+            stats["invoices_unchanged"] += 1
+        elif owner != case_no:
+            _conflict(stats, "invoices", case_no, invoice_no, f"belongs to case {owner} in the book")
+            return
+        elif book == stored or state.overwrite:
+            # only the imported fields change; verified payments stay
+            state.editable(owner)
+            current = lookup_invoice(state.data, owner, invoice_no)
+            current.update({field: invoice[field] for field in SYNC_INVOICE_FIELDS})
+            changes.append(invoice_upsert(case_no, current))
+            stats["invoices_updated"] += 1
+        else:
+            _conflict(stats, "invoices", case_no, invoice_no, "changed in the book since the last import" if stored
+                      else "differs from the book and was not imported before")
+            return
+    state.record(state.prints.invoices, invoice_no, digest)
+
+
+def sync_frame(frame, state, stats, changes):
+    stats["rows"] += len(frame)
+    for case_no, invoice_no, case, invoice in _frame_rows(frame):
+        if not case_no:
+            stats["skipped_rows"] += 1
+            continue
+        if case_no not in state.seen_cases:
+            # a case's first row carries its details
+            state.seen_cases.add(case_no)
+            _sync_case(state, case_no, case, stats, changes)
+        if invoice_no:
+            if invoice_no in state.seen_invoices:
+                stats["duplicate_invoices"].add(invoice_no)
+                continue
+            state.seen_invoices.add(invoice_no)
+            _sync_invoice(state, case_no, invoice, stats, changes)
+
+
+def sync_workbook(source, data, workers=None, overwrite=False):
+    # Incremental re-import. A row whose hash matches the one recorded at the
+    # last import is skipped without looking at the book; a changed row is
+    # inserted or applied as an update when the book still holds what was
+    # last imported, and reported as a conflict when the book was edited
+    # since (or the row predates fingerprints and differs), unless
+    # ``overwrite``. Updates keep an invoice's verified payments. Rows that
+    # disappeared from the workbook are left alone.
+    started = time.perf_counter()
+    with perf.span("import.parse"):
+        frames = parse_workbook(source, workers)
+    prints = Fingerprints()
+    state = _SyncState(data, prints, overwrite)
+    stats = new_sync_stats()
+    changes = []
+    with perf.span("import.sync"):
+        for frame in frames:
+            stats["sheets"] += 1
+            sync_frame(resolve_insurers(frame), state, stats, changes)
+    perf.count("import.rows", stats["rows"])
+    perf.count("import.changes", len(changes))
+    if changes:
+        save_data(state.data, changes)
+    if state.recorded:
+        prints.save()
+    stats["duplicate_invoices"] = sorted(stats["duplicate_invoices"])
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
@@ -1,100 +1,128 @@
+import io
+import os
+import tempfile
+import zipfile
+from collections.abc import Mapping
+
 import streamlit as st
 import pandas as pd
-import json
-
-DATA_FILE = "cases_data.json"
-
-def load_data():
-    try:
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return {}
-
-
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4,default=str)
-if "data" not in st.session_state:
-    st.session_state["data"] = load_data()
+from storage import (load_data, save_data, get_store, lookup_invoice, invoice_position, editable_copy,
+                     cache_stats, case_upsert, case_delete, case_rename, invoice_upsert, invoice_delete,
+                     INVOICE_STATUSES, PAID, PARTIALLY_PAID, StoreConflict)
+from matching import get_matcher
+from reconcile import read_statement, plan_reconciliation, apply_reconciliation, summarize
+from importer import import_workbook, stream_import, sync_workbook
+from exporter import DATASETS, EXPORT_FORMATS, export
+from aging import get_aging, invoice_day
+from insurers import get_registry, canonical_shares
+from settlement import record_payment, settle_pending
+from ledger import BANKS, backfill, get_ledger
+from money import split_amount, is_full_share, fx_convert, from_cents, to_cents, to_decimal
+import fx
+import memo
+import perf
+
+PAGE_SIZES = [25, 50, 100, 250]
+CASE_SORT_LABELS = {
+    "Book order": None,
+    "Case No": "case_no",
+    "Clients/Brokers": "clients",
+    "Insured": "insured",
+    "Case Title": "case_title",
+    "Date of Loss": "date_of_loss",
+    "Invoices no": "invoice_count",
+}
+INVOICE_SORT_LABELS = {
+    "Book order": None,
+    "Case No": "case_no",
+    "Invoice No": "invoice_no",
+    "Date of invoice": "Date of invoice",
+    "Status": "Status",
+    "Total amount(MYR)": "Total amount(MYR)",
+    "Total amount(USD)": "Total amount(USD)",
+}
 
 def format_insurer_amounts(amounts_dict):
     return "\n".join([f'"{k}": {v}' for k, v in amounts_dict.items()])
 
 
-def import_excel(uploaded_file):
+def table_controls(key, sort_labels):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        sort_label = st.selectbox("Sort by", list(sort_labels), key=f"{key}_sort")
+    with col2:
+        descending = st.checkbox("Descending", key=f"{key}_descending")
+    with col3:
+        page_size = st.selectbox("Rows per page", PAGE_SIZES, key=f"{key}_page_size")
+    return sort_labels[sort_label], descending, page_size
+
+
+def paged_rows(key, fetch, page_size):
+    # fetch(offset, limit) -> (total, rows); only the current page is built.
+    page_key = f"{key}_page"
+    page = st.session_state.get(page_key, 1)
+    total, rows = fetch((page - 1) * page_size, page_size)
+    pages = max(1, -(-total // page_size))
+    if page > pages:
+        page = pages
+        st.session_state[page_key] = page
+        total, rows = fetch((page - 1) * page_size, page_size)
+    st.number_input("Page", min_value=1, max_value=pages, step=1, key=page_key)
+    st.caption(f"Page {page} of {pages} ({total} rows)")
+    return rows
+
+
+def invoice_table(status, query, sort, descending, offset, limit):
+    # (total, page frame or None); built once per book version and page
+    def build():
+        total, rows = get_store().page_invoices(status, query, sort, descending, offset, limit)
+        return total, invoice_page_frame(rows) if rows else None
+
+    return memo.memoized("invoice_table", (status, query, sort, descending, offset, limit), build)
+
+
+def invoice_page_frame(rows):
+    with perf.span("render.dataframe"):
+        records = []
+        for case_no, inv in rows:
+            record = {"Case No": case_no}
+            record.update(inv)
+            for column in ("insurer amounts(MYR)", "insurer amounts(USD)"):
+                if isinstance(record.get(column), dict):
+                    record[column] = ", ".join(f"{k}: {v}" for k, v in record[column].items())
+            records.append(record)
+        return pd.DataFrame(records)
+
+
+def import_excel(uploaded_file, streaming=False, sync=False):
     if uploaded_file is not None:
-        df = pd.read_excel(uploaded_file, sheet_name=None, engine="openpyxl", skiprows=1)
-        data = load_data()
-        duplicate_cases = set()
-        duplicate_invoices = set()
+        if sync:
+            stats = sync_workbook(uploaded_file, load_data())
+            sync_report(stats)
+            return
+        if streaming:
+            status = st.empty()
+
+            def show_progress(sheet_name, chunk_no, sheet_rows, stats):
+                status.write(f"Sheet {sheet_name}: chunk {chunk_no}, {sheet_rows} rows processed "
+                             f"({stats['invoices_added']} invoices imported so far)")
+
+            stats = stream_import(uploaded_file, progress=show_progress)
+        else:
+            stats = import_workbook(uploaded_file, load_data())
 
-        for sheet_name, sheet_df in df.items():
-            sheet_df = sheet_df.fillna("")
+        dup_case_inv(stats["duplicate_cases"], stats["duplicate_invoices"])
 
-            for _, row in sheet_df.iterrows():
-                case_no = str(row.get("ABL SG Case Ref.", "")).strip()
-                invoice_no = str(row.get("Invoice No", "")).strip()
 
-                if case_no in data:
-                    duplicate_cases.add(case_no)
-                else:
-                    insurers_infor = pro_insurers_field(row)
-                    insurers_dict = pro_insurers_data(insurers_infor)
-                    insurers = {k: float(v) for k, v in insurers_dict.items()}
-
-                    date_of_loss = pro_loss_date(row)
-                    data[case_no] = {
-                        "clients": row.get("Clients/ Brokers", ""),
-                        "insured": row.get("Insured", ""),
-                        "case_title": row.get("Case Title", ""),
-                        "date_of_loss": date_of_loss,
-                        "insurers": insurers,
-                        "invoices": []
-
-                    }
-
-                if not isinstance(data[case_no].get("invoices", []), list):
-                    st.warning(f"Fixing invalid invoices format for case {case_no}")
-                    data[case_no]["invoices"] = []
-
-                if invoice_no:
-                    existing_invoices = {inv["invoice_no"] for inv in data[case_no].get("invoices", [])}
-                    if invoice_no in existing_invoices:
-                        duplicate_invoices.add(invoice_no)
-                    else:
-                        parse_json_or_default = pro_fault_inv()
-
-                        insurer_amounts_myr = parse_json_or_default(row.get("Insurer Amounts (MYR)", "{}"))
-                        insurer_amounts_usd = parse_json_or_default(row.get("Insurer Amounts (USD)", "{}"))
-
-                        invoice_date1 = data_inv(row)
-                        invoice_date = convert_date(invoice_date1)
-
-                        status_value = row.get("Status", "")
-                        invoice_data = {
-                            "invoice_no": invoice_no,
-                            "Date of invoice": invoice_date,
-                            "issuing office": row.get("Issuing Office", ""),
-                            "Status": status_value,
-                            "Total amount(MYR)": float(row.get("Invoice Amount (MYR)", 0.0000) or 0.0000),
-                            "Total amount(USD)": float(row.get("Invoice Amount (USD)", 0.0000) or 0.0000),
-                            "exchange rate": float(row.get("Fx Rate", 0.0000) or 0.0000),
-                            "insurer amounts(MYR)": insurer_amounts_myr,
-                            "insurer amounts(USD)": insurer_amounts_usd
-
-                        }
-                        data[case_no]["invoices"].append(invoice_data)
-        save_data(data)
-
-        dup_case_inv(duplicate_cases, duplicate_invoices)
-
-def convert_date(date_str):
-    try:
-        dt = datetime.strptime(date_str, "%d-%b-%Y")
-        return dt.strftime("%Y/%m/%d")
-    except ValueError:
-        return date_str
+def sync_report(stats):
+    st.success(f"Cases: {stats['cases_inserted']} inserted, {stats['cases_updated']} updated, "
+               f"{stats['cases_unchanged']} unchanged. Invoices: {stats['invoices_inserted']} inserted, "
+               f"{stats['invoices_updated']} updated, {stats['invoices_unchanged']} unchanged.")
+    if stats["conflicts"]:
+        st.warning(f"{len(stats['conflicts'])} rows not applied: they were also changed in the book")
+        st.dataframe(pd.DataFrame(stats["conflicts"]), use_container_width=True)
+    if stats["duplicate_invoices"]:
+        st.warning(f"Invoices listed more than once: {', '.join(stats['duplicate_invoices'])}")
 
 
 def dup_case_inv(duplicate_cases, duplicate_invoices):
@@ -108,70 +136,6 @@ def dup_case_inv(duplicate_cases, duplicate_invoices):
     st.rerun()
 
 
-def pro_loss_date(row):
-    date_of_loss = row.get("Date of loss", "")
-    if isinstance(date_of_loss, pd.Timestamp):
-        date_of_loss = date_of_loss.strftime("%d-%b-%Y")
-    else:
-        date_of_loss = str(date_of_loss) if not pd.isna(date_of_loss) else ""
-    return date_of_loss
-
-from datetime import datetime
-def data_inv(row):
-    invoice_date = row.get("Date of Invoice", "")
-    if isinstance(invoice_date, pd.Timestamp):
-        return invoice_date.strftime("%Y-%m-%d")
-    elif isinstance(invoice_date, str) and invoice_date:
-        for fmt in ("%d-%b-%Y", "%Y-%m-%d"):
-            try:
-                return datetime.strptime(invoice_date, fmt).strftime("%Y-%m-%d")
-            except ValueError:
-                pass
-    return invoice_date
-
-
-def pro_fault_inv():
-    def parse_json_or_default(value, default={}):
-        try:
-            return json.loads(value) if value and value.startswith("{") else default
-        except json.JSONDecodeError:
-            return default
-
-    return parse_json_or_default
-
-
-def pro_insurers_field(row):
-    insurers_value = row.get("Insurers", "")
-    if pd.isna(insurers_value) or insurers_value is None:
-        insurers = ""
-    else:
-        insurers = str(insurers_value).strip()
-
-    return insurers
-
-
-def pro_insurers_data(insurers):
-    insurers_str = str(insurers).strip()
-    if insurers_str.startswith("{") and insurers_str.endswith("}"):
-        try:
-            insurers_dict = json.loads(insurers_str.replace("'", "\""))
-            return insurers_dict
-        except json.JSONDecodeError:
-            return {}
-    else:
-        insurers_list = [name.strip() for name in insurers_str.split(",") if name.strip()]
-        if not insurers_list:
-            return {}
-        num_insurers = len(insurers_list)
-        if num_insurers == 1:
-            return {insurers_list[0]: 100.0}
-        else:
-            weight = round(100.0 / num_insurers, 2)
-            insurers_dict = {name: weight for name in insurers_list}
-            insurers_dict[insurers_list[-1]] = 100.0 - weight * (num_insurers - 1)
-
-        return insurers_dict
-
 def main_page():
     st.header("Case Management Dashboard")
     if st.button("Add New Case"):
@@ -181,25 +145,44 @@ def main_page():
 
     if st.button("Check invoices"):
         st.session_state.page = "invoice_list"
-        all_invoices = []
-        for case_data in st.session_state["data"].values():
-            all_invoices.extend(case_data.get("invoices", []))
-        st.session_state.temp_case["invoices"] = all_invoices
         st.rerun()
 
     if st.button("payment update"):
         st.session_state.page ="match_payment"
-        total_invoices = []
-        for case_data in st.session_state["data"].values():
-            total_invoices.extend(case_data.get("invoices", []))
-        st.session_state.temp_case["invoices"] = total_invoices
+        st.session_state.temp_case["invoice_count"] = len(memo.invoice_list())
         st.rerun()
 
     uploaded_file = st.file_uploader("Import from Excel", type=["xlsx"])
+    streaming = st.checkbox("Streaming import (large workbooks)", key="streaming_import")
+    sync = st.checkbox("Sync changes to existing cases and invoices", key="sync_import")
     if uploaded_file and st.button("Import Data"):
-        import_excel(uploaded_file)
+        import_excel(uploaded_file, streaming, sync)
+    export_section()
     view_all_cases()
 
+
+def export_section():
+    with st.expander("Export"):
+        fmt = st.selectbox("Format", EXPORT_FORMATS, key="export_format")
+        datasets = st.multiselect("Datasets", DATASETS, default=list(DATASETS), key="export_datasets")
+        if datasets and st.button("Prepare export"):
+            with tempfile.TemporaryDirectory() as tmp:
+                result = export(os.path.join(tmp, f"case_book.{fmt}"), datasets, fmt)
+                if len(result["files"]) == 1:
+                    file_name = os.path.basename(result["files"][0])
+                    with open(result["files"][0], "rb") as f:
+                        payload = f.read()
+                else:
+                    # one CSV/Parquet file per dataset: download them as a zip
+                    file_name = "case_book.zip"
+                    buffer = io.BytesIO()
+                    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+                        for path in result["files"]:
+                            archive.write(path, os.path.basename(path))
+                    payload = buffer.getvalue()
+            st.caption(", ".join(f"{name}: {rows} rows" for name, rows in result["rows"].items()))
+            st.download_button(f"Download {file_name}", payload, file_name=file_name)
+
 def check_invoices_page():
     if "page" not in st.session_state:
         st.session_state.page = "main"
@@ -210,74 +193,78 @@ def check_invoices_page():
         st.rerun()
 
     if st.session_state.page == "invoice_list":
-        invoices = st.session_state.temp_case.get("invoices", [])
-        if invoices:
-            df = pd.DataFrame(invoices)
-
-            # if "verified_insurers" in df.columns:
-            #     print("Verified===",df["verified_insurers"].iloc[5])
-            #     print("type",type(df["verified_insurers"].iloc[5]))
-
-            df["insurer amounts(MYR)"] = df["insurer amounts(MYR)"].apply(lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
-            df["insurer amounts(USD)"] = df["insurer amounts(USD)"].apply(lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
-
-            if "Status" in df.columns and "Date of invoice" in df.columns:
-                filter_option = st.radio("Filter invoices by status:", ["All", "Paid", "Outstanding"])
-                filter_invoices(df, filter_option)
-            else:
-                st.dataframe(df)
+        filter_option = st.radio("Filter invoices by status:", ["All", PAID, PARTIALLY_PAID, "Outstanding"])
+        filter_invoices(filter_option)
     else:
         st.write("No invoices found.")
 
 
 
 
-def filter_invoices(df, filter_option):
-    if filter_option == "All":
-        st.dataframe(df)
-
-    elif filter_option == "Paid":
-        paid_df = df[df["Status"] == "Paid"]
-        if not paid_df.empty:
-            st.dataframe(paid_df)
+def filter_invoices(filter_option):
+    if filter_option in ("All", PAID, PARTIALLY_PAID):
+        status = None if filter_option == "All" else filter_option
+        invoice_search = st.text_input("Search by Invoice No", key="invoice_search").strip()
+        sort, descending, page_size = table_controls("invoices", INVOICE_SORT_LABELS)
+        frame = paged_rows("invoices", lambda offset, limit: invoice_table(
+            status, invoice_search, sort, descending, offset, limit), page_size)
+        if frame is not None:
+            st.dataframe(frame)
+        elif status:
+            st.write(f"No {status.lower()} invoices found.")
         else:
-            st.write("No paid invoices found.")
+            st.write("No invoices found.")
 
     elif filter_option == "Outstanding":
-        cases = st.session_state.get("data", {})
         insurer_search = st.text_input("Search by Insurer (A, B, etc.)").strip()
-        if not insurer_search:
-            st.write("Please enter an insurer name to search.")
-        else:
-            choose_invoices = []
-            for case_no,case_data in cases.items():
-                if "insurers" in case_data and insurer_search in case_data["insurers"] :
-                    insurers_keys = [str(key).upper() for key in case_data["insurers"].keys()]
-                    if insurer_search.upper() in insurers_keys:
-                        for invoice in case_data.get("invoices", []):
-                            choose_invoices.append(invoice)
-            if choose_invoices:
-                df = pd.DataFrame(choose_invoices)
-                st.write("Filtered invoices based on insurer search:")
-        outstanding_df = df[df["Status"] == "Outstanding"].copy()
-        outstanding_df["Date of invoice"] = pd.to_datetime(outstanding_df["Date of invoice"], errors="coerce")
-        today = datetime.today()
-        outstanding_df["Days Overdue"] = (today - outstanding_df["Date of invoice"]).dt.days
-
-        categories = {
-            "≤ 6 months": outstanding_df[outstanding_df["Days Overdue"] <= 180],
-            "6 - 12 months": outstanding_df[
-                (outstanding_df["Days Overdue"] > 180) & (outstanding_df["Days Overdue"] <= 365)],
-            "12 - 18 months": outstanding_df[
-                (outstanding_df["Days Overdue"] > 365) & (outstanding_df["Days Overdue"] <= 540)],
-            "> 18 months": outstanding_df[outstanding_df["Days Overdue"] > 540]
-        }
-        for label, category_df in categories.items():
-            with st.expander(f"{label} ({len(category_df)})"):
-                if not category_df.empty:
-                    st.dataframe(category_df)
-                else:
+        aging = get_aging()
+        today = date.today()
+        insurer = None
+        if insurer_search:
+            registry = get_registry()
+            found = registry.search(insurer_search)
+            if not found:
+                st.write("No insurer matches this search.")
+                return
+            if len(found) == 1:
+                insurer = found[0]
+            else:
+                insurer = st.selectbox("Matching insurers", found, format_func=registry.display_name,
+                                       key="aging_insurer")
+            st.write(f"Filtered invoices for insurer {registry.display_name(insurer)}:")
+        currencies = fx.get_rates().currencies()
+        reporting = st.selectbox("Show amounts in", ["Invoice currencies"] + currencies, key="aging_currency")
+        if reporting in currencies and fx.rate(fx.SOURCE_CURRENCY, today, reporting) is None:
+            st.warning(f"No {fx.SOURCE_CURRENCY}/{reporting} rate on file for {today}.")
+            reporting = "Invoice currencies"
+        buckets, summary = memo.outstanding(insurer, today, None if reporting == "Invoice currencies" else reporting)
+        for label, count, totals in buckets:
+            amounts = ", ".join(f"{currency} {amount:,.2f}" for currency, amount in totals.items() if amount)
+            with st.expander(f"{label} ({count})" + (f" - {amounts}" if amounts else "")):
+                if not count:
                     st.write("No invoices in this category.")
+                elif st.toggle("Show invoices", key=f"aging_{label}"):
+                    st.dataframe(memo.memoized("aging_bucket", (label, insurer, today),
+                                               lambda: bucket_frame(aging, label, insurer, today)))
+
+        if summary:
+            st.subheader("Outstanding by insurer")
+            st.dataframe(pd.DataFrame(summary), hide_index=True)
+
+
+def bucket_frame(aging, label, insurer, today):
+    data = load_data()
+    rows = []
+    for case_no, invoice_no in aging.bucket_invoices(label, insurer, today):
+        inv = lookup_invoice(data, case_no, invoice_no)
+        if inv is not None:
+            rows.append(dict(inv, **{"Days Overdue": today.toordinal() - invoice_day(
+                inv.get("Date of invoice"))}))
+    bucket_df = pd.DataFrame(rows)
+    for column in ("insurer amounts(MYR)", "insurer amounts(USD)"):
+        if column in bucket_df.columns:
+            bucket_df[column] = bucket_df[column].apply(format_insurer_amounts)
+    return bucket_df
 
 
 def match_invoices_page():
@@ -286,32 +273,24 @@ def match_invoices_page():
         st.session_state.page = "main"
         st.rerun()
     st.header("Payment update")
+    reconcile_statement_section()
+    cash_received_section()
 
     currency_choice = st.radio("Select Payment Currency", ["MYR", "USD"], key="currency_choice")
     insurer_keyword = st.text_input(" Insurer Name ", key="pay_insurer_keyword")
     insurer_amount_input = st.number_input("Received Amount", min_value=0.0, step=0.01, key="pay_insurer_amount")
-    data = st.session_state.get("data", {})
+    data = load_data()
 
     matching_invoices = []
     close_match_invoices = []
-    amount_field = "insurer amounts(MYR)" if currency_choice == "MYR" else "insurer amounts(USD)"
-
-
-    for case_no, case_data in data.items():
-        invoices = case_data.get("invoices", [])
-        for inv in invoices:
-            if inv.get("Status", "Outstanding") != "Outstanding":
-                continue
-            insurer_amounts = inv.get(amount_field, {})
-            for insurer,amount in insurer_amounts.items():
-                if insurer_keyword.strip().lower() in insurer.lower():
-                    if abs( amount- insurer_amount_input) < 0.01:
-                        if "verified_insurers" in inv and insurer in inv["verified_insurers"]:
-                            continue
-                        matching_invoices.append((case_no, inv, insurer, amount))
-                        break
-                    elif currency_choice == "USD" and amount > insurer_amount_input and (amount - insurer_amount_input) <= 50:
-                        close_match_invoices.append((case_no, inv, insurer, amount))
+
+    with perf.span("match.query"):
+        exact, close = get_matcher().match(currency_choice, insurer_keyword, insurer_amount_input)
+    for matches, found in ((exact, matching_invoices), (close, close_match_invoices)):
+        for case_no, invoice_no, insurer, amount in matches:
+            inv = lookup_invoice(data, case_no, invoice_no)
+            if inv is not None:
+                found.append((case_no, inv, insurer, amount))
 
     if not matching_invoices and not close_match_invoices:
         st.info("No matching invoices found for the given insurer keyword and payment amount.")
@@ -326,7 +305,7 @@ def match_invoices_page():
             st.write(f"**Matched Insurer:** {insurers}")
             st.write(f"**Expected Amount ({currency_choice}):** {expected_amount:.2f}")
 
-            user_bank = st.selectbox("Payment to ", ["SXP", "ABL KL", "ABL LDN"], key=f"user_bank_{idx}")
+            user_bank = st.selectbox("Payment to ", BANKS, key=f"user_bank_{idx}")
 
             if st.button(f"Verify Payment for Invoice {invoice.get('invoice_no')}", key=f"verify_{idx}"):
                 # verified_insurers = data.get(case_no, {}).get("invoices", [])
@@ -335,9 +314,7 @@ def match_invoices_page():
                 #         invoice["verified_insurers"] = json.loads(invoice["verified_insurers"])
                 #     except json.JSONDecodeError:
                 #         pass
-                if "verified_insurers" not in invoice:
-                    invoice["verified_insurers"] = {}
-                invoice["verified_insurers"][insurers] = {
+                payment = {
                     "Received Amount": expected_amount,
                     "Payment to": user_bank,
                     "currency": currency_choice,
@@ -348,8 +325,12 @@ def match_invoices_page():
                 # df["verified_insurers"] = df["verified_insurers"].apply(lambda x: format_data(x))
                 # for i, inv in enumerate(verified_insurers):
                 #     data[case_no]["invoices"][i]["verified_insurers"] = df.loc[i, "verified_insurers"]
+                data = editable_copy(data, case_no)
+                invoice = lookup_invoice(data, case_no, invoice.get("invoice_no"))
+                changes = record_payment(case_no, invoice, insurers, payment)
                 st.success(f"Insurer {insurers} marked as verified.")
-                save_data(data)
+                save_data(data, changes)
+                show_status_change(changes)
 
 
 
@@ -370,7 +351,7 @@ def match_invoices_page():
             st.write(f"**Invoice No:** {selected_inv.get('invoice_no', 'N/A')}")
             st.write(f"**Payable Amount:** {selected_amount:.2f} USD")
             new_payment = st.number_input("Enter Received Amount", min_value=0.0, step=0.01, key="new_payment_amount")
-            user_bank = st.selectbox("Payment to", ["SXP", "ABL KL", "ABL LDN"], key="new_payment_bank")
+            user_bank = st.selectbox("Payment to", BANKS, key="new_payment_bank")
 
 
             if st.button("Verify Payment for Selected Invoice"):
@@ -381,48 +362,120 @@ def match_invoices_page():
                 #     except json.JSONDecodeError:
                 #         selected_inv["verified_insurers"] = {}
 
-                if "verified_insurers" not in selected_inv:
-                    selected_inv["verified_insurers"] = {}
-                selected_inv["verified_insurers"][selected_insurer] = {
+                payment = {
                     "Received Amount": new_payment,
                     "Payment to": user_bank,
                     "currency": "USD",
-                    "verified": "True"
+                    "verified": True
                 }
                 # df = pd.DataFrame(verified_insurers)
                 # print("Before update:", selected_inv["verified_insurers"])
                 # df["verified_insurers"] = df["verified_insurers"].apply(lambda x: format_data(x))
                 # for i, inv in enumerate(verified_insurers):
                 #     data[case_no]["invoices"][i]["verified_insurers"] = df.loc[i, "verified_insurers"]
+                data = editable_copy(data, case_no)
+                selected_inv = lookup_invoice(data, case_no, selected_inv.get("invoice_no"))
+                changes = record_payment(case_no, selected_inv, selected_insurer, payment)
                 st.success(f"Insurer {selected_insurer} marked as verified.")
-                save_data(data)
+                save_data(data, changes)
+                show_status_change(changes)
+
 
 
 
+        # invoices verified before statuses were tracked
+        data, status_changes = settle_pending(data)
+        save_data(data, status_changes)
+        show_status_change(status_changes)
 
-        for case_no, case_data in data.items():
-            for inv in case_data.get("invoices", []):
-                if inv.get("Status", "Outstanding") != "Outstanding":
-                    continue
-                insurers_myr = set(inv.get("insurer amounts(MYR)", {}).keys())
-                insurers_usd = set(inv.get("insurer amounts(USD)", {}).keys())
-                all_insurers = insurers_myr | insurers_usd
-                verified_insurers = set(inv.get("verified_insurers", {}))
 
-                if all_insurers and all_insurers == verified_insurers:
-                    inv["Status"] = "Paid"
-                    st.success("All insurer amounts verified. Invoice status updated to PAID.")
+def show_status_change(changes):
+    for record in changes:
+        if record["op"] == "status_change":
+            status = record["status"]
+            if status == PAID:
+                st.success("All insurer amounts verified. Invoice status updated to PAID.")
+            elif status == PARTIALLY_PAID:
+                st.warning(f"Invoice {record['invoice_no']} is partially paid.")
 
 
-        save_data(data)
+def reconcile_statement_section():
+    with st.expander("Reconcile bank statement"):
+        statement_file = st.file_uploader("Statement (insurer, amount, currency, bank, date)",
+                                          type=["csv", "xlsx"], key="statement_file")
+        resolve_ambiguous = st.checkbox("Apply ambiguous lines to the oldest invoice", value=True,
+                                        key="resolve_ambiguous")
+        if not statement_file:
+            return
+        data = load_data()
+        try:
+            lines = read_statement(statement_file, statement_file.name)
+        except ValueError as e:
+            st.error(str(e))
+            return
+        report = plan_reconciliation(data, lines, resolve_ambiguous)
+        counts = summarize(report)
+        st.write(f"Matched: {counts['matched']}, Ambiguous: {counts['ambiguous']}, "
+                 f"Unmatched: {counts['unmatched']}")
+        st.dataframe(pd.DataFrame(report))
+
+        if st.button("Apply reconciliation", key="apply_reconciliation"):
+            paid = apply_reconciliation(data, report)
+            applied = sum(1 for result in report if result["case_no"])
+            st.success(f"Verified {applied} payments, {paid} invoices marked as PAID.")
+
+
+def cash_received_section():
+    with st.expander("Cash received"):
+        payments = get_ledger()
+        by = st.radio("Group by", ["bank", "insurer"], horizontal=True, key="cash_group")
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            bank = st.selectbox("Bank", ["All"] + list(BANKS), key="cash_bank")
+        with col2:
+            currency = st.selectbox("Currency", ["All", "MYR", "USD"], key="cash_currency")
+        with col3:
+            insurer = st.text_input("Insurer", key="cash_insurer").strip()
+        period = st.date_input("Received between", value=(), key="cash_period")
+        filters = {
+            "bank": None if bank == "All" else bank,
+            "currency": None if currency == "All" else currency,
+            "insurer": insurer or None,
+        }
+        if len(period) == 2:
+            filters["start"], filters["end"] = period
+        report = payments.cash_report(by, **filters)
+        if report:
+            st.dataframe(pd.DataFrame(report), hide_index=True)
+        else:
+            st.write("No receipts recorded for this selection.")
+
+        invoice_no = st.text_input("Receipts and balance of invoice", key="cash_invoice").strip()
+        if invoice_no:
+            located = get_store().locate_invoice(invoice_no)
+            inv = lookup_invoice(load_data(), located[0], invoice_no) if located else None
+            if inv is None:
+                st.write(f"Invoice {invoice_no} not found.")
+            else:
+                st.dataframe(pd.DataFrame([
+                    {"Receipt": receipt["receipt_id"], "Date": receipt["date"], "Bank": receipt["bank"],
+                     "Currency": receipt["currency"], "Insurer": allocation["insurer"],
+                     "Amount": allocation["amount"]}
+                    for receipt, allocation in payments.invoice_receipts(invoice_no)]), hide_index=True)
+                st.dataframe(pd.DataFrame([
+                    {"Currency": currency, "Insurer": name, "Outstanding": from_cents(cents)}
+                    for (currency, name), cents in payments.balances(inv).items()]), hide_index=True)
+
+        if st.button("Add verified payments missing from the ledger", key="cash_backfill"):
+            st.success(f"Recorded {backfill(load_data())} receipts.")
 
 
 def format_data(x):
-    if isinstance(x, dict):
+    if isinstance(x, Mapping):
         result = ""
         for k, v in x.items():
             value = ""
-            if isinstance(v, dict):
+            if isinstance(v, Mapping):
                 for x, y in v.items():
                     value += f"    {x}: {y}\n"
             result += f"{k}:\n{value}"
@@ -431,12 +484,11 @@ def format_data(x):
 
 
 def view_all_cases():
-    data = load_data()
-
     search_query = st.text_input("Search by Case No", "").strip().lower()
 
+    sort, descending, page_size = table_controls("cases", CASE_SORT_LABELS)
     case_list = []
-    display_cases(case_list, data, search_query)
+    display_cases(case_list, search_query, sort, descending, page_size)
     manage_case(case_list)
 
 def manage_case(case_list):
@@ -461,10 +513,10 @@ def manage_case(case_list):
 
         with col3:
             if st.button("Delete Case", key=f"delete_{selected_case}"):
-                data = load_data()
+                data = editable_copy(load_data())
                 if selected_case in data:
                     del data[selected_case]
-                    save_data(data)
+                    save_data(data, [case_delete(selected_case)])
                     st.success(f"Deleted case {selected_case}")
                     st.rerun()
 
@@ -473,24 +525,9 @@ def manage_case(case_list):
         st.warning("No cases found")
 
 
-def display_cases(case_list, data, search_query):
-    for case_no, details in data.items():
-        if not isinstance(details, dict):
-            st.warning(f"Invalid data format for case {case_no}: Expected dict, got {type(details)}")
-            continue
-        if not isinstance(details.get("invoices", []), list):
-            st.warning(f"Invalid invoices format for case {case_no}: Expected list, got {type(details['invoices'])}")
-            details["invoices"] = []
-        if search_query and search_query not in case_no.lower():
-            continue
-        case_list.append({
-            "Case No": case_no,
-            "Clients/Brokers": details.get("clients", "N/A"),
-            "Insured": details.get("insured", "N/A"),
-            "Case Title": details.get("case_title", "N/A"),
-            "Date of Loss": details.get("date_of_loss", "N/A"),
-            "Invoices no": len(details.get("invoices", []))
-        })
+def display_cases(case_list, search_query, sort=None, descending=False, page_size=PAGE_SIZES[0]):
+    case_list.extend(paged_rows("cases", lambda offset, limit: memo.case_page(
+        search_query, sort, descending, offset, limit), page_size))
 
 
 def new_case_page():
@@ -508,20 +545,23 @@ def save_case_detail(case_no, case_title, clients, data, date_of_loss, insured,
     if not case_no:
         st.error("Case No is required")
         return
+    if case_no in data:
+        st.error("Case No already exists")
+        return
     if isinstance(total_share, dict):
-        total_share = sum(total_share.values())
-    total_share = float(total_share)
-    if abs(total_share - 100.0) > 1e-4:
+        total_share = sum(to_decimal(share) for share in total_share.values())
+    if not is_full_share(total_share):
         st.error("Total insurers share must equal 100%")
         return
 
+    data = editable_copy(data, case_no)
     data[case_no]={
             "case_no": case_no,
             "clients": clients,
             "insured": insured,
             "case_title": case_title,
             "date_of_loss": str(date_of_loss),
-            "insurers": new_insurers
+            "insurers": canonical_shares(new_insurers)
         }
 
     save_case(data,case_no)
@@ -557,7 +597,7 @@ def get_insurers_infor():
                                     value=list(insurers.values())[i] if i < len(insurers) else 0.0,
                                     key=f"ins_share_{i}")
         new_insurers[name] = share
-        total_share += share
+        total_share += to_decimal(share)
     return  case_no, case_title, clients, data, date_of_loss,insured, new_insurers, total_share
 
 
@@ -596,14 +636,13 @@ def save_case(data,case_no):
     }
 
 
-    save_data(data)
+    save_data(data, [case_upsert(case_no, data[case_no])])
 
 def new_invoice_page():
     global invoice_date
     st.header("Invoice Creation")
-    data = load_data()
     case_no = st.session_state.case_no
-    st.session_state.data = data
+    data = editable_copy(load_data(), case_no)
     if st.button("← Return to Main"):
         st.session_state.page = "main"
         st.rerun()
@@ -615,26 +654,27 @@ def new_invoice_page():
         display_in(case_no, data)
         edit_invoice(case_no, data)
 
-    save_invoice(case_no,data)
-    calculate_ex()
+    invoice_data = save_invoice(case_no,data)
+    calculate_ex(invoice_data["Date of invoice"] if invoice_data else None)
 
     if st.button("Save Invoice"):
-        save_data(data)
+        save_data(data, [invoice_upsert(case_no, invoice_data)] if invoice_data else [])
         st.success("Invoice saved!")
         st.rerun()
 
 
 def display_in(case_no, data):
-    df_invoices = pd.DataFrame(data.get(case_no, {}).get("invoices", []))
-    df_invoices["insurer amounts(MYR)"] = df_invoices["insurer amounts(MYR)"].apply(
-        lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
-    df_invoices["insurer amounts(USD)"] = df_invoices["insurer amounts(USD)"].apply(
-        lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
+    with perf.span("render.dataframe"):
+        df_invoices = pd.DataFrame(data.get(case_no, {}).get("invoices", []))
+        df_invoices["insurer amounts(MYR)"] = df_invoices["insurer amounts(MYR)"].apply(
+            lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
+        df_invoices["insurer amounts(USD)"] = df_invoices["insurer amounts(USD)"].apply(
+            lambda x: ", ".join(f"{k}: {v}" for k, v in x.items()))
     st.dataframe(df_invoices)
 
 from datetime import datetime,date
 def save_invoice(case_no,data):
-    invoices = st.session_state.data[case_no]["invoices"]
+    invoices = data[case_no]["invoices"]
     input_inv_no= st.text_input("Invoice No*",value=st.session_state.get("invoice_new_inv_no", ""))
     if not input_inv_no:
         st.error("Invoice No is required")
@@ -661,14 +701,17 @@ def save_invoice(case_no,data):
         st.session_state["sel_Status"] = "Outstanding"
     if "new_office" not in st.session_state:
         st.session_state["new_office"] = "ABL KL"
-    st.session_state["sel_Status"] = st.selectbox("Status", ["Outstanding", "Paid"],
-                                                  index=["Outstanding", "Paid"].index(st.session_state["sel_Status"]), key="status_select")
+    st.session_state["sel_Status"] = st.selectbox("Status", INVOICE_STATUSES,
+                                                  index=INVOICE_STATUSES.index(st.session_state["sel_Status"]), key="status_select")
     st.session_state["new_office"] = st.selectbox("Issuing Office", ["ABL KL", "SXP", "ABL SG"],
                                                   index=["ABL KL", "SXP", "ABL SG"].index(
                                                       st.session_state["new_office"]), key="office_select")
 
-    existing_invoice = next((inv for inv in invoices if inv["invoice_no"] == input_inv_no), None)
-    invoice_no = input_inv_no if input_inv_no else existing_invoice
+    located = get_store().locate_invoice(input_inv_no)
+    if located is not None and located[0] != case_no:
+        st.error(f"Invoice No {input_inv_no} already exists in case {located[0]}")
+        return
+    position = invoice_position(data, case_no, input_inv_no)
 
     invoice_data = {
         "invoice_no": input_inv_no,
@@ -681,24 +724,18 @@ def save_invoice(case_no,data):
         "insurer amounts(MYR)": {},
         "insurer amounts(USD)": {}
     }
-    if existing_invoice:
-        index = invoices.index(existing_invoice)
-        invoices[index] = invoice_data
+    if position is not None:
+        invoices[position] = invoice_data
     else:
-        st.session_state.data[case_no]["invoices"].append(invoice_data)
-    insurers = data[case_no].get("insurers", {})
-    for name, share in insurers.items():
-        cal_amount(case_no, invoice_no, name, share)
+        invoices.append(invoice_data)
+    cal_amount(invoice_data, data[case_no].get("insurers", {}))
+    return invoice_data
 
 
-def cal_amount(case_no,invoice_no, name, share):
-    invoices = st.session_state.data[case_no]["invoices"]
-    invoice_data = next((inv for inv in invoices if inv["invoice_no"] == invoice_no), None)
-    if invoice_data:
-        invoice_data["insurer amounts(MYR)"][name] = round(st.session_state.invoice_amount_myr * share / 100, 2)
-        invoice_data["insurer amounts(USD)"][name] = round(st.session_state.invoice_amount_usd * share / 100, 2)
-        index = invoices.index(invoice_data)
-        st.session_state.data[case_no]["invoices"][index] = invoice_data
+def cal_amount(invoice_data, insurers):
+    # split in whole cents so the insurer amounts add up to the invoice total
+    invoice_data["insurer amounts(MYR)"] = split_amount(st.session_state.invoice_amount_myr, insurers)
+    invoice_data["insurer amounts(USD)"] = split_amount(st.session_state.invoice_amount_usd, insurers)
 
 
 
@@ -707,12 +744,10 @@ def cal_amount(case_no,invoice_no, name, share):
 def edit_invoice(case_no, data):
     selected_invoice_no = selected_saved_invoices_details(data, case_no)
     if selected_invoice_no:
-        selected_invoice = next((inv for inv in data[case_no]["invoices"] if
-                                 inv["invoice_no"] == selected_invoice_no), None)
+        selected_invoice = lookup_invoice(data, case_no, selected_invoice_no)
         if selected_invoice:
             if st.button("Delete Invoice"):
                 delete_invoice(case_no, data, selected_invoice_no)
-                save_data(data)
                 return
 
 
@@ -725,7 +760,7 @@ def selected_saved_invoices_details(data, case_no):
     invoices = data[case_no]["invoices"]
     invoice_numbers = [inv["invoice_no"] for inv in invoices] if invoices else []
     input_invoice_no = st.selectbox("Select Invoice", invoice_numbers) if invoice_numbers else ""
-    selected_invoice = next((inv for inv in invoices if inv["invoice_no"] == input_invoice_no), None)
+    selected_invoice = lookup_invoice(data, case_no, input_invoice_no)
 
     insurer_myr = selected_invoice.get("insurer amounts(MYR)", {})
     insurer_usd = selected_invoice.get("insurer amounts(USD)", {})
@@ -754,13 +789,14 @@ def selected_saved_invoices_details(data, case_no):
     return input_invoice_no
 
 
-def calculate_ex():
+def calculate_ex(invoice_date=None):
     if "invoice_amount_myr" not in st.session_state:
         st.session_state.invoice_amount_myr = 0.00
     if "invoice_amount_usd" not in st.session_state:
         st.session_state.invoice_amount_usd = 0.00
+    table_rate = fx.invoice_rate(invoice_date)
     if "invoice_ex_rate" not in st.session_state:
-        st.session_state.invoice_ex_rate = 1.0000
+        st.session_state.invoice_ex_rate = table_rate or 1.0000
     temp_amount_myr = st.number_input("Amount (MYR)*", min_value=0.0, step=0.01,
                                       value=st.session_state.invoice_amount_myr, key="temp_amount_myr")
     temp_amount_usd = st.number_input("Amount (USD)*", min_value=0.0, step=0.01,
@@ -779,23 +815,23 @@ def calculate_ex():
         st.rerun()
     st.write(
         f" Converted: {st.session_state.invoice_amount_myr:.2f} MYR / {st.session_state.invoice_amount_usd:.2f} USD")
+    if table_rate and table_rate != st.session_state.invoice_ex_rate:
+        st.caption(f"Rate table: {table_rate:.4f} MYR per USD on {invoice_date}")
 
 
 
 
 
 def delete(data, invoice_no, case_no):
+    data = editable_copy(data, case_no)
     if case_no in data and "invoices" in data[case_no]:
-        invoices_before = data[case_no]["invoices"]
-        data[case_no]["invoices"] = [
-            inv for inv in invoices_before if inv["invoice_no"] != invoice_no
-        ]
-        invoices_after = data[case_no]["invoices"]
+        position = invoice_position(data, case_no, invoice_no)
 
-        if len(invoices_before) == len(invoices_after):
+        if position is None:
             st.error(f"Invoice {invoice_no} not found! Deletion failed.")
         else:
-            save_data(data)
+            del data[case_no]["invoices"][position]
+            save_data(data, [invoice_delete(case_no, invoice_no)])
             st.success(f"Invoice {invoice_no} deleted!")
             st.rerun()
     else:
@@ -804,12 +840,12 @@ def delete(data, invoice_no, case_no):
 def calculate_exchange(amount_myr, amount_usd, exchange_rate):
     if exchange_rate > 0:
         if amount_myr > 0 and amount_usd == 0:
-            amount_usd = round(amount_myr / exchange_rate, 4)
+            amount_usd = fx_convert(amount_myr, exchange_rate, divide=True)
         elif amount_usd > 0 and amount_myr == 0:
-            amount_myr = round(amount_usd * exchange_rate, 4)
+            amount_myr = fx_convert(amount_usd, exchange_rate)
         elif amount_myr > 0 and amount_usd > 0:
-            expected_usd = round(amount_myr / exchange_rate, 4)
-            if abs(expected_usd - amount_usd) > 0.01:
+            expected_usd = fx_convert(amount_myr, exchange_rate, divide=True)
+            if abs(to_cents(expected_usd) - to_cents(amount_usd)) > 1:
                 st.warning(f"Amount mismatch! Expected USD: {expected_usd}, but entered: {amount_usd}. Please verify.")
     return amount_myr, amount_usd
 
@@ -851,28 +887,33 @@ def edit_case_page():
                                     value=list(insurers.values())[i] if i < len(insurers) else 0.0,
                                     key=f"new_case_ins_share_{i}")
         new_insurers[name] = share
-        total_share += share
+        total_share += to_decimal(share)
 
 
     if st.button("Save Changes"):
-        if abs(total_share - 100.0) > 1e-4:
+        if not is_full_share(total_share):
             st.error("Total share must equal 100%")
         else:
 
+            data = editable_copy(data, case_no)
+            invoices = data.get(case_no, {}).get("invoices", [])
+            changes = []
             if new_case_no != case_no:
                 if new_case_no in data:  
                     st.error("New Case No already exists")
                     return
                 del data[case_no]
+                changes.append(case_rename(case_no, new_case_no))
             data[new_case_no] = {
                 "clients": clients,
                 "insured": insured,
                 "case_title": case_title,
                 "date_of_loss": str(date_of_loss),
-                "insurers": new_insurers,
-                "invoices": case_data.get("invoices", [])
+                "insurers": canonical_shares(new_insurers),
+                "invoices": invoices
             }
-            save_data(data)
+            changes.append(case_upsert(new_case_no, data[new_case_no]))
+            save_data(data, changes)
             st.success("Case updated successfully!")
             st.session_state.page = "main"
             st.rerun()
@@ -913,10 +954,48 @@ def main():
         "match_payment": match_invoices_page
     }
 
+    # drawn before the page so the toggle survives pages that call st.rerun()
+    show_panel = st.sidebar.checkbox("Performance panel", key="perf_panel")
+    perf.begin_run(perf.ENABLED or show_panel)
+    stats = cache_stats()
+    st.sidebar.caption(f"Dataset cache: {stats['hits']} hits / {stats['misses']} misses")
+    views = memo.memo_stats()
+    st.sidebar.caption(f"View cache: {views['hits']} hits / {views['misses']} misses, "
+                       f"{views['entries']}/{views['capacity']} entries")
+
     if st.session_state.page in pages:
-        pages[st.session_state.page]()
+        with perf.span(f"render.{st.session_state.page}"):
+            try:
+                pages[st.session_state.page]()
+            except StoreConflict as e:
+                # saved from a page opened before someone else changed the case
+                st.error(str(e))
     else:
         st.error("Invalid page state")
+    if show_panel:
+        performance_panel()
+
+
+def performance_panel():
+    metrics = perf.snapshot()
+    st.sidebar.caption(f"This rerun: {metrics['wall_seconds'] * 1000:.1f} ms")
+    if metrics["spans"]:
+        st.sidebar.dataframe(pd.DataFrame([
+            {"Span": name, "Calls": span["calls"], "ms": round(span["seconds"] * 1000, 2)}
+            for name, span in metrics["spans"].items()]), hide_index=True)
+    if metrics["counters"]:
+        st.sidebar.dataframe(pd.DataFrame(list(metrics["counters"].items()), columns=["Counter", "Value"]),
+                             hide_index=True)
+    views = memo.memo_stats()["views"]
+    if views:
+        st.sidebar.dataframe(pd.DataFrame([
+            {"View": view, "Hits": stats["hits"], "Misses": stats["misses"], "Evicted": stats["evictions"],
+             "Hit rate": stats["hit_rate"]} for view, stats in views.items()]), hide_index=True)
+    if st.sidebar.checkbox("Log every rerun", key="perf_log"):
+        perf.log_run(st.session_state.page)
+    if st.sidebar.button("Write Prometheus file"):
+        perf.write_prometheus()
+        st.sidebar.success(f"Wrote {perf.PROMETHEUS_FILE}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,186 @@
+import json
+import os
+import re
+from bisect import bisect_left
+
+import storage
+from book_index import MIN_GRAM_QUERY, trigrams
+
+# Optional {"alias": "Canonical Name"} overrides for spellings the suffix rules
+# cannot tie together (e.g. abbreviations).
+INSURERS_FILE = "insurers.json"
+# Corporate-form words dropped when deriving an insurer's canonical ID, so
+# "AXA", "Axa Insurance" and "AXA Ins." are one insurer.
+LEGAL_SUFFIXES = {
+    "the", "insurance", "ins", "insurer", "insurers", "assurance", "co", "company", "corp",
+    "corporation", "ltd", "limited", "plc", "inc", "bhd", "berhad", "sdn", "pte", "ag", "sa",
+}
+FUZZY_THRESHOLD = 0.6
+
+_registry = None
+
+
+def _words(name):
+    return re.sub(r"[^\w]+", " ", str(name).lower()).split()
+
+
+def canonical_key(name):
+    words = _words(name)
+    core = [word for word in words if word not in LEGAL_SUFFIXES]
+    return " ".join(core or words)
+
+
+def _load_aliases(path=INSURERS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return {canonical_key(alias): name for alias, name in json.load(file).items()}
+
+
+_aliases = _load_aliases()
+
+
+def insurer_id(name):
+    # Canonical ID of an insurer spelling; stable across processes.
+    key = canonical_key(name)
+    if key in _aliases:
+        return canonical_key(_aliases[key])
+    return key
+
+
+def _grams(text):
+    # padded, so a spelling's first letters and word ends get trigrams too
+    return trigrams(f"  {text} ")
+
+
+class InsurerRegistry:
+    # Canonical insurer IDs with every spelling seen for them, a trigram index
+    # over those spellings for substring and typo-tolerant lookups and a
+    # sorted word list for short prefix queries.
+    def __init__(self):
+        self.names = {}
+        self.spellings = {}
+        self.grams = {}
+        self.words = []
+        self.revision = 0
+        for alias, name in _aliases.items():
+            self.names.setdefault(insurer_id(name), name)
+            self._index(alias, insurer_id(name))
+
+    @classmethod
+    def from_store(cls, store):
+        registry = cls()
+        for _, details, _ in store.search_cases(""):
+            for name in details.get("insurers", {}) or {}:
+                registry.resolve(name)
+        for _, inv in store.iter_invoices():
+            registry.add_invoice(inv)
+        return registry
+
+    def _index(self, spelling, insurer):
+        if spelling in self.spellings:
+            return
+        self.spellings[spelling] = insurer
+        self.revision += 1
+        for gram in _grams(spelling):
+            self.grams.setdefault(gram, set()).add(spelling)
+        for word in spelling.split():
+            i = bisect_left(self.words, (word, spelling))
+            if i == len(self.words) or self.words[i] != (word, spelling):
+                self.words.insert(i, (word, spelling))
+
+    def resolve(self, name):
+        # Canonical spelling for ``name``; the first spelling seen for a new
+        # insurer becomes its canonical one.
+        name = " ".join(str(name).split())
+        insurer = insurer_id(name)
+        if not insurer:
+            return name
+        self.names.setdefault(insurer, name)
+        self._index(" ".join(_words(name)), insurer)
+        self._index(insurer, insurer)
+        return self.names[insurer]
+
+    def display_name(self, insurer):
+        return self.names.get(insurer, insurer)
+
+    def add_invoice(self, inv):
+        for field in ("insurer amounts(MYR)", "insurer amounts(USD)"):
+            for name in inv.get(field, {}) or {}:
+                self.resolve(name)
+
+    def search(self, query, fuzzy=True):
+        # Insurer IDs whose spellings contain ``query`` (word prefixes for
+        # queries shorter than MIN_GRAM_QUERY); when nothing contains it, the
+        # closest spellings by trigram similarity, best first.
+        text = " ".join(_words(query))
+        if not text:
+            return sorted(self.names)
+        if len(text) < MIN_GRAM_QUERY:
+            i = bisect_left(self.words, (text,))
+            found = set()
+            while i < len(self.words) and self.words[i][0].startswith(text):
+                found.add(self.spellings[self.words[i][1]])
+                i += 1
+            return sorted(found)
+
+        grams = _grams(text)
+        inner = {gram for gram in grams if not gram.startswith(" ") and not gram.endswith(" ")} or grams
+        candidates = None
+        for gram in inner:
+            spellings = self.grams.get(gram, set())
+            candidates = set(spellings) if candidates is None else candidates & spellings
+            if not candidates:
+                break
+        found = {self.spellings[s] for s in candidates or () if text in s}
+        if found or not fuzzy:
+            return sorted(found)
+
+        scores = {}
+        for gram in grams:
+            for spelling in self.grams.get(gram, ()):
+                scores[spelling] = scores.get(spelling, 0) + 1
+        ranked = {}
+        for spelling, shared in scores.items():
+            # share of the query's trigrams found, then overall similarity
+            score = (shared / len(grams), shared / len(grams | _grams(spelling)))
+            if score[0] >= FUZZY_THRESHOLD:
+                insurer = self.spellings[spelling]
+                ranked[insurer] = max(ranked.get(insurer, score), score)
+        return sorted(ranked, key=lambda insurer: (-ranked[insurer][0], -ranked[insurer][1], insurer))
+
+
+def canonical_shares(shares):
+    # Re-keys an {insurer: value} dict by canonical spelling, summing values of
+    # aliases that name the same insurer.
+    registry = get_registry()
+    result = {}
+    for name, value in shares.items():
+        name = registry.resolve(name)
+        result[name] = result[name] + value if name in result else value
+    return result
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = InsurerRegistry.from_store(storage.get_store())
+    return _registry
+
+
+def _on_change(changes):
+    global _registry
+    if _registry is None:
+        return
+    if changes is None:
+        _registry = None
+        return
+    for record in changes:
+        if record.get("op") == "case_upsert":
+            for name in record["case"].get("insurers", {}) or {}:
+                _registry.resolve(name)
+        elif record.get("op") == "invoice_upsert":
+            _registry.add_invoice(record["invoice"])
+
+
+storage.add_listener(_on_change)
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Mapping
+from datetime import date, datetime
+
+import storage
+from insurers import insurer_id
+from matching import CURRENCIES
+from money import from_cents, to_cents
+
+# Cash received, one record per receipt, appended to LEDGER_FILE as JSON lines
+# and never rewritten. A receipt holds who paid (insurer), into which account
+# (bank), its currency, amount and day, and its allocations: the invoice
+# shares it settles, {"case_no", "invoice_no", "insurer", "amount"} each.
+# Receipts are indexed by insurer, bank, currency and day, allocations by
+# invoice number (which case renames keep), so cash reports and invoice
+# balances are lookups rather than scans of the book. An invoice's
+# "verified_insurers" entry for a share carries the sum of its allocations
+# (settlement.record_receipts), so partial receipts add up. Each receipt has an
+# idempotency key (receipt_key) and append leaves out keys already recorded,
+# so a receipt written again after the book save that should follow it
+# failed is only counted once.
+LEDGER_FILE = "cases_data.ledger.jsonl"
+LEDGER_LOCK_FILE = "cases_data.ledger.lock"
+BANKS = ("SXP", "ABL KL", "ABL LDN")
+REPORT_GROUPS = {"bank": "Bank", "insurer": "Insurer"}
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%d-%b-%Y", "%d/%m/%Y")
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def receipt_day(value):
+    # Day ordinal of a receipt date, or None when it cannot be read.
+    if isinstance(value, datetime):
+        return value.date().toordinal()
+    if isinstance(value, date):
+        return value.toordinal()
+    text = str(value or "").strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).toordinal()
+        except ValueError:
+            pass
+    return None
+
+
+def _file_id(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+class PaymentLedger:
+    def __init__(self, path=LEDGER_FILE, lock_file=LEDGER_LOCK_FILE):
+        self.path = path
+        self.lock_file = lock_file
+        self._lock = threading.RLock()
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self.receipts = []
+        # key -> receipt positions, in ledger order
+        self.by_insurer = {}
+        self.by_bank = {}
+        self.by_currency = {}
+        self.by_day = {}
+        self.days = []
+        # invoice_no -> [(position, allocation)]; (invoice_no, currency, insurer) -> cents
+        self.by_invoice = {}
+        self.allocated = {}
+        self.keys = set()
+        self._offset = 0
+        self._file = None
+
+    def refresh(self):
+        # Folds in the receipts appended since the last read, by this or any
+        # other process; a replaced file is read again from the start.
+        with self._lock:
+            file = _file_id(self.path)
+            if file != self._file:
+                self._reset()
+                self._file = file
+            if file is None:
+                return
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                chunk = f.read()
+            # only complete lines; a partial last line is still being written
+            end = chunk.rfind(b"\n") + 1
+            for line in chunk[:end].splitlines():
+                if line.strip():
+                    try:
+                        self._index(json.loads(line))
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+            self._offset += end
+
+    def _index(self, receipt):
+        position = len(self.receipts)
+        insurers = {insurer_id(receipt["insurer"])}
+        for allocation in receipt.get("allocations", []):
+            insurers.add(insurer_id(allocation["insurer"]))
+            self.by_invoice.setdefault(allocation["invoice_no"], []).append((position, allocation))
+            key = (allocation["invoice_no"], receipt["currency"], allocation["insurer"])
+            self.allocated[key] = self.allocated.get(key, 0) + to_cents(allocation["amount"])
+        self.receipts.append(receipt)
+        if receipt.get("key"):
+            self.keys.add(receipt["key"])
+        for insurer in insurers:
+            self.by_insurer.setdefault(insurer, []).append(position)
+        self.by_bank.setdefault(receipt["bank"], []).append(position)
+        self.by_currency.setdefault(receipt["currency"], []).append(position)
+        day = receipt_day(receipt.get("date"))
+        if day not in self.by_day:
+            self.by_day[day] = []
+            if day is not None:
+                insort(self.days, day)
+        self.by_day[day].append(position)
+
+    def append(self, receipts):
+        # Writes new receipts (dicts without "receipt_id") and returns the ones
+        # written, numbered; ids follow the ledger order across processes.
+        # Receipts whose key the ledger already holds are left out.
+        if not receipts:
+            return []
+        with self._lock, storage.file_lock(self.lock_file):
+            self.refresh()
+            keys = set(self.keys)
+            fresh = []
+            for receipt in receipts:
+                key = receipt.get("key")
+                if key is None or key not in keys:
+                    keys.add(key)
+                    fresh.append(receipt)
+            receipts = fresh
+            if not receipts:
+                return []
+            lines = []
+            for number, receipt in enumerate(receipts, start=len(self.receipts) + 1):
+                receipt["receipt_id"] = number
+                lines.append(json.dumps(receipt, separators=(",", ":")) + "\n")
+            with open(self.path, "ab") as f:
+                f.write("".join(lines).encode())
+                f.flush()
+                os.fsync(f.fileno())
+            self.refresh()
+        return receipts
+
+    def receipts_for(self, insurer=None, bank=None, currency=None, start=None, end=None):
+        # Receipts matching every given filter, in ledger order; ``start`` and
+        # ``end`` are inclusive dates and leave out undated receipts.
+        selections = []
+        if insurer is not None:
+            selections.append(self.by_insurer.get(insurer_id(insurer), []))
+        if bank is not None:
+            selections.append(self.by_bank.get(bank, []))
+        if currency is not None:
+            selections.append(self.by_currency.get(currency, []))
+        if start is not None or end is not None:
+            low = bisect_left(self.days, receipt_day(start)) if start is not None else 0
+            high = bisect_right(self.days, receipt_day(end)) if end is not None else len(self.days)
+            selections.append([position for day in self.days[low:high] for position in self.by_day[day]])
+        if not selections:
+            return list(self.receipts)
+        selections.sort(key=len)
+        positions = set(selections[0])
+        for other in selections[1:]:
+            positions.intersection_update(other)
+        return [self.receipts[position] for position in sorted(positions)]
+
+    def invoice_receipts(self, invoice_no):
+        # [(receipt, allocation)] of the receipts settling ``invoice_no``.
+        return [(self.receipts[position], allocation) for position, allocation in self.by_invoice.get(invoice_no, [])]
+
+    def paid_cents(self, invoice_no, currency, insurer):
+        return self.allocated.get((invoice_no, currency, insurer), 0)
+
+    def share_balance(self, invoice_no, currency, insurer, cents, verified):
+        # Cents still to receive on one insurer share of ``cents``, negative
+        # when overpaid, or None when it is not owed in ``currency``. A share
+        # the book has not verified is owed in full in every currency; a
+        # verified one only in the currencies the ledger received it in, and
+        # not at all when it was verified before the ledger (see backfill).
+        if not verified:
+            return cents
+        paid = self.paid_cents(invoice_no, currency, insurer)
+        return cents - paid if paid else None
+
+    def balances(self, inv):
+        # {(currency, insurer): share_balance} of an invoice's owed shares.
+        invoice_no = inv.get("invoice_no")
+        verified = inv.get("verified_insurers", {}) or {}
+        balances = {}
+        for currency in CURRENCIES:
+            for insurer, amount in (inv.get(f"insurer amounts({currency})", {}) or {}).items():
+                balance = self.share_balance(invoice_no, currency, insurer, to_cents(amount), insurer in verified)
+                if balance is not None:
+                    balances[(currency, insurer)] = balance
+        return balances
+
+    def cash_report(self, by="bank", **filters):
+        # Receipts and amounts per bank or payer insurer and currency.
+        if by not in REPORT_GROUPS:
+            raise ValueError(f"Cannot group receipts by {by!r}")
+        totals = {}
+        for receipt in self.receipts_for(**filters):
+            key = (receipt[by], receipt["currency"])
+            count, cents = totals.get(key, (0, 0))
+            totals[key] = (count + 1, cents + to_cents(receipt["amount"]))
+        return [{REPORT_GROUPS[by]: name, "Currency": currency, "Receipts": count, "Amount": from_cents(cents)}
+                for (name, currency), (count, cents) in sorted(totals.items())]
+
+
+def receipt_key(receipt, recorded):
+    # Idempotency key of a receipt: what it pays, and ``recorded``, the cents
+    # the book had recorded for each allocated share before it. Writing the
+    # same payment again while the book is unchanged gives the same key; the
+    # next payment of a share does not, as the book has moved on.
+    parts = [receipt["currency"], to_cents(receipt["amount"])]
+    for allocation, cents in zip(receipt["allocations"], recorded):
+        parts.append([allocation["invoice_no"], allocation["insurer"], to_cents(allocation["amount"]), cents])
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def new_receipt(insurer, bank, currency, amount, allocations, day=None, source="manual"):
+    # ``allocations``: (case_no, invoice_no, insurer, amount) per settled share.
+    # Receipts without a day are dated today; one that cannot be read is kept
+    # as given and left out of date ranges.
+    parsed = receipt_day(day) if day else date.today().toordinal()
+    return {
+        "receipt_id": None,
+        "key": None,
+        "recorded": datetime.now().isoformat(timespec="seconds"),
+        "date": date.fromordinal(parsed).isoformat() if parsed else str(day),
+        "insurer": insurer,
+        "bank": bank,
+        "currency": currency,
+        "amount": from_cents(to_cents(amount)),
+        "source": source,
+        "allocations": [{"case_no": case_no, "invoice_no": invoice_no, "insurer": share_insurer,
+                         "amount": from_cents(to_cents(share_amount))}
+                        for case_no, invoice_no, share_insurer, share_amount in allocations],
+    }
+
+
+def book_receipt(case_no, inv, insurer, payment):
+    # Receipt for a share verified outside the ledger (before it existed, or
+    # by an import), from the payment stored on the invoice.
+    amount = payment.get("Received Amount") or 0
+    receipt = new_receipt(insurer, payment.get("Payment to") or "", payment.get("currency") or "", amount,
+                          [(case_no, inv.get("invoice_no"), insurer, amount)], payment.get("Payment date"), "book")
+    receipt["key"] = receipt_key(receipt, [0])
+    return receipt
+
+
+def missing_receipts(ledger, data):
+    # book_receipt for every verified share without allocations in the ledger.
+    receipts = []
+    for case_no, case in data.items():
+        for inv in case.get("invoices", []):
+            for insurer, payment in (inv.get("verified_insurers", {}) or {}).items():
+                currency = payment.get("currency") if isinstance(payment, Mapping) else None
+                if currency and not ledger.paid_cents(inv.get("invoice_no"), currency, insurer):
+                    receipts.append(book_receipt(case_no, inv, insurer, payment))
+    return receipts
+
+
+def backfill(data):
+    # Records the verified shares the ledger does not know yet; returns how
+    # many receipts were added. What is still owed on those shares now comes
+    # from the ledger, so the indexes and memoized views are told as if the
+    # payments had just been verified.
+    ledger = get_ledger()
+    added = ledger.append(missing_receipts(ledger, data))
+    changes = []
+    for receipt in added:
+        for allocation in receipt["allocations"]:
+            case_no, invoice_no, insurer = allocation["case_no"], allocation["invoice_no"], allocation["insurer"]
+            payment = storage.lookup_invoice(data, case_no, invoice_no)["verified_insurers"][insurer]
+            changes.append(storage.payment_verified(case_no, invoice_no, insurer, payment))
+    if changes:
+        storage.changed(changes)
+    return len(added)
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = PaymentLedger()
+    _ledger.refresh()
+    return _ledger
@@ -0,0 +1,203 @@
+from bisect import bisect_left, bisect_right, insort
+
+import perf
+import storage
+from insurers import get_registry, insurer_id
+from money import from_cents, to_cents
+
+CURRENCIES = ("MYR", "USD")
+USD_CLOSE_MATCH_WINDOW = 50
+
+_matcher = None
+
+
+def normalize_insurer(name):
+    return insurer_id(name)
+
+
+class PaymentMatcher:
+    # Insurer shares of open invoices still owed money, keyed by (currency,
+    # insurer ID), each holding a list of entries sorted by amount in cents.
+    # A share is entered at its ledger balance (PaymentLedger.share_balance),
+    # so one paid short stays matchable for the rest. ``shares`` keeps every
+    # share's full cents per open invoice to work that balance out again.
+    def __init__(self):
+        self.index = {}
+        self.names = {currency: set() for currency in CURRENCIES}
+        self.entries = {}
+        self.shares = {}
+        self.case_invoices = {}
+        self.seq = 0
+        self._name_lookups = {}
+        self._registry_revision = None
+
+    @classmethod
+    def from_store(cls, store):
+        from ledger import get_ledger
+
+        matcher = cls()
+        payments = get_ledger()
+        with perf.span("match.build"):
+            for currency in CURRENCIES:
+                for case_no, invoice_no, insurer, amount, verified in store.outstanding_shares(currency):
+                    matcher._add_owed(payments, case_no, invoice_no, currency, insurer, to_cents(amount), verified)
+        return matcher
+
+    def _add_owed(self, payments, case_no, invoice_no, currency, insurer, cents, verified):
+        self.shares.setdefault((case_no, invoice_no), {})[(currency, insurer)] = cents
+        self.case_invoices.setdefault(case_no, set()).add(invoice_no)
+        balance = payments.share_balance(invoice_no, currency, insurer, cents, True) if verified else cents
+        if balance is not None and balance > 0:
+            self._add_share(case_no, invoice_no, currency, insurer, from_cents(balance))
+
+    def _add_share(self, case_no, invoice_no, currency, insurer, amount):
+        name = normalize_insurer(insurer)
+        key = (currency, name)
+        if key not in self.index:
+            self.index[key] = []
+            self.names[currency].add(name)
+            self._name_lookups.clear()
+        self.seq += 1
+        entry = (to_cents(amount), self.seq, case_no, invoice_no, insurer, amount)
+        insort(self.index[key], entry)
+        self.entries.setdefault((case_no, invoice_no), []).append((key, entry))
+        self.case_invoices.setdefault(case_no, set()).add(invoice_no)
+
+    def add_invoice(self, case_no, inv):
+        from ledger import get_ledger
+
+        if not storage.is_open(inv):
+            return
+        verified = inv.get("verified_insurers", {}) or {}
+        payments = get_ledger() if verified else None
+        for currency in CURRENCIES:
+            for insurer, amount in inv.get(f"insurer amounts({currency})", {}).items():
+                self._add_owed(payments, case_no, inv.get("invoice_no"), currency, insurer, to_cents(amount),
+                               insurer in verified)
+
+    def remove_invoice(self, case_no, invoice_no):
+        for key, entry in self.entries.pop((case_no, invoice_no), []):
+            self._remove_entry(key, entry)
+        self.shares.pop((case_no, invoice_no), None)
+        invoices = self.case_invoices.get(case_no)
+        if invoices is not None:
+            invoices.discard(invoice_no)
+            if not invoices:
+                del self.case_invoices[case_no]
+
+    def refresh_invoice(self, case_no, inv):
+        self.remove_invoice(case_no, inv.get("invoice_no"))
+        self.add_invoice(case_no, inv)
+
+    def set_status(self, case_no, invoice_no, status):
+        if not storage.is_open_status(status):
+            self.remove_invoice(case_no, invoice_no)
+
+    def verify(self, case_no, invoice_no, insurer):
+        # The share leaves the index, or stays at what the ledger says is
+        # still owed on it after a short payment.
+        from ledger import get_ledger
+
+        remaining = []
+        for key, entry in self.entries.get((case_no, invoice_no), []):
+            if entry[4] == insurer:
+                self._remove_entry(key, entry)
+            else:
+                remaining.append((key, entry))
+        if (case_no, invoice_no) in self.entries:
+            self.entries[(case_no, invoice_no)] = remaining
+        shares = self.shares.get((case_no, invoice_no), {})
+        payments = get_ledger()
+        for currency in CURRENCIES:
+            cents = shares.get((currency, insurer))
+            if cents is not None:
+                balance = payments.share_balance(invoice_no, currency, insurer, cents, True)
+                if balance is not None and balance > 0:
+                    self._add_share(case_no, invoice_no, currency, insurer, from_cents(balance))
+
+    def remove_case(self, case_no):
+        for invoice_no in list(self.case_invoices.get(case_no, ())):
+            self.remove_invoice(case_no, invoice_no)
+
+    def rename_case(self, case_no, new_case_no):
+        for invoice_no in list(self.case_invoices.get(case_no, ())):
+            owed = [(key, entry) for key, entry in self.entries.get((case_no, invoice_no), [])]
+            shares = self.shares.get((case_no, invoice_no), {})
+            self.remove_invoice(case_no, invoice_no)
+            self.shares[(new_case_no, invoice_no)] = shares
+            self.case_invoices.setdefault(new_case_no, set()).add(invoice_no)
+            for (currency, _), entry in owed:
+                self._add_share(new_case_no, invoice_no, currency, entry[4], entry[5])
+
+    def _remove_entry(self, key, entry):
+        entries = self.index.get(key)
+        if not entries:
+            return
+        i = bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+        if not entries:
+            del self.index[key]
+            self.names[key[0]].discard(key[1])
+            self._name_lookups.clear()
+
+    def _matching_names(self, currency, keyword):
+        registry = get_registry()
+        if registry.revision != self._registry_revision:
+            self._name_lookups.clear()
+            self._registry_revision = registry.revision
+        lookup = (currency, keyword)
+        if lookup not in self._name_lookups:
+            self._name_lookups[lookup] = [name for name in registry.search(keyword) if name in self.names.get(currency, ())]
+        return self._name_lookups[lookup]
+
+    def match(self, currency, insurer_keyword, amount, one_per_invoice=True):
+        # Returns (exact, close) lists of (case_no, invoice_no, insurer, amount)
+        # in book order. Close matches are USD shares at most
+        # USD_CLOSE_MATCH_WINDOW above the received amount.
+        cents = to_cents(amount)
+        window = USD_CLOSE_MATCH_WINDOW * 100 if currency == "USD" else 0
+        exact = []
+        close = []
+        for name in self._matching_names(currency, insurer_keyword):
+            entries = self.index[(currency, name)]
+            lo = bisect_left(entries, (cents,))
+            hi = bisect_right(entries, (cents + window, float("inf")))
+            perf.count("match.entries_scanned", hi - lo)
+            for entry in entries[lo:hi]:
+                if entry[0] == cents:
+                    exact.append(entry)
+                else:
+                    close.append(entry)
+
+        exact.sort(key=lambda entry: entry[1])
+        matched = set()
+        exact_matches = []
+        for entry in exact:
+            if (entry[2], entry[3]) not in matched or not one_per_invoice:
+                matched.add((entry[2], entry[3]))
+                exact_matches.append(entry[2:])
+        close.sort(key=lambda entry: entry[1])
+        close_matches = [entry[2:] for entry in close if (entry[2], entry[3]) not in matched]
+        return exact_matches, close_matches
+
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        _matcher = PaymentMatcher.from_store(storage.get_store())
+    return _matcher
+
+
+def _on_change(changes):
+    global _matcher
+    if _matcher is None:
+        return
+    if changes is None:
+        _matcher = None
+        return
+    for record in changes:
+        storage.dispatch_change(_matcher, record)
+
+
+storage.add_listener(_on_change)
@@ -0,0 +1,113 @@
+import os
+import threading
+from collections import OrderedDict
+
+import perf
+import storage
+
+# Derived views of the book (page tables, summaries, aging) built once per
+# book version and reused by every session and rerun until the book changes.
+# Entries are keyed by (view, storage.data_version(), params) and shared, so
+# callers must not change what they get back. Past MEMO_SIZE entries the
+# least recently used one is evicted; entries of an older book version are
+# dropped as soon as a newer one is asked for.
+MEMO_SIZE = int(os.environ.get("CASES_MEMO_SIZE", "128"))
+
+_entries = OrderedDict()
+_stats = {}
+_lock = threading.RLock()
+_version = None
+
+
+def _view_stats(view):
+    return _stats.setdefault(view, {"hits": 0, "misses": 0, "evictions": 0})
+
+
+def _drop_stale(version):
+    # Caller holds _lock.
+    global _version
+    if version == _version:
+        return
+    for key in list(_entries):
+        if key[1] != version:
+            del _entries[key]
+            _view_stats(key[0])["evictions"] += 1
+    _version = version
+
+
+def memoized(view, params, build):
+    # build() the first time ``view`` is asked for with ``params`` on this
+    # version of the book; the stored result after that.
+    storage.load_data()  # catches up with other processes before reading the version
+    version = storage.data_version()
+    key = (view, version, params)
+    with _lock:
+        _drop_stale(version)
+        if key in _entries:
+            _entries.move_to_end(key)
+            _view_stats(view)["hits"] += 1
+            perf.count("memo.hits")
+            return _entries[key]
+        _view_stats(view)["misses"] += 1
+    perf.count("memo.misses")
+    with perf.span(f"memo.build.{view}"):
+        value = build()
+    with _lock:
+        if version == _version:
+            _entries[key] = value
+            while len(_entries) > MEMO_SIZE:
+                evicted, _ = _entries.popitem(last=False)
+                _view_stats(evicted[0])["evictions"] += 1
+    return value
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def memo_stats():
+    # {"entries", "capacity", "hits", "misses", "hit_rate", "views": {view: {...}}}
+    with _lock:
+        views = {view: dict(stats, hit_rate=_rate(stats)) for view, stats in sorted(_stats.items())}
+        hits = sum(stats["hits"] for stats in _stats.values())
+        misses = sum(stats["misses"] for stats in _stats.values())
+        return {"entries": len(_entries), "capacity": MEMO_SIZE, "hits": hits, "misses": misses,
+                "hit_rate": _rate({"hits": hits, "misses": misses}), "views": views}
+
+
+def _rate(stats):
+    asked = stats["hits"] + stats["misses"]
+    return round(stats["hits"] / asked, 3) if asked else None
+
+
+def invoice_list(status=None):
+    # Every (case_no, invoice) of the book, optionally of one status.
+    return memoized("invoice_list", (status,), lambda: list(storage.get_store().iter_invoices(status)))
+
+
+def case_page(query="", sort=None, descending=False, offset=0, limit=None):
+    # (total, rows) of the case summary table, one row per case on the page.
+    def build():
+        total, rows = storage.get_store().page_cases(query, sort, descending, offset, limit)
+        return total, [{
+            "Case No": case_no,
+            "Clients/Brokers": details.get("clients", "N/A"),
+            "Insured": details.get("insured", "N/A"),
+            "Case Title": details.get("case_title", "N/A"),
+            "Date of Loss": details.get("date_of_loss", "N/A"),
+            "Invoices no": invoice_count,
+        } for case_no, details, invoice_count in rows]
+
+    return memoized("case_page", (query, sort, descending, offset, limit), build)
+
+
+def outstanding(insurer=None, reference_date=None, reporting=None):
+    # aging_report: the outstanding invoices by age bucket and the totals per
+    # insurer. Revalued reports also depend on the FX table in use.
+    import fx
+    from aging import aging_report
+
+    rates = fx.get_rates() if reporting else None
+    return memoized("outstanding", (insurer, reference_date, reporting, rates),
+                    lambda: aging_report(insurer, reference_date, reporting))
@@ -0,0 +1,66 @@
+from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
+
+# Amounts are kept as integer cents while they are computed; the book still
+# stores them as 2-place floats derived from those cents.
+CENT = Decimal("0.01")
+# FX conversions round half-up to FX_PLACES, as the invoice form shows them.
+FX_PLACES = 4
+FX_ROUNDING = ROUND_HALF_UP
+SHARE_PLACES = Decimal("0.0001")
+
+
+def to_decimal(amount):
+    return Decimal(str(amount or 0))
+
+
+def to_cents(amount):
+    return int((to_decimal(amount) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    return float(Decimal(cents) * CENT)
+
+
+def allocate(total, weights):
+    # Largest-remainder split of the integer ``total`` in proportion to
+    # ``weights``; the parts always add up to ``total``. Equal remainders go
+    # to the earlier weight.
+    weights = [to_decimal(weight) for weight in weights]
+    weight_sum = sum(weights)
+    if not weights or weight_sum <= 0:
+        return [0] * len(weights)
+    exact = [Decimal(total) * weight / weight_sum for weight in weights]
+    parts = [int(value.to_integral_value(ROUND_FLOOR)) for value in exact]
+    short = total - sum(parts)
+    order = sorted(range(len(weights)), key=lambda i: (-(exact[i] - parts[i]), i))
+    for i in order[:short]:
+        parts[i] += 1
+    return parts
+
+
+def split_amount(amount, shares):
+    # {insurer: amount} for {insurer: share%}; the split adds up to the
+    # shares' part of ``amount`` to the cent (all of it when they total 100).
+    total_share = sum(to_decimal(share) for share in shares.values())
+    total = int((to_cents(amount) * total_share / 100).to_integral_value(ROUND_HALF_UP))
+    parts = allocate(total, shares.values())
+    return {name: from_cents(cents) for name, cents in zip(shares, parts)}
+
+
+def equal_shares(count):
+    # Percentages for ``count`` equal insurers that add up to exactly 100.
+    return [from_cents(part) for part in allocate(100 * 100, [1] * count)]
+
+
+def is_full_share(total_share):
+    return to_decimal(total_share).quantize(SHARE_PLACES, ROUND_HALF_UP) == 100
+
+
+def fx_round(value):
+    return float(to_decimal(value).quantize(Decimal(1).scaleb(-FX_PLACES), FX_ROUNDING))
+
+
+def fx_convert(amount, rate, divide=False):
+    # amount * rate (or amount / rate) rounded by the FX policy.
+    rate = to_decimal(rate)
+    return fx_round(to_decimal(amount) / rate if divide else to_decimal(amount) * rate)
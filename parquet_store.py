@@ -0,0 +1,448 @@
+import json
+import os
+import sys
+from collections.abc import Mapping
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import perf
+from records import json_default
+from storage import (DATA_FILE, JOURNAL_FILE, LOCK_FILE, OPEN_STATUSES, PARQUET_FILE, JsonStore, StoreError,
+                     apply_change, is_open)
+
+# Money and rates are stored as decimals; a value the typed column cannot hold
+# exactly (an int, text, extra precision, None) also goes to the row's "extra"
+# JSON, which wins when the book is rebuilt, so the round trip is lossless
+# while column readers still get a usable typed value.
+AMOUNT = pa.decimal128(24, 6)
+AMOUNT_EXP = Decimal("0.000001")
+AMOUNT_LIMIT = Decimal(10) ** 18
+CASE_DATE_FORMAT = "%d-%b-%Y"
+INVOICE_DATE_FORMAT = "%Y-%m-%d"
+
+SCHEMAS = {
+    "cases": pa.schema([
+        ("case_no", pa.string()), ("clients", pa.string()), ("insured", pa.string()),
+        ("case_title", pa.string()), ("date_of_loss", pa.date32()), ("extra", pa.string()),
+    ]),
+    "case_insurers": pa.schema([
+        ("case_no", pa.string()), ("insurer", pa.string()), ("share", AMOUNT), ("extra", pa.string()),
+    ]),
+    "invoices": pa.schema([
+        ("invoice_id", pa.int64()), ("case_no", pa.string()), ("invoice_no", pa.string()),
+        ("date_of_invoice", pa.date32()), ("issuing_office", pa.string()), ("status", pa.string()),
+        ("total_myr", AMOUNT), ("total_usd", AMOUNT), ("exchange_rate", AMOUNT), ("extra", pa.string()),
+    ]),
+    "invoice_amounts": pa.schema([
+        ("invoice_id", pa.int64()), ("currency", pa.string()), ("insurer", pa.string()),
+        ("amount", AMOUNT), ("extra", pa.string()),
+    ]),
+    "verified_payments": pa.schema([
+        ("invoice_id", pa.int64()), ("insurer", pa.string()), ("received_amount", AMOUNT),
+        ("payment_to", pa.string()), ("currency", pa.string()), ("verified", pa.bool_()),
+        ("extra", pa.string()),
+    ]),
+}
+
+# JSON key -> (column, kind)
+CASE_FIELDS = {
+    "clients": ("clients", "text"),
+    "insured": ("insured", "text"),
+    "case_title": ("case_title", "text"),
+    "date_of_loss": ("date_of_loss", CASE_DATE_FORMAT),
+}
+INVOICE_FIELDS = {
+    "invoice_no": ("invoice_no", "text"),
+    "Date of invoice": ("date_of_invoice", INVOICE_DATE_FORMAT),
+    "issuing office": ("issuing_office", "text"),
+    "Status": ("status", "text"),
+    "Total amount(MYR)": ("total_myr", "amount"),
+    "Total amount(USD)": ("total_usd", "amount"),
+    "exchange rate": ("exchange_rate", "amount"),
+}
+PAYMENT_FIELDS = {
+    "Received Amount": ("received_amount", "amount"),
+    "Payment to": ("payment_to", "text"),
+    "currency": ("currency", "text"),
+    "verified": ("verified", "bool"),
+}
+CURRENCIES = ("MYR", "USD")
+CASE_CONTAINERS = {"insurers": dict, "invoices": list}
+AMOUNT_CONTAINERS = ("insurer amounts(MYR)", "insurer amounts(USD)")
+
+
+def _typed(value, kind):
+    # (typed value, exact): exact is False when the typed column alone would
+    # not give back ``value``.
+    if value is None:
+        return None, False
+    if kind == "text":
+        return (value, True) if isinstance(value, str) else (None, False)
+    if kind == "bool":
+        return (value, True) if isinstance(value, bool) else (None, False)
+    if kind == "amount":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None, False
+        try:
+            decimal = Decimal(repr(value)).quantize(AMOUNT_EXP)
+        except InvalidOperation:
+            return None, False
+        if not decimal.is_finite() or abs(decimal) >= AMOUNT_LIMIT:
+            return None, False
+        return decimal, isinstance(value, float) and float(decimal) == value
+    # date columns keep the date when the stored text is its canonical spelling
+    if isinstance(value, str):
+        try:
+            parsed = datetime.strptime(value, kind).date()
+        except ValueError:
+            return None, False
+        return parsed, parsed.strftime(kind) == value
+    return None, False
+
+
+def _untyped(value, kind):
+    if value is None:
+        return None
+    if kind == "amount":
+        return float(value)
+    if kind in ("text", "bool"):
+        return value
+    return value.strftime(kind)
+
+
+def _split(record, fields, skip=()):
+    row = {}
+    extra = {}
+    for key, value in record.items():
+        if key in skip:
+            continue
+        if key not in fields:
+            extra[key] = value
+            continue
+        column, kind = fields[key]
+        row[column], exact = _typed(value, kind)
+        if not exact:
+            extra[key] = value
+    return row, extra
+
+
+def _join(row, fields, extra):
+    record = {}
+    for key, (column, kind) in fields.items():
+        if row.get(column) is not None:
+            record[key] = _untyped(row[column], kind)
+    if extra:
+        record.update(json.loads(extra))
+    return record
+
+
+def _dump(extra):
+    return json.dumps(extra, default=json_default) if extra else None
+
+
+def _containers(record, containers, extra):
+    # Nested containers become child rows and are always rebuilt on read; one
+    # that is missing or of another shape is kept as-is and listed in
+    # "__absent__" so it is not rebuilt.
+    absent = []
+    for key in containers:
+        kind = containers[key] if isinstance(containers, dict) else dict
+        if not isinstance(record.get(key), kind):
+            absent.append(key)
+            if key in record:
+                extra[key] = record[key]
+    if absent:
+        extra["__absent__"] = absent
+
+
+def book_to_tables(data):
+    rows = {name: [] for name in SCHEMAS}
+    invoice_id = 0
+    for case_no, case in data.items():
+        row, extra = _split(case, CASE_FIELDS, skip=CASE_CONTAINERS)
+        _containers(case, CASE_CONTAINERS, extra)
+        rows["cases"].append(dict(row, case_no=case_no, extra=_dump(extra)))
+
+        insurers = case.get("insurers")
+        for insurer, share in (insurers if isinstance(insurers, dict) else {}).items():
+            typed, exact = _typed(share, "amount")
+            rows["case_insurers"].append({"case_no": case_no, "insurer": insurer, "share": typed,
+                                          "extra": None if exact else _dump({"share": share})})
+
+        invoices = case.get("invoices")
+        for inv in invoices if isinstance(invoices, list) else []:
+            invoice_id += 1
+            row, extra = _split(inv, INVOICE_FIELDS, skip=AMOUNT_CONTAINERS + ("verified_insurers",))
+            _containers(inv, AMOUNT_CONTAINERS, extra)
+            verified = inv.get("verified_insurers")
+            if "verified_insurers" in inv and not (isinstance(verified, Mapping) and verified):
+                # only a non-empty dict is rebuilt from payment rows
+                extra["verified_insurers"] = verified
+            rows["invoices"].append(dict(row, invoice_id=invoice_id, case_no=case_no, extra=_dump(extra)))
+
+            for currency in CURRENCIES:
+                amounts = inv.get(f"insurer amounts({currency})")
+                for insurer, amount in (amounts if isinstance(amounts, dict) else {}).items():
+                    typed, exact = _typed(amount, "amount")
+                    rows["invoice_amounts"].append({
+                        "invoice_id": invoice_id, "currency": currency, "insurer": insurer, "amount": typed,
+                        "extra": None if exact else _dump({"amount": amount})})
+
+            for insurer, payment in (verified if isinstance(verified, Mapping) else {}).items():
+                if not isinstance(payment, Mapping):
+                    payment = {"__payment__": payment}
+                row, extra = _split(payment, PAYMENT_FIELDS)
+                rows["verified_payments"].append(dict(row, invoice_id=invoice_id, insurer=insurer,
+                                                      extra=_dump(extra)))
+
+    return {name: pa.Table.from_pylist(rows[name], schema=schema) for name, schema in SCHEMAS.items()}
+
+
+def tables_to_book(tables):
+    data = {}
+    for row in tables["cases"].to_pylist():
+        case = _join(row, CASE_FIELDS, row["extra"])
+        absent = case.pop("__absent__", [])
+        for key, kind in CASE_CONTAINERS.items():
+            if key not in absent:
+                case[key] = kind()
+        data[row["case_no"]] = case
+    for row in tables["case_insurers"].to_pylist():
+        share = _untyped(row["share"], "amount")
+        if row["extra"]:
+            share = json.loads(row["extra"])["share"]
+        data[row["case_no"]]["insurers"][row["insurer"]] = share
+    for case_no, inv in _invoices(tables):
+        data[case_no]["invoices"].append(inv)
+    return data
+
+
+def _invoices(tables, fields=INVOICE_FIELDS):
+    # [(case_no, invoice)] from the invoices table and, when present, its
+    # insurer amounts and verified payments tables. ``fields``: the invoice
+    # fields whose columns were read.
+    result = []
+    invoices_by_id = {}
+    for row in tables["invoices"].to_pylist():
+        inv = _join(row, fields, row["extra"])
+        absent = inv.pop("__absent__", [])
+        if "invoice_amounts" in tables:
+            for key in AMOUNT_CONTAINERS:
+                if key not in absent:
+                    inv[key] = {}
+        result.append((row["case_no"], inv))
+        invoices_by_id[row["invoice_id"]] = inv
+    if "invoice_amounts" in tables:
+        for row in tables["invoice_amounts"].to_pylist():
+            amount = _untyped(row["amount"], "amount")
+            if row["extra"]:
+                amount = json.loads(row["extra"])["amount"]
+            invoices_by_id[row["invoice_id"]][f"insurer amounts({row['currency']})"][row["insurer"]] = amount
+    if "verified_payments" in tables:
+        for row in tables["verified_payments"].to_pylist():
+            payment = _join(row, PAYMENT_FIELDS, row["extra"])
+            payment = payment.get("__payment__", payment)
+            invoices_by_id[row["invoice_id"]].setdefault("verified_insurers", {})[row["insurer"]] = payment
+    return result
+
+
+def _table_file(manifest_file, name, generation):
+    return f"{os.path.splitext(manifest_file)[0]}.{generation}.{name}.parquet"
+
+
+def _read_manifest(manifest_file):
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError as e:
+        raise StoreError(f"{manifest_file} is not valid JSON: {e}")
+
+
+def write_snapshot(data, manifest_file=PARQUET_FILE):
+    # Tables are written under a new generation first; replacing the small
+    # manifest switches readers over atomically, then old files are removed.
+    previous = _read_manifest(manifest_file)
+    generation = previous["generation"] + 1 if previous else 1
+    for name, table in book_to_tables(data).items():
+        with open(_table_file(manifest_file, name, generation), "wb") as f:
+            pq.write_table(table, f, compression="zstd")
+            f.flush()
+            os.fsync(f.fileno())
+            perf.count("storage.snapshot_bytes", f.tell())
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"generation": generation, "tables": sorted(SCHEMAS)}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, manifest_file)
+    if previous:
+        for name in previous["tables"]:
+            try:
+                os.remove(_table_file(manifest_file, name, previous["generation"]))
+            except FileNotFoundError:
+                pass
+
+
+def read_table(name, manifest_file=PARQUET_FILE, columns=None, filters=None, generation=None):
+    # One table of the snapshot (the current one, or ``generation``),
+    # memory-mapped and reading only ``columns`` of the rows ``filters``
+    # keeps; None when there is no snapshot yet.
+    if generation is None:
+        manifest = _read_manifest(manifest_file)
+        if manifest is None:
+            return None
+        generation = manifest["generation"]
+    return pq.read_table(_table_file(manifest_file, name, generation), columns=columns, filters=filters,
+                         memory_map=True)
+
+
+def read_invoices(manifest_file, generation, fields=None, filters=None):
+    # [(case_no, invoice)] of one snapshot generation in book order, reading
+    # only the invoice rows ``filters`` keeps and the columns of ``fields``
+    # (invoice keys, None for all): the insurer amounts and verified payments
+    # tables are skipped unless asked for. Nothing of the cases is read.
+    columns = {key: INVOICE_FIELDS[key] for key in INVOICE_FIELDS if fields is None or key in fields}
+    tables = {"invoices": read_table("invoices", manifest_file,
+                                     ["invoice_id", "case_no", "extra"] + [column for column, _ in columns.values()],
+                                     filters, generation)}
+    ids = pc.field("invoice_id").isin(tables["invoices"]["invoice_id"])
+    for key, name in (("insurer amounts(MYR)", "invoice_amounts"), ("insurer amounts(USD)", "invoice_amounts"),
+                      ("verified_insurers", "verified_payments")):
+        if (fields is None or key in fields) and name not in tables:
+            tables[name] = read_table(name, manifest_file, filters=ids, generation=generation)
+    return _invoices(tables, columns)
+
+
+def read_snapshot(manifest_file=PARQUET_FILE):
+    manifest = _read_manifest(manifest_file)
+    if manifest is None:
+        return {}
+    return tables_to_book({name: read_table(name, manifest_file=manifest_file) for name in SCHEMAS})
+
+
+def _status_rows(statuses):
+    # Invoice rows whose Status may be one of ``statuses``: a status that is
+    # not plain text has a null column and sits in "extra", so those rows are
+    # read too and the invoice itself decides.
+    return pc.field("status").isin(list(statuses)) | pc.field("status").is_null()
+
+
+def _journal_records(journal_file):
+    # Change records of the journal written since the snapshot.
+    try:
+        with open(journal_file, "rb") as f:
+            chunk = f.read()
+    except FileNotFoundError:
+        return []
+    records = []
+    for line in chunk[:chunk.rfind(b"\n") + 1].splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if record.get("op") != "base":
+            records.append(record)
+    return records
+
+
+class ParquetStore(JsonStore):
+    # Same journal and locking as JsonStore; only the snapshot is Parquet.
+    # The invoice list and aging read their invoices from the snapshot (only
+    # the rows and columns they need) with the journal replayed over the
+    # cases it touches, instead of loading the book.
+    def _read_snapshot(self):
+        return read_snapshot(self.data_file)
+
+    def _write_snapshot(self):
+        write_snapshot(self._data, self.data_file)
+
+    def iter_invoices(self, status=None):
+        if status is None:
+            return self._snapshot_invoices(None, lambda inv: True)
+        return self._snapshot_invoices(_status_rows([status]), lambda inv: inv.get("Status") == status)
+
+    def open_invoices(self, fields=None):
+        return self._snapshot_invoices(_status_rows(("",) + OPEN_STATUSES), is_open, fields)
+
+    def _snapshot_invoices(self, rows, keep, fields=None):
+        # [(case_no, invoice)] in book order. A write while the snapshot and
+        # journal are read (the files changed, or a compaction removed the old
+        # tables) means reading both again.
+        with perf.span("storage.parquet_invoices"):
+            while True:
+                key = self.version_key()
+                manifest = _read_manifest(self.data_file)
+                records = _journal_records(self.journal_file)
+                try:
+                    invoices = self._replayed_invoices(manifest, records, rows, keep, fields)
+                except FileNotFoundError:
+                    continue
+                if self.version_key() == key:
+                    perf.count("storage.rows_scanned", len(invoices))
+                    return invoices
+
+    def _replayed_invoices(self, manifest, records, rows, keep, fields):
+        touched = {case_no for record in records
+                   for case_no in (record.get("case_no"), record.get("new_case_no")) if case_no is not None}
+        if manifest is None:
+            order, snapshot, changed = [], [], []
+        else:
+            generation = manifest["generation"]
+            if touched:
+                others = ~pc.field("case_no").isin(list(touched))
+                rows = others if rows is None else rows & others
+            snapshot = [(case_no, inv) for case_no, inv in read_invoices(self.data_file, generation, fields, rows)
+                        if keep(inv)]
+            if not touched:
+                return snapshot
+            order = read_table("cases", self.data_file, ["case_no"], generation=generation)["case_no"].to_pylist()
+            changed = read_invoices(self.data_file, generation, fields, pc.field("case_no").isin(list(touched)))
+
+        # the touched cases as the journal leaves them, in their place among
+        # the others (None), e.g. a renamed case keeps its position
+        book = {case_no: {"invoices": []} if case_no in touched else None for case_no in order}
+        for case_no, inv in changed:
+            book[case_no]["invoices"].append(inv)
+        for record in records:
+            apply_change(book, record)
+        untouched = {}
+        for case_no, inv in snapshot:
+            untouched.setdefault(case_no, []).append((case_no, inv))
+        invoices = []
+        for case_no, case in book.items():
+            if case is None:
+                invoices.extend(untouched.get(case_no, ()))
+            else:
+                invoices.extend((case_no, inv) for inv in case.get("invoices", []) if keep(inv))
+        return invoices
+
+
+def json_to_parquet(json_file=DATA_FILE, manifest_file=PARQUET_FILE, journal_file=JOURNAL_FILE):
+    data = JsonStore(json_file, journal_file, LOCK_FILE).load()
+    write_snapshot(data, manifest_file)
+    return len(data), sum(len(case.get("invoices", [])) for case in data.values())
+
+
+def parquet_to_json(manifest_file=PARQUET_FILE, json_file=DATA_FILE, journal_file=JOURNAL_FILE):
+    data = ParquetStore(manifest_file, journal_file, LOCK_FILE).load()
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(data, f, indent=4, default=json_default)
+    os.replace(tmp_file, json_file)
+    return len(data), sum(len(case.get("invoices", [])) for case in data.values())
+
+
+if __name__ == "__main__":
+    # python parquet_store.py to-parquet [json] [manifest]
+    # python parquet_store.py to-json [manifest] [json]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("to-parquet", "to-json"):
+        sys.exit("usage: parquet_store.py to-parquet|to-json [source] [target]")
+    convert = json_to_parquet if sys.argv[1] == "to-parquet" else parquet_to_json
+    cases, invoices = convert(*sys.argv[2:4])
+    print(f"Converted {cases} cases and {invoices} invoices")
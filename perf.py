@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# Timing spans and counters for the hot paths. Collection is off unless
+# CASES_PERF is set or a session turns it on for its reruns (begin_run); off,
+# span() hands back a shared no-op context and count() returns at once.
+ENABLED = os.environ.get("CASES_PERF", "") not in ("", "0")
+PERF_LOG_FILE = os.environ.get("CASES_PERF_LOG", "perf_log.jsonl")
+PERF_LOG_MAX_BYTES = 5 * 1024 * 1024
+PROMETHEUS_FILE = os.environ.get("CASES_PERF_PROM", "perf_metrics.prom")
+
+_NULL = nullcontext()
+_local = threading.local()
+_totals_lock = threading.Lock()
+# process-wide totals since start: name -> [calls, seconds] / name -> value
+_span_totals = {}
+_counter_totals = {}
+
+
+def enabled():
+    return getattr(_local, "enabled", ENABLED)
+
+
+def begin_run(enable=None):
+    # Starts a fresh set of per-run metrics for this thread (a Streamlit
+    # rerun); ``enable`` overrides CASES_PERF for the run.
+    _local.enabled = ENABLED if enable is None else enable
+    _local.spans = {}
+    _local.counters = {}
+    _local.started = time.perf_counter()
+
+
+def _run():
+    if not hasattr(_local, "spans"):
+        _local.spans = {}
+        _local.counters = {}
+        _local.started = time.perf_counter()
+    return _local
+
+
+class _Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        spans = _run().spans
+        entry = spans.setdefault(self.name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        with _totals_lock:
+            total = _span_totals.setdefault(self.name, [0, 0.0])
+            total[0] += 1
+            total[1] += elapsed
+        return False
+
+
+def span(name):
+    if not getattr(_local, "enabled", ENABLED):
+        return _NULL
+    return _Span(name)
+
+
+def count(name, value=1):
+    if not getattr(_local, "enabled", ENABLED):
+        return
+    counters = _run().counters
+    counters[name] = counters.get(name, 0) + value
+    with _totals_lock:
+        _counter_totals[name] = _counter_totals.get(name, 0) + value
+
+
+def snapshot():
+    # This thread's metrics for the current run.
+    run = _run()
+    return {
+        "wall_seconds": time.perf_counter() - run.started,
+        "spans": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in sorted(run.spans.items())},
+        "counters": dict(sorted(run.counters.items())),
+    }
+
+
+def _prometheus_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+
+def prometheus_text():
+    with _totals_lock:
+        spans = {name: list(entry) for name, entry in _span_totals.items()}
+        counters = dict(_counter_totals)
+    lines = ["# TYPE cases_span_calls_total counter", "# TYPE cases_span_seconds_total counter"]
+    for name, (calls, seconds) in sorted(spans.items()):
+        lines.append(f'cases_span_calls_total{{span="{name}"}} {calls}')
+        lines.append(f'cases_span_seconds_total{{span="{name}"}} {seconds:.6f}')
+    for name, value in sorted(counters.items()):
+        metric = f"cases_{_prometheus_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=PROMETHEUS_FILE):
+    # Process totals in the Prometheus text format (node_exporter textfile).
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_file, path)
+
+
+def log_run(label=None, path=PERF_LOG_FILE, max_bytes=PERF_LOG_MAX_BYTES):
+    # Appends this run's metrics as one JSON line; past ``max_bytes`` the log
+    # rolls over to ``path``.1.
+    record = dict(snapshot(), time=time.time(), label=label)
+    if os.path.exists(path) and os.path.getsize(path) >= max_bytes:
+        os.replace(path, path + ".1")
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
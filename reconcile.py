@@ -0,0 +1,138 @@
+import pandas as pd
+
+from ledger import new_receipt
+from matching import CURRENCIES, get_matcher
+from money import to_cents
+from settlement import record_receipts
+from storage import PAID, editable_copy, save_data, lookup_invoice
+
+STATEMENT_COLUMNS = {
+    "insurer": ("insurer", "insurer name", "payer", "remitter"),
+    "amount": ("amount", "received amount", "credit"),
+    "currency": ("currency", "ccy"),
+    "bank": ("bank", "payment to", "account"),
+    "date": ("date", "value date", "payment date"),
+}
+
+
+def read_statement(source, filename=None):
+    name = (filename or getattr(source, "name", None) or str(source)).lower()
+    if name.endswith(".csv"):
+        df = pd.read_csv(source, dtype=str, keep_default_na=False)
+    else:
+        df = pd.read_excel(source, dtype=str, engine="openpyxl").fillna("")
+
+    columns = {str(c).strip().lower(): c for c in df.columns}
+    renamed = {}
+    for field, aliases in STATEMENT_COLUMNS.items():
+        for alias in aliases:
+            if alias in columns:
+                renamed[columns[alias]] = field
+                break
+    df = df.rename(columns=renamed)
+    missing = [field for field in ("insurer", "amount") if field not in df.columns]
+    if missing:
+        raise ValueError(f"Statement is missing column(s): {', '.join(missing)}")
+
+    df["amount"] = pd.to_numeric(df["amount"].str.replace(",", "", regex=False), errors="coerce")
+    df["currency"] = df["currency"].str.strip().str.upper().replace("", "MYR") if "currency" in df else "MYR"
+    df["bank"] = df["bank"].str.strip() if "bank" in df else ""
+    df["date"] = df["date"].str.strip() if "date" in df else ""
+    df["insurer"] = df["insurer"].str.strip()
+    # lines in a currency the book does not bill in are kept, but never match
+    return [
+        {"line": i + 1, "insurer": row.insurer, "amount": row.amount, "currency": row.currency,
+         "bank": row.bank, "date": row.date,
+         "note": "" if row.currency in CURRENCIES else f"unknown currency {row.currency!r}"}
+        for i, row in enumerate(df[["insurer", "amount", "currency", "bank", "date"]].itertuples(index=False))
+    ]
+
+
+def _invoice_date(data, case_no, invoice_no):
+    inv = lookup_invoice(data, case_no, invoice_no) or {}
+    return str(inv.get("Date of invoice") or "9999").replace("/", "-")
+
+
+def plan_reconciliation(data, lines, resolve_ambiguous=True):
+    # Lines are taken in statement order. Each one claims at most one insurer
+    # share; exact amounts rank before USD close matches, then the smallest
+    # shortfall, then the oldest invoice, so the outcome never depends on
+    # dict or index ordering.
+    matcher = get_matcher()
+    claimed = set()
+    report = []
+    for line in lines:
+        result = dict(line, status="unmatched", case_no="", invoice_no="", matched_insurer="",
+                      expected_amount=None, candidates=0)
+        report.append(result)
+        if pd.isna(line["amount"]) or not line["insurer"] or line.get("note"):
+            continue
+
+        exact, close = matcher.match(line["currency"], line["insurer"], line["amount"], one_per_invoice=False)
+        cents = to_cents(line["amount"])
+        candidates = []
+        for kind, matches in ((0, exact), (1, close)):
+            for case_no, invoice_no, insurer, amount in matches:
+                if (case_no, invoice_no, insurer) in claimed:
+                    continue
+                rank = (kind, to_cents(amount) - cents)
+                candidates.append((rank, _invoice_date(data, case_no, invoice_no), case_no, invoice_no,
+                                   insurer, amount))
+        if not candidates:
+            continue
+
+        candidates.sort(key=lambda c: c[:5])
+        best = candidates[0]
+        ties = sum(1 for c in candidates if c[0] == best[0])
+        result["candidates"] = len(candidates)
+        if ties > 1:
+            result["status"] = "ambiguous"
+            if not resolve_ambiguous:
+                continue
+        else:
+            result["status"] = "matched"
+        _, _, case_no, invoice_no, insurer, amount = best
+        claimed.add((case_no, invoice_no, insurer))
+        result.update(case_no=case_no, invoice_no=invoice_no, matched_insurer=insurer, expected_amount=amount)
+    return report
+
+
+def apply_reconciliation(data, report):
+    # One ledger receipt per applied statement line, written in one append.
+    data = editable_copy(data, *{result["case_no"] for result in report if result["case_no"]})
+    receipts = []
+    invoices = {}
+    for result in report:
+        if not result["case_no"]:
+            continue
+        ref = (result["case_no"], result["invoice_no"])
+        inv = lookup_invoice(data, *ref)
+        if inv is None:
+            continue
+        invoices[ref] = inv
+        receipts.append(new_receipt(result["insurer"], result["bank"], result["currency"], result["amount"],
+                                    [ref + (result["matched_insurer"], result["amount"])], result["date"],
+                                    "statement"))
+    changes = record_receipts(receipts, invoices)
+
+    # several lines can settle one invoice; only its last status is kept
+    settled = {}
+    for record in changes:
+        if record["op"] == "status_change":
+            settled[(record["case_no"], record["invoice_no"])] = record["status"]
+    save_data(data, changes)
+    return sum(1 for status in settled.values() if status == PAID)
+
+
+def summarize(report, paid=0):
+    counts = {"matched": 0, "ambiguous": 0, "unmatched": 0}
+    for result in report:
+        counts[result["status"]] += 1
+    counts["paid_invoices"] = paid
+    return counts
+
+
+def reconcile(data, source, filename=None, resolve_ambiguous=True):
+    report = plan_reconciliation(data, read_statement(source, filename), resolve_ambiguous)
+    paid = apply_reconciliation(data, report)
+    return summarize(report, paid), report
@@ -0,0 +1,314 @@
+import copy
+import sys
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+# Compact form of the book that every Streamlit session shares (see
+# storage.load_data). Cases and invoices are slotted records instead of
+# dicts; repeated text (insurers, offices, statuses, dates, clients) is
+# interned; insurer amounts keep only a shared tuple of insurer names, their
+# values sit in one array of doubles per loaded book; verified payments are
+# records too. Records read and write like the dicts they replace, so code
+# checks for a Mapping rather than a dict. Amount dicts are built on access, so code that
+# changes one assigns it back; other nested values (invoice lists, verified
+# payments) are the stored objects. Pages edit a plain copy of a case
+# (plain_copy via storage.editable_copy) and records are compacted again on
+# the next load.
+
+_MISSING = object()
+_name_tuples = {}
+
+
+def intern_text(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _names(keys):
+    names = tuple(intern_text(key) for key in keys)
+    return _name_tuples.setdefault(names, names)
+
+
+def _packable(value):
+    # {name: float} dicts go to the pool; anything else is stored as given
+    return type(value) is dict and all(type(amount) is float for amount in value.values())
+
+
+class Record(MutableMapping):
+    # ``pool``/``at``: the book's array of doubles and where this record's
+    # packed amounts start, PACKED slots in order.
+    __slots__ = ("extra", "pool", "at")
+    # JSON key -> slot, in the order keys are listed
+    FIELDS = {}
+    PACKED = ()
+    INTERNED = frozenset()
+
+    def __init__(self, values=(), pool=None):
+        for slot in self.FIELDS.values():
+            setattr(self, slot, _MISSING)
+        self.extra = None
+        self.pool = pool
+        self.at = None
+        values = dict(values)
+        packed = {}
+        for key, value in values.items():
+            slot = self.FIELDS.get(key)
+            if slot in self.PACKED and _packable(value):
+                packed[slot] = value
+            else:
+                self[key] = value
+        if packed:
+            self._pack(packed)
+
+    def _packed_values(self):
+        # {slot: (names, values)} of the amounts now in the pool
+        result = {}
+        position = self.at
+        for slot in self.PACKED:
+            names = getattr(self, slot)
+            if type(names) is tuple:
+                result[slot] = (names, self.pool[position:position + len(names)])
+                position += len(names)
+        return result
+
+    def _pack(self, changed):
+        # Stores ``changed`` ({slot: {name: float}}) with the other packed
+        # amounts; in place when the sizes allow, else at the end of the pool.
+        # The amounts left behind stay in the pool until the book is repacked
+        # (repack_book).
+        current = self._packed_values() if self.at is not None else {}
+        size = sum(len(names) for names, _ in current.values())
+        values = []
+        for slot in self.PACKED:
+            if slot in changed:
+                setattr(self, slot, _names(changed[slot]))
+                values.extend(changed[slot].values())
+            elif slot in current:
+                values.extend(current[slot][1])
+        if self.pool is None:
+            self.pool = array("d")
+        if self.at is not None and len(values) == size:
+            self.pool[self.at:self.at + size] = array("d", values)
+        elif self.at is not None and self.at + size == len(self.pool):
+            # this record's amounts end the pool: grow them where they are
+            del self.pool[self.at:]
+            self.pool.extend(values)
+        else:
+            self.at = len(self.pool)
+            self.pool.extend(values)
+
+    def _unpack(self, slot):
+        position = self.at
+        for other in self.PACKED:
+            names = getattr(self, other)
+            if type(names) is tuple:
+                if other == slot:
+                    return dict(zip(names, self.pool[position:position + len(names)]))
+                position += len(names)
+        raise KeyError(slot)
+
+    def _value(self, slot):
+        value = getattr(self, slot)
+        if type(value) is tuple and slot in self.PACKED:
+            return self._unpack(slot)
+        return value
+
+    def __getitem__(self, key):
+        slot = self.FIELDS.get(key)
+        if slot is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        if getattr(self, slot) is _MISSING:
+            raise KeyError(key)
+        return self._value(slot)
+
+    def setdefault(self, key, default=None):
+        # The stored value: assigning may store a compacted copy of ``default``.
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def get(self, key, default=None):
+        slot = self.FIELDS.get(key)
+        if slot is None:
+            return default if self.extra is None else self.extra.get(key, default)
+        if getattr(self, slot) is _MISSING:
+            return default
+        return self._value(slot)
+
+    def _unset(self, slot):
+        # Moves the other packed amounts out of the way of ``slot``.
+        if type(getattr(self, slot)) is tuple and slot in self.PACKED:
+            others = {other: self._unpack(other) for other in self.PACKED
+                      if other != slot and type(getattr(self, other)) is tuple}
+            size = sum(len(getattr(self, other)) for other in self.PACKED if type(getattr(self, other)) is tuple)
+            if self.at + size == len(self.pool):
+                # the last amounts in the pool are this record's: reuse their space
+                del self.pool[self.at:]
+            setattr(self, slot, _MISSING)
+            self.at = None
+            if others:
+                self._pack(others)
+
+    def __setitem__(self, key, value):
+        slot = self.FIELDS.get(key)
+        if slot is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        elif slot in self.PACKED and _packable(value):
+            if type(getattr(self, slot)) is not tuple or len(getattr(self, slot)) != len(value):
+                self._unset(slot)
+            self._pack({slot: value})
+        else:
+            self._unset(slot)
+            setattr(self, slot, intern_text(value) if slot in self.INTERNED else value)
+
+    def __delitem__(self, key):
+        slot = self.FIELDS.get(key)
+        if slot is None:
+            if self.extra is None:
+                raise KeyError(key)
+            del self.extra[key]
+            if not self.extra:
+                self.extra = None
+        elif getattr(self, slot) is _MISSING:
+            raise KeyError(key)
+        else:
+            self._unset(slot)
+            setattr(self, slot, _MISSING)
+
+    def __contains__(self, key):
+        slot = self.FIELDS.get(key)
+        if slot is None:
+            return self.extra is not None and key in self.extra
+        return getattr(self, slot) is not _MISSING
+
+    def __iter__(self):
+        for key, slot in self.FIELDS.items():
+            if getattr(self, slot) is not _MISSING:
+                yield key
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self.items())!r})"
+
+    def __reduce__(self):
+        return type(self), (plain_copy(self),)
+
+
+class InvoiceRecord(Record):
+    FIELDS = {
+        "invoice_no": "invoice_no",
+        "Date of invoice": "date",
+        "issuing office": "office",
+        "Status": "status",
+        "Total amount(MYR)": "total_myr",
+        "Total amount(USD)": "total_usd",
+        "exchange rate": "rate",
+        "insurer amounts(MYR)": "amounts_myr",
+        "insurer amounts(USD)": "amounts_usd",
+        "verified_insurers": "verified",
+    }
+    PACKED = ("amounts_myr", "amounts_usd")
+    INTERNED = frozenset(("date", "office", "status"))
+    __slots__ = tuple(FIELDS.values())
+
+    def __setitem__(self, key, value):
+        if key == "verified_insurers" and type(value) is dict:
+            value = {intern_text(insurer): compact_payment(payment) for insurer, payment in value.items()}
+        super().__setitem__(key, value)
+
+
+class PaymentRecord(Record):
+    FIELDS = {
+        "Received Amount": "amount",
+        "Payment to": "bank",
+        "currency": "currency",
+        "verified": "verified",
+    }
+    INTERNED = frozenset(("bank", "currency"))
+    __slots__ = tuple(FIELDS.values())
+
+
+class CaseRecord(Record):
+    FIELDS = {
+        "clients": "clients",
+        "insured": "insured",
+        "case_title": "case_title",
+        "date_of_loss": "date_of_loss",
+        "insurers": "insurers",
+        "invoices": "invoices",
+    }
+    PACKED = ("insurers",)
+    INTERNED = frozenset(("clients", "date_of_loss"))
+    __slots__ = tuple(FIELDS.values())
+
+    def __setitem__(self, key, value):
+        if key == "invoices" and type(value) is list:
+            value = [compact_invoice(inv, self.pool) for inv in value]
+        super().__setitem__(key, value)
+
+
+def compact_payment(payment):
+    return PaymentRecord(payment) if type(payment) is dict else payment
+
+
+def compact_invoice(inv, pool=None):
+    return InvoiceRecord(inv, pool) if type(inv) is dict else inv
+
+
+def compact_case(case, pool=None):
+    return CaseRecord(case, pool) if type(case) is dict else case
+
+
+class Book(dict):
+    # {case_no: case} as read from the store at ``version``, or None when
+    # unknown. Copies made for editing keep it (storage.editable_copy) so a
+    # save can tell which cases other writers changed since.
+    __slots__ = ("version",)
+
+    def __init__(self, cases=(), version=None):
+        super().__init__(cases)
+        self.version = version
+
+    def __reduce__(self):
+        return Book, (dict(self), self.version)
+
+
+def compact_book(data, pool=None):
+    # Same book with every plain case and invoice replaced by its record; the
+    # records share one pool of amounts (``pool``, or a new one), freed with
+    # the book.
+    pool = array("d") if pool is None else pool
+    return Book(((case_no, compact_case(case, pool)) for case_no, case in data.items()),
+                getattr(data, "version", None))
+
+
+def repack_book(data):
+    # (book, pool): ``data`` moved onto a new pool that holds only its own
+    # amounts. A pool that changed books keep adding to (storage.changed_book)
+    # also holds the amounts of every case they replaced.
+    pool = array("d")
+    return Book(((case_no, compact_case(plain_copy(case), pool)) for case_no, case in data.items()),
+                getattr(data, "version", None)), pool
+
+
+def plain_copy(value):
+    # Deep copy made of plain dicts and lists, for editing outside the book.
+    if isinstance(value, Mapping):
+        return {key: plain_copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [plain_copy(item) for item in value]
+    return copy.deepcopy(value)
+
+
+def json_default(value):
+    # ``default`` for json.dump(s) of a book or change records holding records
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    return str(value)
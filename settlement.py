@@ -0,0 +1,251 @@
+from collections.abc import Mapping
+
+import storage
+from ledger import book_receipt, get_ledger, new_receipt, receipt_key
+from matching import CURRENCIES
+from money import from_cents, to_cents
+from storage import (OUTSTANDING, PARTIALLY_PAID, PAID, editable_copy, invoice_status, is_open, is_open_status,
+                     lookup_invoice, payment_verified, status_change)
+
+_tracker = None
+
+
+def share_cents(inv):
+    # {(currency, insurer): cents} of an invoice's insurer shares.
+    return {(currency, insurer): to_cents(amount)
+            for currency in CURRENCIES
+            for insurer, amount in (inv.get(f"insurer amounts({currency})", {}) or {}).items()}
+
+
+def is_short(expected, insurer, payment):
+    # A payment below the insurer's share in the payment's currency.
+    if not isinstance(payment, Mapping):
+        return False
+    cents = expected.get((payment.get("currency"), insurer))
+    return cents is not None and to_cents(payment.get("Received Amount")) < cents
+
+
+def settled_status(unverified, short):
+    if short:
+        return PARTIALLY_PAID
+    return OUTSTANDING if unverified else PAID
+
+
+class SettlementTracker:
+    # Per open invoice, the insurer shares still unverified (a counter that
+    # verifications decrement) and the verified shares received short. An
+    # invoice is Paid once nothing is unverified and Partially Paid while a
+    # share is short. ``pending`` holds invoices whose stored status lags
+    # behind, e.g. ones verified before statuses were tracked.
+    def __init__(self):
+        self.expected = {}
+        self.unverified = {}
+        self.short = {}
+        self.stored = {}
+        self.case_invoices = {}
+        self.pending = set()
+
+    @classmethod
+    def from_store(cls, store):
+        tracker = cls()
+        for case_no, inv in store.open_invoices():
+            tracker.add_invoice(case_no, inv)
+        return tracker
+
+    def status(self, ref):
+        if not self.expected[ref]:
+            # no insurer shares: nothing to settle automatically
+            return self.stored[ref]
+        return settled_status(self.unverified[ref], self.short[ref])
+
+    def _check(self, ref):
+        status = self.status(ref)
+        if status != self.stored[ref] and status != OUTSTANDING:
+            self.pending.add(ref)
+        else:
+            self.pending.discard(ref)
+
+    def add_invoice(self, case_no, inv):
+        if not is_open(inv):
+            return
+        status = invoice_status(inv)
+        ref = (case_no, inv.get("invoice_no"))
+        expected = share_cents(inv)
+        verified = inv.get("verified_insurers", {}) or {}
+        self.expected[ref] = expected
+        self.unverified[ref] = {insurer for _, insurer in expected} - set(verified)
+        self.short[ref] = {insurer for insurer, payment in verified.items() if is_short(expected, insurer, payment)}
+        self.stored[ref] = status
+        self.case_invoices.setdefault(case_no, set()).add(ref[1])
+        self._check(ref)
+
+    def remove_invoice(self, case_no, invoice_no):
+        ref = (case_no, invoice_no)
+        if ref not in self.stored:
+            return
+        for table in (self.expected, self.unverified, self.short, self.stored):
+            del table[ref]
+        self.pending.discard(ref)
+        self.case_invoices[case_no].discard(invoice_no)
+        if not self.case_invoices[case_no]:
+            del self.case_invoices[case_no]
+
+    def refresh_invoice(self, case_no, inv):
+        self.remove_invoice(case_no, inv.get("invoice_no"))
+        self.add_invoice(case_no, inv)
+
+    def set_status(self, case_no, invoice_no, status):
+        ref = (case_no, invoice_no)
+        if not is_open_status(status):
+            self.remove_invoice(case_no, invoice_no)
+        elif ref in self.stored:
+            self.stored[ref] = status or OUTSTANDING
+            self._check(ref)
+
+    def verify(self, case_no, invoice_no, insurer, payment=None):
+        ref = (case_no, invoice_no)
+        if ref not in self.stored:
+            return
+        self.unverified[ref].discard(insurer)
+        if is_short(self.expected[ref], insurer, payment):
+            self.short[ref].add(insurer)
+        else:
+            self.short[ref].discard(insurer)
+        self._check(ref)
+
+    def remove_case(self, case_no):
+        for invoice_no in list(self.case_invoices.get(case_no, ())):
+            self.remove_invoice(case_no, invoice_no)
+
+    def rename_case(self, case_no, new_case_no):
+        for invoice_no in self.case_invoices.pop(case_no, ()):
+            old, new = (case_no, invoice_no), (new_case_no, invoice_no)
+            for table in (self.expected, self.unverified, self.short, self.stored):
+                table[new] = table.pop(old)
+            if old in self.pending:
+                self.pending.discard(old)
+                self.pending.add(new)
+            self.case_invoices.setdefault(new_case_no, set()).add(invoice_no)
+
+    def status_after(self, case_no, inv, insurer, payment):
+        # Status ``inv`` takes once ``payment`` for ``insurer`` is recorded, or
+        # None for an invoice that is not open. Payments already on the
+        # working copy but not saved yet (a statement batch) count as well.
+        ref = (case_no, inv.get("invoice_no"))
+        if ref not in self.stored:
+            return None
+        if not self.expected[ref]:
+            return self.stored[ref]
+        verified = dict(inv.get("verified_insurers", {}) or {})
+        verified[insurer] = payment
+        short = {name for name, paid in verified.items() if is_short(self.expected[ref], name, paid)}
+        return settled_status(self.unverified[ref] - set(verified), short)
+
+
+def _verify(case_no, inv, insurer, payment):
+    # Marks ``insurer`` verified on ``inv`` and returns the change records:
+    # the payment, plus its new status when that moves. Neither carries the
+    # rest of the invoice, so verifications other writers saved since ``inv``
+    # was read are kept. ``inv`` belongs to an editable copy of the book,
+    # never the shared one.
+    invoice_no = inv.get("invoice_no")
+    status = get_tracker().status_after(case_no, inv, insurer, payment)
+    inv.setdefault("verified_insurers", {})[insurer] = payment
+    changes = [payment_verified(case_no, invoice_no, insurer, payment)]
+    if status is not None and status != invoice_status(inv):
+        inv["Status"] = status
+        changes.append(status_change(case_no, invoice_no, status))
+    return changes
+
+
+def record_receipts(receipts, invoices):
+    # Appends ``receipts`` (ledger.new_receipt) to the payment ledger and
+    # marks every allocated share verified with all the ledger has received
+    # for it in the receipt's currency. ``invoices`` maps (case_no,
+    # invoice_no) to the invoice to update, taken from an editable copy of the
+    # book (storage.editable_copy) that the caller saves. A share verified before the
+    # ledger knew it gets a receipt for that payment first, so it adds up.
+    # Receipts are keyed by what the book held before them (ledger.receipt_key),
+    # so recording them again after the save failed adds nothing.
+    payments = get_ledger()
+    carried = {}
+    recorded = {}
+    for receipt in receipts:
+        before = []
+        for allocation in receipt["allocations"]:
+            case_no, invoice_no, insurer = allocation["case_no"], allocation["invoice_no"], allocation["insurer"]
+            inv = invoices[(case_no, invoice_no)]
+            earlier = (inv.get("verified_insurers", {}) or {}).get(insurer)
+            if (isinstance(earlier, Mapping) and earlier.get("currency")
+                    and not payments.paid_cents(invoice_no, earlier.get("currency"), insurer)):
+                carried.setdefault((invoice_no, insurer), book_receipt(case_no, inv, insurer, earlier))
+            share = (invoice_no, receipt["currency"], insurer)
+            if share not in recorded:
+                same_currency = isinstance(earlier, Mapping) and earlier.get("currency") == receipt["currency"]
+                recorded[share] = to_cents(earlier.get("Received Amount")) if same_currency else 0
+            before.append(recorded[share])
+            recorded[share] += to_cents(allocation["amount"])
+        receipt["key"] = receipt_key(receipt, before)
+    payments.append(list(carried.values()) + list(receipts))
+
+    changes = []
+    for receipt in receipts:
+        for allocation in receipt["allocations"]:
+            case_no, invoice_no, insurer = allocation["case_no"], allocation["invoice_no"], allocation["insurer"]
+            payment = {
+                "Received Amount": from_cents(payments.paid_cents(invoice_no, receipt["currency"], insurer)),
+                "Payment to": receipt["bank"],
+                "currency": receipt["currency"],
+                "verified": True,
+                "Payment date": receipt["date"],
+            }
+            changes.extend(_verify(case_no, invoices[(case_no, invoice_no)], insurer, payment))
+    return changes
+
+
+def record_payment(case_no, inv, insurer, payment, source="manual"):
+    # One receipt settling one share, from a payment as the pages build it
+    # ("Received Amount", "Payment to", "currency", optional "Payment date").
+    amount = payment.get("Received Amount")
+    receipt = new_receipt(insurer, payment.get("Payment to") or "", payment.get("currency"), amount,
+                          [(case_no, inv.get("invoice_no"), insurer, amount)], payment.get("Payment date"), source)
+    return record_receipts([receipt], {(case_no, inv.get("invoice_no")): inv})
+
+
+def settle_pending(data):
+    # (book, changes): the status changes for the invoices whose stored status
+    # lags behind, and a copy of ``data`` they are made on, to be saved.
+    tracker = get_tracker()
+    pending = sorted(tracker.pending, key=str)
+    data = editable_copy(data, *{case_no for case_no, _ in pending})
+    changes = []
+    for ref in pending:
+        inv = lookup_invoice(data, *ref)
+        if inv is not None and invoice_status(inv) != tracker.status(ref):
+            inv["Status"] = tracker.status(ref)
+            changes.append(status_change(ref[0], ref[1], inv["Status"]))
+    return data, changes
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = SettlementTracker.from_store(storage.get_store())
+    return _tracker
+
+
+def _on_change(changes):
+    global _tracker
+    if _tracker is None:
+        return
+    if changes is None:
+        _tracker = None
+        return
+    for record in changes:
+        if record.get("op") == "payment_verified":
+            _tracker.verify(record["case_no"], record["invoice_no"], record["insurer"], record["payment"])
+        else:
+            storage.dispatch_change(_tracker, record)
+
+
+storage.add_listener(_on_change)
@@ -0,0 +1,597 @@
+import json
+import sqlite3
+import sys
+import threading
+from array import array
+
+from book_index import MIN_GRAM_QUERY
+from storage import (DATA_FILE, DB_FILE, JOURNAL_FILE, LOCK_FILE, CASE_SORT_FIELDS, INVOICE_SORT_FIELDS,
+                     OPEN_STATUSES, OUTSTANDING, JsonStore, changed_book, check_base, repack_due)
+from records import compact_book, repack_book
+
+# Free-form value columns are declared without a type so SQLite keeps the
+# Python value exactly as given (no numeric/text affinity conversion).
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_no TEXT PRIMARY KEY,
+    clients, insured, case_title, date_of_loss,
+    extra TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS case_insurers (
+    case_no TEXT NOT NULL REFERENCES cases(case_no) ON DELETE CASCADE ON UPDATE CASCADE,
+    position INTEGER NOT NULL,
+    insurer NOT NULL,
+    share,
+    PRIMARY KEY (case_no, position)
+);
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    case_no TEXT NOT NULL REFERENCES cases(case_no) ON DELETE CASCADE ON UPDATE CASCADE,
+    position INTEGER NOT NULL,
+    invoice_no NOT NULL,
+    date_of_invoice, issuing_office, status,
+    total_myr, total_usd, exchange_rate,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS invoice_amounts (
+    invoice_id INTEGER NOT NULL REFERENCES invoices(id) ON DELETE CASCADE,
+    currency TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    insurer NOT NULL,
+    amount,
+    PRIMARY KEY (invoice_id, currency, position)
+);
+CREATE TABLE IF NOT EXISTS verified_payments (
+    invoice_id INTEGER NOT NULL REFERENCES invoices(id) ON DELETE CASCADE,
+    insurer NOT NULL,
+    position INTEGER NOT NULL,
+    received_amount, payment_to, currency, verified TEXT,
+    extra TEXT,
+    PRIMARY KEY (invoice_id, insurer)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+CREATE INDEX IF NOT EXISTS idx_case_insurers_insurer ON case_insurers(insurer);
+CREATE INDEX IF NOT EXISTS idx_invoices_case_no ON invoices(case_no, position);
+CREATE INDEX IF NOT EXISTS idx_invoices_invoice_no ON invoices(invoice_no);
+CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices(status, date_of_invoice);
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices(date_of_invoice);
+CREATE INDEX IF NOT EXISTS idx_invoice_amounts_insurer ON invoice_amounts(currency, insurer);
+CREATE INDEX IF NOT EXISTS idx_verified_payments_insurer ON verified_payments(insurer);
+"""
+
+# Trigram indexes over the searched text columns, so substring searches of
+# case numbers, invoice numbers and insurer names look up the grams instead
+# of scanning every row. Triggers keep them in step with their tables.
+TEXT_INDEXES = {
+    "cases_fts": ("cases", "case_no"),
+    "invoices_fts": ("invoices", "invoice_no"),
+    "invoice_amounts_fts": ("invoice_amounts", "insurer"),
+}
+TEXT_INDEX_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({column}, content='{table}', content_rowid='rowid',
+                                                    tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+    INSERT INTO {fts} (rowid, {column}) VALUES (new.rowid, new.{column});
+END;
+CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+    INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+END;
+CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {column} ON {table} BEGIN
+    INSERT INTO {fts} ({fts}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+    INSERT INTO {fts} (rowid, {column}) VALUES (new.rowid, new.{column});
+END;
+"""
+
+CASE_COLUMNS = {
+    "clients": "clients",
+    "insured": "insured",
+    "case_title": "case_title",
+    "date_of_loss": "date_of_loss",
+}
+INVOICE_COLUMNS = {
+    "invoice_no": "invoice_no",
+    "Date of invoice": "date_of_invoice",
+    "issuing office": "issuing_office",
+    "Status": "status",
+    "Total amount(MYR)": "total_myr",
+    "Total amount(USD)": "total_usd",
+    "exchange rate": "exchange_rate",
+}
+PAYMENT_COLUMNS = {
+    "Received Amount": "received_amount",
+    "Payment to": "payment_to",
+    "currency": "currency",
+}
+CURRENCIES = ("MYR", "USD")
+# Invoices iter_invoices reads (and attaches amounts and payments to) at a time.
+INVOICE_BATCH = 500
+
+
+def _split(record, columns, skip=()):
+    # Known keys go to their column; anything else (or a None value, which
+    # would be indistinguishable from a missing key) is kept in "extra".
+    values = {}
+    extra = {}
+    for key, value in record.items():
+        if key in skip:
+            continue
+        if key in columns and value is not None:
+            values[columns[key]] = value
+        else:
+            extra[key] = value
+    return values, (json.dumps(extra, default=str) if extra else None)
+
+
+def _like_pattern(text):
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _text_filter(fts, rowid, column, query):
+    # (condition, params) keeping the rows whose ``column`` contains ``query``
+    # (case-insensitive); ("", ()) when there is nothing to filter on.
+    if not query:
+        return "", ()
+    if len(query) < MIN_GRAM_QUERY:
+        return f"{column} LIKE ? ESCAPE '\\'", (_like_pattern(query),)
+    return f"{rowid} IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?)", ('"' + query.replace('"', '""') + '"',)
+
+
+def _open_filter(column):
+    # (condition, params) of storage.is_open on a status column: NULL or blank
+    # is Outstanding.
+    return (f"COALESCE(NULLIF({column}, ''), ?) IN ({', '.join('?' * len(OPEN_STATUSES))})",
+            (OUTSTANDING,) + OPEN_STATUSES)
+
+
+def _child_rows(conn, query, order, ids):
+    # Rows of ``query`` (a SELECT from a table keyed by invoice_id) for the
+    # invoices ``ids``, or for every invoice when ``ids`` is None.
+    if ids is None:
+        yield from conn.execute(f"{query} ORDER BY {order}")
+        return
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        yield from conn.execute(f"{query} WHERE invoice_id IN ({','.join('?' * len(chunk))}) ORDER BY {order}",
+                                chunk)
+
+
+def _join(row, columns, extra):
+    record = {}
+    for key, column in columns.items():
+        if row[column] is not None:
+            record[key] = row[column]
+    if extra:
+        record.update(json.loads(extra))
+    return record
+
+
+class SQLiteStore:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        # autocommit mode; writes open their own BEGIN IMMEDIATE transaction
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.executescript(SCHEMA)
+        self._add_missing_columns()
+        self._create_text_indexes()
+        self.lock = threading.RLock()
+        self.version = None
+        self.foreign_changes = []
+        self._data = None
+        self._pool = None
+        self._packed_size = 0
+
+    def _add_missing_columns(self):
+        # databases written before cases carried the version they were last
+        # written at; 0 reads as "before any copy of the book was taken"
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(cases)")}
+        if "version" not in columns:
+            self.conn.execute("ALTER TABLE cases ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _create_text_indexes(self):
+        existing = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for fts, (table, column) in TEXT_INDEXES.items():
+            self.conn.executescript(TEXT_INDEX_SCHEMA.format(fts=fts, table=table, column=column))
+            if fts not in existing:
+                # databases written before the index existed
+                self.conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+    def store_version(self):
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def version_key(self):
+        return self.store_version()
+
+    def refresh(self):
+        if self.version is not None and self.store_version() != self.version:
+            self.foreign_changes = None
+        elif self._data is not None:
+            return self._data
+        return self.load()
+
+    def load(self):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.version = self.store_version()
+                self._pool = array("d")
+                self._data = compact_book(self._load(), self._pool)
+                self._packed_size = len(self._pool)
+                self._data.version = self.version
+                return self._data
+            finally:
+                self.conn.execute("COMMIT")
+
+    def _load(self):
+        data = {}
+        for row in self.conn.execute("SELECT * FROM cases ORDER BY rowid"):
+            case = _join(row, CASE_COLUMNS, row["extra"])
+            case["insurers"] = {}
+            case["invoices"] = []
+            data[row["case_no"]] = case
+        for row in self.conn.execute(
+                "SELECT case_no, insurer, share FROM case_insurers ORDER BY case_no, position"):
+            data[row["case_no"]]["insurers"][row["insurer"]] = row["share"]
+
+        invoices_by_id = {}
+        for row in self.conn.execute("SELECT * FROM invoices ORDER BY case_no, position"):
+            inv = _join(row, INVOICE_COLUMNS, row["extra"])
+            data[row["case_no"]]["invoices"].append(inv)
+            invoices_by_id[row["id"]] = inv
+        self._attach_children(invoices_by_id, whole=True)
+        return data
+
+    def _attach_children(self, invoices_by_id, conn=None, whole=False):
+        # Insurer amounts and verified payments of ``invoices_by_id``, looked
+        # up by invoice id; ``whole`` reads both tables through (every invoice
+        # is being loaded).
+        conn = conn or self.conn
+        ids = None if whole else list(invoices_by_id)
+        for inv in invoices_by_id.values():
+            inv.setdefault("insurer amounts(MYR)", {})
+            inv.setdefault("insurer amounts(USD)", {})
+        for row in _child_rows(conn, "SELECT invoice_id, currency, insurer, amount FROM invoice_amounts",
+                               "invoice_id, currency, position", ids):
+            inv = invoices_by_id.get(row["invoice_id"])
+            if inv is not None:
+                inv.setdefault(f"insurer amounts({row['currency']})", {})[row["insurer"]] = row["amount"]
+        for row in _child_rows(conn, "SELECT * FROM verified_payments", "invoice_id, position", ids):
+            inv = invoices_by_id.get(row["invoice_id"])
+            if inv is None:
+                continue
+            payment = _join(row, PAYMENT_COLUMNS, row["extra"])
+            if row["verified"] is not None:
+                payment["verified"] = json.loads(row["verified"])
+            inv.setdefault("verified_insurers", {})[row["insurer"]] = payment
+
+    def save(self, data, changes=None):
+        # Change records are applied row by row inside one write transaction,
+        # which is the merge: concurrent writers only ever touch the rows of
+        # the cases/invoices they changed. When no other writer committed since
+        # the store's book was loaded, the records are applied to that book as
+        # well (storage.changed_book, as JsonStore does) and the new book is
+        # returned; the caller's ``data`` is never kept. Otherwise returns None
+        # so the cache reloads. Each case row carries the version it was last
+        # written at, for storage.check_base.
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = self.store_version()
+                if changes is None:
+                    self._replace_all(data)
+                    self.conn.execute("UPDATE cases SET version = ?", (current + 1,))
+                else:
+                    base = getattr(data, "version", None)
+                    check_base(base, current, changes, lambda case_nos: self._changed_since(case_nos, base))
+                    for record in changes:
+                        self._apply(record)
+                    touched = {case_no for record in changes
+                               for case_no in (record.get("case_no"), record.get("new_case_no"))
+                               if case_no is not None}
+                    self.conn.executemany("UPDATE cases SET version = ? WHERE case_no = ?",
+                                          [(current + 1, case_no) for case_no in touched])
+                self.conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        up_to_date = current == self.version
+        self.version = current + 1
+        if not up_to_date:
+            self.foreign_changes = None
+            self._data = None
+        elif changes is None:
+            self._pool = array("d")
+            self._data = compact_book(data, self._pool)
+            self._packed_size = len(self._pool)
+        elif self._data is not None:
+            self._data = changed_book(self._data, changes, self._pool)
+            if repack_due(self._pool, self._packed_size):
+                self._data, self._pool = repack_book(self._data)
+                self._packed_size = len(self._pool)
+        if self._data is not None:
+            self._data.version = self.version
+        return self._data
+
+    def _changed_since(self, case_nos, version):
+        case_nos = list(case_nos)
+        changed = []
+        for start in range(0, len(case_nos), 500):
+            chunk = case_nos[start:start + 500]
+            changed.extend(row[0] for row in self.conn.execute(
+                f"SELECT case_no FROM cases WHERE version > ? AND case_no IN ({','.join('?' * len(chunk))})",
+                [version] + chunk))
+        return changed
+
+    def apply(self, changes):
+        # rows only, as JsonStore.apply: the next load reads the book again
+        with self.lock:
+            self._data = None
+            self.save(None, changes)
+
+    def compact(self):
+        with self.lock:
+            self.conn.execute("VACUUM")
+
+    def _replace_all(self, data):
+        self.conn.execute("DELETE FROM cases")
+        for case_no, case in data.items():
+            self._upsert_case(case_no, case)
+            for inv in case.get("invoices", []):
+                self._upsert_invoice(case_no, inv)
+
+    def _apply(self, record):
+        op = record.get("op")
+        case_no = record.get("case_no")
+        if op == "case_upsert":
+            self._upsert_case(case_no, record["case"])
+        elif op == "case_delete":
+            self.conn.execute("DELETE FROM cases WHERE case_no = ?", (case_no,))
+        elif op == "case_rename":
+            self.conn.execute(
+                "UPDATE cases SET case_no = ? WHERE case_no = ? "
+                "AND NOT EXISTS (SELECT 1 FROM cases WHERE case_no = ?)",
+                (record["new_case_no"], case_no, record["new_case_no"]))
+        elif op == "invoice_upsert":
+            self.conn.execute("INSERT OR IGNORE INTO cases (case_no) VALUES (?)", (case_no,))
+            self._upsert_invoice(case_no, record["invoice"])
+        elif op == "invoice_delete":
+            self.conn.execute("DELETE FROM invoices WHERE case_no = ? AND invoice_no = ?",
+                              (case_no, record["invoice_no"]))
+        elif op == "payment_verified":
+            invoice_id = self._invoice_id(case_no, record["invoice_no"])
+            if invoice_id is not None:
+                self._upsert_payment(invoice_id, record["insurer"], record["payment"])
+        elif op == "status_change":
+            # a None status lives in "extra" (see _split); the column wins now
+            self.conn.execute(
+                "UPDATE invoices SET status = ?, extra = NULLIF(json_remove(extra, '$.Status'), '{}') "
+                "WHERE case_no = ? AND invoice_no = ?", (record["status"], case_no, record["invoice_no"]))
+
+    def _upsert_case(self, case_no, case):
+        values, extra = _split(case, CASE_COLUMNS, skip=("insurers", "invoices"))
+        columns = list(CASE_COLUMNS.values())
+        self.conn.execute(
+            f"INSERT INTO cases (case_no, {', '.join(columns)}, extra) "
+            f"VALUES (?, {', '.join('?' for _ in columns)}, ?) "
+            f"ON CONFLICT(case_no) DO UPDATE SET "
+            f"{', '.join(f'{c} = excluded.{c}' for c in columns)}, extra = excluded.extra",
+            [case_no] + [values.get(c) for c in columns] + [extra])
+        self.conn.execute("DELETE FROM case_insurers WHERE case_no = ?", (case_no,))
+        self.conn.executemany(
+            "INSERT INTO case_insurers (case_no, position, insurer, share) VALUES (?, ?, ?, ?)",
+            [(case_no, i, name, share) for i, (name, share) in enumerate(case.get("insurers", {}).items())])
+
+    def _invoice_id(self, case_no, invoice_no):
+        row = self.conn.execute("SELECT id FROM invoices WHERE case_no = ? AND invoice_no = ?",
+                                (case_no, invoice_no)).fetchone()
+        return row["id"] if row else None
+
+    def _upsert_invoice(self, case_no, invoice):
+        skip = ["verified_insurers"] + [f"insurer amounts({c})" for c in CURRENCIES]
+        values, extra = _split(invoice, INVOICE_COLUMNS, skip=skip)
+        columns = list(INVOICE_COLUMNS.values())
+        invoice_id = self._invoice_id(case_no, invoice.get("invoice_no"))
+        if invoice_id is None:
+            position = self.conn.execute(
+                "SELECT COALESCE(MAX(position) + 1, 0) FROM invoices WHERE case_no = ?",
+                (case_no,)).fetchone()[0]
+            invoice_id = self.conn.execute(
+                f"INSERT INTO invoices (case_no, position, {', '.join(columns)}, extra) "
+                f"VALUES (?, ?, {', '.join('?' for _ in columns)}, ?)",
+                [case_no, position] + [values.get(c) for c in columns] + [extra]).lastrowid
+        else:
+            self.conn.execute(
+                f"UPDATE invoices SET {', '.join(f'{c} = ?' for c in columns)}, extra = ? WHERE id = ?",
+                [values.get(c) for c in columns] + [extra, invoice_id])
+            self.conn.execute("DELETE FROM invoice_amounts WHERE invoice_id = ?", (invoice_id,))
+            self.conn.execute("DELETE FROM verified_payments WHERE invoice_id = ?", (invoice_id,))
+
+        rows = []
+        for currency in CURRENCIES:
+            for i, (insurer, amount) in enumerate(invoice.get(f"insurer amounts({currency})", {}).items()):
+                rows.append((invoice_id, currency, i, insurer, amount))
+        self.conn.executemany(
+            "INSERT INTO invoice_amounts (invoice_id, currency, position, insurer, amount) "
+            "VALUES (?, ?, ?, ?, ?)", rows)
+        for insurer, payment in invoice.get("verified_insurers", {}).items():
+            self._upsert_payment(invoice_id, insurer, payment)
+
+    def _upsert_payment(self, invoice_id, insurer, payment):
+        values, extra = _split(payment, PAYMENT_COLUMNS, skip=("verified",))
+        verified = json.dumps(payment["verified"]) if "verified" in payment else None
+        self.conn.execute(
+            "INSERT INTO verified_payments (invoice_id, insurer, position, received_amount, payment_to, "
+            "currency, verified, extra) "
+            "VALUES (?, ?, (SELECT COUNT(*) FROM verified_payments WHERE invoice_id = ?), ?, ?, ?, ?, ?) "
+            "ON CONFLICT(invoice_id, insurer) DO UPDATE SET received_amount = excluded.received_amount, "
+            "payment_to = excluded.payment_to, currency = excluded.currency, "
+            "verified = excluded.verified, extra = excluded.extra",
+            (invoice_id, insurer, invoice_id, values.get("received_amount"), values.get("payment_to"),
+             values.get("currency"), verified, extra))
+
+    def _load_invoices(self, where, params, order="", limit=None, offset=0):
+        invoices_by_id = {}
+        case_nos = []
+        page = ""
+        if limit is not None or offset:
+            page = " LIMIT ? OFFSET ?"
+            params = tuple(params) + (-1 if limit is None else limit, offset)
+        for row in self.conn.execute(
+                f"SELECT invoices.* FROM invoices JOIN cases ON cases.case_no = invoices.case_no "
+                f"{where} ORDER BY {order}cases.rowid, invoices.position{page}",
+                params):
+            invoices_by_id[row["id"]] = _join(row, INVOICE_COLUMNS, row["extra"])
+            case_nos.append(row["case_no"])
+        if invoices_by_id:
+            self._attach_children(invoices_by_id)
+        return list(zip(case_nos, invoices_by_id.values()))
+
+    def invoice_index(self):
+        index = {}
+        for row in self.conn.execute("SELECT case_no FROM cases"):
+            index[row["case_no"]] = set()
+        for row in self.conn.execute("SELECT case_no, invoice_no FROM invoices"):
+            index[row["case_no"]].add(row["invoice_no"])
+        return index
+
+    def locate_invoice(self, invoice_no):
+        # (case_no, index in the case's invoice list) of the first case in book
+        # order holding ``invoice_no``, or None.
+        row = self.conn.execute(
+            "SELECT invoices.case_no, (SELECT COUNT(*) FROM invoices other WHERE other.case_no = invoices.case_no "
+            "AND other.position < invoices.position) AS idx FROM invoices "
+            "JOIN cases ON cases.case_no = invoices.case_no WHERE invoices.invoice_no = ? "
+            "ORDER BY cases.rowid, invoices.position LIMIT 1",
+            (invoice_no,)).fetchone()
+        return (row["case_no"], row["idx"]) if row is not None else None
+
+    def _case_rows(self, rows):
+        # (case_no, details, invoice_count) with each case's insurer shares,
+        # as the JSON store returns them.
+        results = []
+        by_case = {}
+        for row in rows:
+            details = _join(row, CASE_COLUMNS, row["extra"])
+            details["insurers"] = {}
+            by_case[row["case_no"]] = details
+            results.append((row["case_no"], details, row["invoice_count"]))
+        case_nos = list(by_case)
+        for start in range(0, len(case_nos), 500):
+            chunk = case_nos[start:start + 500]
+            for row in self.conn.execute(
+                    f"SELECT case_no, insurer, share FROM case_insurers WHERE case_no IN ({','.join('?' * len(chunk))}) "
+                    "ORDER BY case_no, position", chunk):
+                by_case[row["case_no"]]["insurers"][row["insurer"]] = row["share"]
+        return results
+
+    def _case_filter(self, query):
+        condition, params = _text_filter("cases_fts", "cases.rowid", "case_no", query)
+        return (f"WHERE {condition}" if condition else ""), params
+
+    def search_cases(self, query=""):
+        where, params = self._case_filter(query)
+        return self._case_rows(self.conn.execute(
+            "SELECT cases.*, (SELECT COUNT(*) FROM invoices WHERE invoices.case_no = cases.case_no) "
+            f"AS invoice_count FROM cases {where} ORDER BY rowid",
+            params))
+
+    def page_cases(self, query="", sort=None, descending=False, offset=0, limit=None):
+        where, params = self._case_filter(query)
+        total = self.conn.execute(f"SELECT COUNT(*) FROM cases {where}", params).fetchone()[0]
+        order = ""
+        if sort is not None:
+            if sort not in CASE_SORT_FIELDS:
+                raise ValueError(f"Cannot sort cases by {sort!r}")
+            order = f"{CASE_COLUMNS.get(sort, sort)}{' DESC' if descending else ''}, "
+        rows = self.conn.execute(
+            "SELECT cases.*, (SELECT COUNT(*) FROM invoices WHERE invoices.case_no = cases.case_no) "
+            f"AS invoice_count FROM cases {where} ORDER BY {order}rowid "
+            "LIMIT ? OFFSET ?",
+            params + (-1 if limit is None else limit, offset))
+        return total, self._case_rows(rows)
+
+    def page_invoices(self, status=None, query="", sort=None, descending=False, offset=0, limit=None):
+        conditions, params = [], ()
+        condition, text_params = _text_filter("invoices_fts", "invoices.id", "invoices.invoice_no", query)
+        if condition:
+            conditions.append(condition)
+            params += text_params
+        if status is not None:
+            conditions.append("invoices.status = ?")
+            params += (status,)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        total = self.conn.execute(f"SELECT COUNT(*) FROM invoices {where}", params).fetchone()[0]
+        order = ""
+        if sort is not None:
+            if sort not in INVOICE_SORT_FIELDS:
+                raise ValueError(f"Cannot sort invoices by {sort!r}")
+            order = f"invoices.{INVOICE_COLUMNS.get(sort, sort)}{' DESC' if descending else ''}, "
+        return total, self._load_invoices(where, params, order, limit, offset)
+
+    def iter_invoices(self, status=None):
+        if status is None:
+            return self._stream_invoices("", ())
+        return self._stream_invoices("WHERE invoices.status = ?", (status,))
+
+    def open_invoices(self, fields=None):
+        condition, params = _open_filter("invoices.status")
+        return self._stream_invoices(f"WHERE {condition}", params)
+
+    def _stream_invoices(self, where, params):
+        # (case_no, invoice) read INVOICE_BATCH rows at a time, so an export
+        # never holds every invoice. The rows come from a connection of their
+        # own, whose read transaction keeps them at one version of the store
+        # while writers commit on self.conn.
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN")
+            cursor = conn.execute(
+                f"SELECT invoices.* FROM invoices JOIN cases ON cases.case_no = invoices.case_no "
+                f"{where} ORDER BY cases.rowid, invoices.position", params)
+            while True:
+                rows = cursor.fetchmany(INVOICE_BATCH)
+                if not rows:
+                    break
+                invoices_by_id = {row["id"]: _join(row, INVOICE_COLUMNS, row["extra"]) for row in rows}
+                self._attach_children(invoices_by_id, conn)
+                for row in rows:
+                    yield row["case_no"], invoices_by_id[row["id"]]
+        finally:
+            conn.close()
+
+    def outstanding_shares(self, currency, insurer_keyword=""):
+        condition, params = _text_filter("invoice_amounts_fts", "a.rowid", "a.insurer", insurer_keyword.strip())
+        open_condition, open_params = _open_filter("invoices.status")
+        rows = self.conn.execute(
+            "SELECT invoices.case_no, invoices.invoice_no, a.insurer, a.amount, "
+            "EXISTS (SELECT 1 FROM verified_payments v WHERE v.invoice_id = a.invoice_id "
+            "AND v.insurer = a.insurer) AS verified "
+            "FROM invoice_amounts a JOIN invoices ON invoices.id = a.invoice_id "
+            "JOIN cases ON cases.case_no = invoices.case_no "
+            f"WHERE a.currency = ? AND {open_condition} "
+            f"{f'AND {condition}' if condition else ''} ORDER BY cases.rowid, invoices.position, a.position",
+            (currency,) + open_params + params)
+        for row in rows:
+            yield row["case_no"], row["invoice_no"], row["insurer"], row["amount"], bool(row["verified"])
+
+
+def migrate_json_to_sqlite(json_file=DATA_FILE, db_file=DB_FILE, journal_file=JOURNAL_FILE):
+    data = JsonStore(json_file, journal_file, LOCK_FILE).load()
+    store = SQLiteStore(db_file)
+    store.save(data)
+    invoice_count = sum(len(case.get("invoices", [])) for case in data.values())
+    return len(data), invoice_count
+
+
+if __name__ == "__main__":
+    cases, invoices = migrate_json_to_sqlite(*sys.argv[1:3])
+    print(f"Migrated {cases} cases and {invoices} invoices")
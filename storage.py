@@ -0,0 +1,766 @@
+import json
+import os
+import threading
+from array import array
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import perf
+from book_index import BookIndex
+from records import Book, compact_book, compact_case, json_default, plain_copy, repack_book
+
+DATA_FILE = "cases_data.json"
+JOURNAL_FILE = "cases_data.journal"
+LOCK_FILE = "cases_data.lock"
+DB_FILE = "cases_data.db"
+PARQUET_FILE = "cases_data.parquet.json"
+COMPACT_THRESHOLD = 500
+# A loaded book is moved to a new pool of amounts once its pool has doubled
+# since it was packed (and holds at least this many).
+REPACK_POOL_SIZE = 1 << 16
+
+# Fields the paged case/invoice queries can sort on.
+CASE_SORT_FIELDS = ("case_no", "clients", "insured", "case_title", "date_of_loss", "invoice_count")
+INVOICE_SORT_FIELDS = ("case_no", "invoice_no", "Date of invoice", "issuing office", "Status",
+                       "Total amount(MYR)", "Total amount(USD)", "exchange rate")
+
+# Invoice statuses; an invoice stays open (matchable, aged) until it is Paid.
+OUTSTANDING = "Outstanding"
+PARTIALLY_PAID = "Partially Paid"
+PAID = "Paid"
+INVOICE_STATUSES = (OUTSTANDING, PARTIALLY_PAID, PAID)
+OPEN_STATUSES = (OUTSTANDING, PARTIALLY_PAID)
+
+# "json" keeps the snapshot + journal files, "parquet" the same journal over a
+# Parquet snapshot (PARQUET_FILE manifest), "sqlite" uses DB_FILE.
+BACKEND = os.environ.get("CASES_BACKEND", "json")
+
+_store = None
+_listeners = []
+
+# One parsed book per process, shared by every Streamlit session and reused
+# until the store changes on disk or is written through save_data. A book is
+# never changed once handed out: a save builds the next one (changed_book) and
+# swaps it in, so sessions reading the previous one never see half a change.
+_cache = {"key": None, "data": None}
+_cache_stats = {"hits": 0, "misses": 0}
+_cache_lock = threading.RLock()
+_version = 0
+
+
+class StoreError(Exception):
+    pass
+
+
+class StoreConflict(StoreError):
+    # A save made from a copy of the book older than the store, that would
+    # overwrite a case another writer changed since.
+    pass
+
+
+def invoice_status(inv):
+    # An invoice without a status (or a blank one) is Outstanding.
+    return inv.get("Status") or OUTSTANDING
+
+
+def is_open_status(status):
+    return (status or OUTSTANDING) in OPEN_STATUSES
+
+
+def is_open(inv):
+    # Whether an invoice is still owed money: matched, aged and tracked for
+    # settlement. Every view of what is outstanding uses this test.
+    return is_open_status(inv.get("Status"))
+
+
+def add_listener(listener):
+    # Listeners receive the change records of every save, or None when the
+    # whole book was rewritten.
+    _listeners.append(listener)
+
+
+def _notify(changes):
+    for listener in _listeners:
+        listener(changes)
+
+
+def get_store():
+    global _store
+    if _store is None:
+        if BACKEND == "sqlite":
+            from sqlite_store import SQLiteStore
+            _store = SQLiteStore(DB_FILE)
+        elif BACKEND == "parquet":
+            from parquet_store import ParquetStore
+            _store = ParquetStore(PARQUET_FILE, JOURNAL_FILE, LOCK_FILE)
+        else:
+            _store = JsonStore(DATA_FILE, JOURNAL_FILE, LOCK_FILE)
+    return _store
+
+
+def _drain_foreign_changes(store):
+    # Records written by other processes that the store folded in while
+    # catching up; None means it had to reload the whole book.
+    foreign = store.foreign_changes
+    store.foreign_changes = []
+    if foreign is None or foreign:
+        _notify(foreign)
+
+
+def load_data():
+    global _version
+    store = get_store()
+    with _cache_lock:
+        key = store.version_key()
+        if _cache["data"] is not None and _cache["key"] == key:
+            _cache_stats["hits"] += 1
+            return _cache["data"]
+        _cache_stats["misses"] += 1
+        with perf.span("storage.load"):
+            data = store.refresh()
+        _cache["key"] = key
+        _cache["data"] = data
+        _version += 1
+        _drain_foreign_changes(store)
+        return data
+
+
+def save_data(data, changes=None):
+    # Without a change list the whole book is written out (import, legacy
+    # callers). With one, only the changed records are persisted; if another
+    # operator wrote in the meantime the records are merged onto the latest
+    # book instead of overwriting it.
+    global _version
+    if changes is not None and not changes:
+        return
+    store = get_store()
+    with _cache_lock, perf.span("storage.save"):
+        book = store.save(data, changes)
+        _cache["key"] = store.version_key() if book is not None else None
+        _cache["data"] = book
+        _version += 1
+        _drain_foreign_changes(store)
+    _notify(changes)
+
+
+def changed(changes):
+    # For writes that live outside the store but change what views of the book
+    # show (the payment ledger): bumps the data version, so memoized views are
+    # rebuilt, and passes ``changes`` to the listeners.
+    global _version
+    with _cache_lock:
+        _version += 1
+    _notify(changes)
+
+
+def invalidate_cache():
+    global _version
+    with _cache_lock:
+        _cache["key"] = None
+        _cache["data"] = None
+        _version += 1
+
+
+def data_version():
+    return _version
+
+
+def cache_stats():
+    return dict(_cache_stats, version=_version)
+
+
+def editable_copy(data, *case_nos):
+    # The cached book is shared between sessions, so a page that edits cases
+    # before saving works on a private copy of those cases only; the copy is
+    # what it then passes to save_data. It keeps the version it was read at.
+    data = Book(data, getattr(data, "version", None))
+    for case_no in case_nos:
+        if case_no in data:
+            data[case_no] = plain_copy(data[case_no])
+    return data
+
+
+def apply_changes(changes):
+    # Persist change records without the caller holding the book, e.g. the
+    # streaming importer committing one chunk at a time.
+    if not changes:
+        return
+    store = get_store()
+    with _cache_lock:
+        store.apply(changes)
+        _drain_foreign_changes(store)
+    invalidate_cache()
+    _notify(changes)
+
+
+def compact():
+    with _cache_lock:
+        get_store().compact()
+    invalidate_cache()
+
+
+@contextmanager
+def file_lock(path):
+    # Advisory lock shared by every process writing the store.
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class JsonStore:
+    # cases_data.json is a snapshot of the book; cases_data.journal starts with
+    # a {"op": "base", "version": n} line and every record after it carries its
+    # store version "v". Writers hold the lock file, readers never block: the
+    # book is replaced, not changed, on every write (changed_book). The invoice
+    # index is updated in place, under _index_lock. ``_stamps`` holds the
+    # version each case was last written at since the snapshot was read;
+    # cases not in it were last written at ``_stamp_floor`` or before.
+    def __init__(self, data_file, journal_file, lock_file):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.lock_file = lock_file
+        self.journal_records = 0
+        self.version = 0
+        self.foreign_changes = []
+        self._data = None
+        self._pool = None
+        self._packed_size = 0
+        self._index = None
+        self._index_lock = threading.RLock()
+        self._snapshot_state = None
+        self._journal_id = None
+        self._journal_offset = 0
+        self._stamps = {}
+        self._stamp_floor = 0
+
+    def load(self):
+        self._snapshot_state = _file_state(self.data_file)
+        self._journal_id = _file_id(self.journal_file)
+        self._journal_offset = 0
+        self.journal_records = 0
+        self.version = 0
+        self._stamps = {}
+        self._stamp_floor = 0
+        self._index = None
+        self._pool = array("d")
+        self._data = compact_book(self._read_snapshot(), self._pool)
+        self._packed_size = len(self._pool)
+        self._read_journal_tail()
+        self._data.version = self.version
+        return self._data
+
+    def refresh(self):
+        self._catch_up()
+        return self._data
+
+    def _catch_up(self):
+        if (self._data is None or _file_state(self.data_file) != self._snapshot_state
+                or _file_id(self.journal_file) != self._journal_id
+                or _file_size(self.journal_file) < self._journal_offset):
+            reloaded = self._data is not None
+            self.load()
+            if reloaded:
+                self.foreign_changes = None
+        elif _file_size(self.journal_file) > self._journal_offset:
+            records = self._read_journal_tail()
+            if self.foreign_changes is not None:
+                self.foreign_changes.extend(records)
+
+    def save(self, data, changes=None):
+        with file_lock(self.lock_file):
+            self._catch_up()
+            if changes is None:
+                self._pool = array("d")
+                self._data = compact_book(data, self._pool)
+                self._packed_size = len(self._pool)
+                self._index = None
+                self.version += 1
+                self._data.version = self.version
+                self._stamps = {}
+                self._stamp_floor = self.version
+                self._compact_locked()
+                return self._data
+            base = getattr(data, "version", None)
+            check_base(base, self.version, changes,
+                       lambda case_nos: [case_no for case_no in case_nos
+                                         if self._stamps.get(case_no, self._stamp_floor) > base])
+            # the records are applied to the store's own book, whatever the
+            # caller did to ``data``; applying them twice is harmless
+            return self._write(changes)
+
+    def apply(self, changes):
+        # For writers that do not hold the book (the streaming importer): the
+        # records only go to the journal, and a loaded book is dropped rather
+        # than rebuilt for every chunk; the next load reads it again.
+        with file_lock(self.lock_file):
+            if (_file_id(self.journal_file) != self._journal_id
+                    or _file_size(self.journal_file) < self._journal_offset):
+                # compacted or replaced since: take the versions from the top
+                self._journal_offset = 0
+                self.journal_records = 0
+                self.version = 0
+                self.foreign_changes = None
+            records = self._read_journal_records()
+            if self.foreign_changes is not None:
+                self.foreign_changes.extend(records)
+            self._data = None
+            with self._index_lock:
+                self._index = None
+            self._append(changes)
+
+    def _write(self, changes):
+        # The next book is in place before the append, which may compact it
+        # into the snapshot; a failed append puts the previous one back.
+        previous = self._data
+        self._data = self._changed_book(changes)
+        try:
+            self._append(changes)
+        except BaseException:
+            self._data = previous
+            raise
+        self._data.version = self.version
+        for record in changes:
+            self._update_index(record)
+        return self._data
+
+    def compact(self):
+        with file_lock(self.lock_file):
+            self._catch_up()
+            self._compact_locked()
+
+    def _changed_book(self, records):
+        book = changed_book(self._data, records, self._pool)
+        if repack_due(self._pool, self._packed_size):
+            book, self._pool = repack_book(book)
+            self._packed_size = len(self._pool)
+        return book
+
+    def _stamp(self, record):
+        for case_no in (record.get("case_no"), record.get("new_case_no")):
+            if case_no is not None:
+                self._stamps[case_no] = self.version
+
+    def _append(self, changes):
+        with open(self.journal_file, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() > self._journal_offset:
+                # drop a torn record left by a writer that crashed mid-append
+                f.truncate(self._journal_offset)
+            start = f.tell()
+            if f.tell() == 0:
+                f.write(_journal_line({"op": "base", "version": self.version}))
+            for record in changes:
+                self.version += 1
+                f.write(_journal_line(dict(record, v=self.version)))
+                self._stamp(record)
+            f.flush()
+            os.fsync(f.fileno())
+            self._journal_offset = f.tell()
+        perf.count("storage.journal_bytes", self._journal_offset - start)
+        self._journal_id = _file_id(self.journal_file)
+        self.journal_records += len(changes)
+        if self.journal_records >= COMPACT_THRESHOLD and self._data is not None:
+            self._compact_locked()
+
+    def _compact_locked(self):
+        # Both files are replaced by rename, so a crash leaves either the old
+        # or the new version of each; replaying an old journal over a newer
+        # snapshot is harmless because every record is idempotent.
+        self._write_snapshot()
+        tmp_journal = self.journal_file + ".tmp"
+        with open(tmp_journal, "wb") as f:
+            f.write(_journal_line({"op": "base", "version": self.version}))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        os.replace(tmp_journal, self.journal_file)
+        self._snapshot_state = _file_state(self.data_file)
+        self._journal_id = _file_id(self.journal_file)
+        self._journal_offset = offset
+        self.journal_records = 0
+
+    def _write_snapshot(self):
+        tmp_file = self.data_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self._data, f, indent=4, default=json_default)
+            f.flush()
+            os.fsync(f.fileno())
+            perf.count("storage.snapshot_bytes", f.tell())
+        os.replace(tmp_file, self.data_file)
+
+    def version_key(self):
+        return (_file_state(self.data_file), _file_state(self.journal_file))
+
+    def _book(self):
+        return self._data if self._data is not None else self.load()
+
+    def _book_index(self):
+        # Caller holds _index_lock.
+        if self._index is None:
+            self._index = BookIndex.from_book(self._book())
+        return self._index
+
+    def _update_index(self, record):
+        with self._index_lock:
+            if self._index is not None:
+                self._index.update(self._data, record)
+
+    def locate_invoice(self, invoice_no):
+        with self._index_lock:
+            return self._book_index().locate(invoice_no)
+
+    def invoice_index(self):
+        # Without a loaded book (the streaming importer), read one just for
+        # this rather than keep it.
+        book = self._data if self._data is not None else \
+            type(self)(self.data_file, self.journal_file, self.lock_file).load()
+        return {case_no: {inv.get("invoice_no") for inv in case.get("invoices", [])}
+                for case_no, case in book.items() if isinstance(case, Mapping)}
+
+    def search_cases(self, query=""):
+        book = self._book()
+        with self._index_lock:
+            found = self._book_index().search(query)
+        results = []
+        for case_no in found:
+            details = book.get(case_no)
+            if not isinstance(details, Mapping):
+                continue
+            invoices = details.get("invoices", [])
+            results.append((case_no, details, len(invoices) if isinstance(invoices, list) else 0))
+        return results
+
+    def page_cases(self, query="", sort=None, descending=False, offset=0, limit=None):
+        # (total, rows) for one page of search_cases; sort=None keeps book order.
+        if sort is not None and sort not in CASE_SORT_FIELDS:
+            raise ValueError(f"Cannot sort cases by {sort!r}")
+        rows = self.search_cases(query)
+        perf.count("storage.rows_scanned", len(rows))
+        if sort == "invoice_count":
+            rows.sort(key=lambda row: row[2], reverse=descending)
+        elif sort == "case_no":
+            rows.sort(key=lambda row: sort_key(row[0]), reverse=descending)
+        elif sort is not None:
+            rows.sort(key=lambda row: sort_key(row[1].get(sort)), reverse=descending)
+        return len(rows), _page(rows, offset, limit)
+
+    def page_invoices(self, status=None, query="", sort=None, descending=False, offset=0, limit=None):
+        # (total, [(case_no, invoice)]) for one page of invoices, optionally
+        # filtered by status and an invoice_no substring.
+        if sort is not None and sort not in INVOICE_SORT_FIELDS:
+            raise ValueError(f"Cannot sort invoices by {sort!r}")
+        query = query.lower()
+        rows = [(case_no, inv) for case_no, inv in self.iter_invoices(status)
+                if not query or query in str(inv.get("invoice_no", "")).lower()]
+        perf.count("storage.rows_scanned", len(rows))
+        if sort == "case_no":
+            rows.sort(key=lambda row: sort_key(row[0]), reverse=descending)
+        elif sort is not None:
+            rows.sort(key=lambda row: sort_key(row[1].get(sort)), reverse=descending)
+        return len(rows), _page(rows, offset, limit)
+
+    def iter_invoices(self, status=None):
+        for case_no, case_data in self._book().items():
+            for inv in case_data.get("invoices", []):
+                if status is None or inv.get("Status") == status:
+                    yield case_no, inv
+
+    def open_invoices(self, fields=None):
+        # ``fields``: the invoice keys the caller reads. Stores that read
+        # columns (ParquetStore) leave the others out; this one has them all.
+        for case_no, case_data in self._book().items():
+            for inv in case_data.get("invoices", []):
+                if is_open(inv):
+                    yield case_no, inv
+
+    def outstanding_shares(self, currency, insurer_keyword=""):
+        amount_field = f"insurer amounts({currency})"
+        keyword = insurer_keyword.strip().lower()
+        for case_no, case_data in self._book().items():
+            for inv in case_data.get("invoices", []):
+                if not is_open(inv):
+                    continue
+                verified = inv.get("verified_insurers", {})
+                for insurer, amount in inv.get(amount_field, {}).items():
+                    if keyword in insurer.lower():
+                        yield case_no, inv.get("invoice_no"), insurer, amount, insurer in verified
+
+    def _read_snapshot(self):
+        try:
+            with open(self.data_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            raise StoreError(f"{self.data_file} is not valid JSON: {e}")
+
+    def _read_journal_tail(self):
+        records = self._read_journal_records()
+        if records:
+            self._data = self._changed_book(records)
+            self._data.version = self.version
+            for record in records:
+                self._update_index(record)
+        return records
+
+    def _read_journal_records(self):
+        # Records appended since ``_journal_offset``, moving it and the
+        # version past them.
+        try:
+            with open(self.journal_file, "rb") as f:
+                f.seek(self._journal_offset)
+                chunk = f.read()
+        except FileNotFoundError:
+            return []
+        # only complete lines; a partial last line is still being written
+        end = chunk.rfind(b"\n") + 1
+        records = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("op") == "base":
+                self.version = max(self.version, record.get("version", 0))
+                self._stamp_floor = self.version
+                continue
+            self.version = record.get("v", self.version + 1)
+            self.journal_records += 1
+            self._stamp(record)
+            records.append(record)
+        self._journal_offset += end
+        return records
+
+
+def _journal_line(record):
+    return (json.dumps(record, default=json_default, separators=(",", ":")) + "\n").encode()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _file_id(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def case_upsert(case_no, case):
+    header = {k: v for k, v in case.items() if k != "invoices"}
+    return {"op": "case_upsert", "case_no": case_no, "case": header}
+
+
+def case_delete(case_no):
+    return {"op": "case_delete", "case_no": case_no}
+
+
+def case_rename(old_case_no, new_case_no):
+    return {"op": "case_rename", "case_no": old_case_no, "new_case_no": new_case_no}
+
+
+def invoice_upsert(case_no, invoice):
+    return {"op": "invoice_upsert", "case_no": case_no, "invoice": invoice}
+
+
+def invoice_delete(case_no, invoice_no):
+    return {"op": "invoice_delete", "case_no": case_no, "invoice_no": invoice_no}
+
+
+def payment_verified(case_no, invoice_no, insurer, payment):
+    return {"op": "payment_verified", "case_no": case_no, "invoice_no": invoice_no,
+            "insurer": insurer, "payment": payment}
+
+
+def status_change(case_no, invoice_no, status):
+    # Only the Status field, so the rest of the invoice (verifications in
+    # particular) is whatever the store holds when the record is applied.
+    # Settlement emits these; it only moves open invoices, possibly to Paid.
+    return {"op": "status_change", "case_no": case_no, "invoice_no": invoice_no, "status": status}
+
+
+# Records that write a whole case header or invoice rather than merge into it.
+REPLACING_OPS = ("case_upsert", "invoice_upsert")
+
+
+def check_base(base, version, changes, changed_since):
+    # Raises StoreConflict when ``changes``, made on a copy of the book read
+    # at version ``base``, would replace a case that was written after it;
+    # ``changed_since(case_nos)`` lists those of ``case_nos`` that were.
+    # Books of unknown version (plain dicts) are merged as before.
+    if base is None or base >= version:
+        return
+    changed = changed_since({record["case_no"] for record in changes if record.get("op") in REPLACING_OPS})
+    if changed:
+        raise StoreConflict(f"Case {', '.join(map(str, sorted(changed, key=str)))} was changed by someone else "
+                            f"since it was opened; reload and try again.")
+
+
+def dispatch_change(index, record):
+    # Routes one change record to an in-memory index kept in sync with the
+    # store (payment matcher, aging aggregates, ...).
+    op = record.get("op")
+    case_no = record.get("case_no")
+    if op == "invoice_upsert":
+        index.refresh_invoice(case_no, record["invoice"])
+    elif op == "invoice_delete":
+        index.remove_invoice(case_no, record["invoice_no"])
+    elif op == "payment_verified":
+        index.verify(case_no, record["invoice_no"], record["insurer"])
+    elif op == "status_change":
+        index.set_status(case_no, record["invoice_no"], record["status"])
+    elif op == "case_delete":
+        index.remove_case(case_no)
+    elif op == "case_rename":
+        index.rename_case(case_no, record["new_case_no"])
+
+
+def sort_key(value):
+    # Orders mixed values the way SQLite orders an untyped column: missing
+    # values, then numbers, then text.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+def _page(rows, offset, limit):
+    return rows[offset:] if limit is None else rows[offset:offset + limit]
+
+
+def invoice_position(data, case_no, invoice_no):
+    # Position of an invoice in data[case_no]["invoices"] from the store's
+    # invoice index; only a working copy that differs from the store falls
+    # back to scanning its case.
+    invoices = data.get(case_no, {}).get("invoices", [])
+    located = get_store().locate_invoice(invoice_no)
+    if located is not None and located[0] == case_no:
+        position = located[1]
+        if position < len(invoices) and invoices[position].get("invoice_no") == invoice_no:
+            return position
+    for position, inv in enumerate(invoices):
+        if inv.get("invoice_no") == invoice_no:
+            return position
+    return None
+
+
+def lookup_invoice(data, case_no, invoice_no):
+    position = invoice_position(data, case_no, invoice_no)
+    return None if position is None else data[case_no]["invoices"][position]
+
+
+def find_invoice(data, case_no, invoice_no):
+    for inv in data.get(case_no, {}).get("invoices", []):
+        if inv.get("invoice_no") == invoice_no:
+            return inv
+    return None
+
+
+def changed_book(data, changes, pool=None):
+    # The book after ``changes``, built copy-on-write: each case they touch is
+    # copied, changed and compacted again (into ``pool``); every other case is
+    # shared with ``data``, which is left exactly as it was.
+    data = Book(data, getattr(data, "version", None))
+    touched = {}
+    for record in changes:
+        for case_no in (record.get("case_no"), record.get("new_case_no")):
+            if case_no is not None and case_no not in touched:
+                touched[case_no] = True
+                if case_no in data:
+                    data[case_no] = plain_copy(data[case_no])
+        apply_change(data, record)
+    for case_no in touched:
+        if case_no in data:
+            data[case_no] = compact_case(data[case_no], pool)
+    return data
+
+
+def repack_due(pool, packed_size):
+    # Whether most of a pool may be amounts of cases that changed_book has
+    # replaced since it was packed with ``packed_size`` of them.
+    return len(pool) > max(2 * packed_size, REPACK_POOL_SIZE)
+
+
+def apply_change(data, record):
+    # Every operation is idempotent so replaying a journal over a snapshot
+    # that already contains some of its records gives the same book.
+    op = record.get("op")
+    case_no = record.get("case_no")
+
+    if op == "case_upsert":
+        case = dict(record["case"])
+        case["invoices"] = data.get(case_no, {}).get("invoices", [])
+        data[case_no] = case
+
+    elif op == "case_delete":
+        data.pop(case_no, None)
+
+    elif op == "case_rename":
+        new_case_no = record["new_case_no"]
+        if case_no in data and new_case_no not in data:
+            # the case keeps its place in the book, as its SQLite row does
+            cases = list(data.items())
+            data.clear()
+            data.update((new_case_no if key == case_no else key, case) for key, case in cases)
+
+    elif op == "invoice_upsert":
+        invoice = record["invoice"]
+        invoices = data.setdefault(case_no, {"invoices": []}).setdefault("invoices", [])
+        for i, inv in enumerate(invoices):
+            if inv.get("invoice_no") == invoice.get("invoice_no"):
+                invoices[i] = invoice
+                break
+        else:
+            invoices.append(invoice)
+
+    elif op == "invoice_delete":
+        if case_no in data:
+            data[case_no]["invoices"] = [
+                inv for inv in data[case_no].get("invoices", [])
+                if inv.get("invoice_no") != record["invoice_no"]
+            ]
+
+    elif op == "payment_verified":
+        inv = find_invoice(data, case_no, record["invoice_no"])
+        if inv is not None:
+            inv.setdefault("verified_insurers", {})[record["insurer"]] = record["payment"]
+
+    elif op == "status_change":
+        inv = find_invoice(data, case_no, record["invoice_no"])
+        if inv is not None:
+            inv["Status"] = record["status"]
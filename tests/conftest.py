@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def book_dir(tmp_path, monkeypatch):
+    # A fresh JSON book in tmp_path, with every process-wide cache and index
+    # dropped so nothing leaks between tests.
+    import aging
+    import insurers
+    import ledger
+    import matching
+    import memo
+    import settlement
+    import storage
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(storage, "BACKEND", "json")
+    monkeypatch.setattr(storage, "_store", None)
+    for module, name in ((aging, "_aging"), (insurers, "_registry"), (ledger, "_ledger"),
+                         (matching, "_matcher"), (settlement, "_tracker")):
+        monkeypatch.setattr(module, name, None)
+    storage.invalidate_cache()
+    memo.clear()
+    return tmp_path
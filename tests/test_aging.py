@@ -0,0 +1,36 @@
+import json
+from datetime import date
+
+import pytest
+
+import storage
+from aging import aging_report
+
+
+def invoice(invoice_no, myr, usd=None):
+    return {"invoice_no": invoice_no, "Date of invoice": "2026-09-01", "Status": "Outstanding",
+            "issuing office": "ABL KL", "Total amount(MYR)": sum(myr.values()),
+            "Total amount(USD)": sum(usd.values()) if usd else None, "exchange rate": 4.0 if usd else None,
+            "insurer amounts(MYR)": myr, "insurer amounts(USD)": usd or {}}
+
+
+def test_reporting_currency_adds_up_every_currency_once(book_dir):
+    book = {"C1": {"clients": "Broker", "insured": "Insured", "case_title": "Title", "date_of_loss": "2026-01-01",
+                   "insurers": {"AXA": 60.0, "Allianz": 40.0},
+                   "invoices": [invoice("USD-1", {"AXA": 240.0, "Allianz": 160.0}, {"AXA": 60.0, "Allianz": 40.0}),
+                                invoice("MYR-1", {"AXA": 300.0})]}}
+    with open(storage.DATA_FILE, "w") as f:
+        json.dump(book, f)
+    with open("fx_rates.csv", "w") as f:
+        f.write("date,currency,rate\n2026-01-01,USD,4.0\n")
+    today = date(2026, 10, 1)
+
+    buckets, summary = aging_report(reference_date=today, reporting="MYR")
+    # the USD invoice counts once (its MYR amounts follow from the USD ones)
+    assert buckets[0][2] == {"MYR": 700.0}
+    assert {row["Insurer"]: row["Total outstanding"] for row in summary} == {"AXA": 540.0, "Allianz": 160.0}
+
+    buckets, summary = aging_report(reference_date=today, reporting="USD")
+    assert buckets[0][2] == {"USD": pytest.approx(175.0)}
+    assert {row["Insurer"]: row["Total outstanding"] for row in summary} == {"AXA": 135.0, "Allianz": 40.0}
+    assert all(row["Currency"] == "USD" for row in summary)
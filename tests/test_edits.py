@@ -0,0 +1,62 @@
+import pytest
+
+import bench
+import storage
+from importer import import_workbook, sync_workbook
+from records import plain_copy
+from reconcile import reconcile
+from settlement import settle_pending
+
+
+@pytest.fixture
+def sqlite_book(book_dir, monkeypatch):
+    # SQLite saves swap in a new cached book and never rebuild it from a
+    # journal, so any in-place edit of the shared book by the code under test
+    # shows up.
+    monkeypatch.setattr(storage, "BACKEND", "sqlite")
+    return book_dir
+
+
+def sample_book():
+    return bench.generate_book(20, 2, 4, seed=1)
+
+
+def test_import_and_sync_leave_the_shared_book_alone(sqlite_book):
+    book = sample_book()
+    bench.write_workbook(book, "book.xlsx")
+    import_workbook("book.xlsx", storage.load_data(), 1)
+    shared = storage.load_data()
+    before = plain_copy(shared)
+
+    case_no = next(iter(book))
+    book[case_no]["case_title"] = "Changed title"
+    book[case_no]["invoices"][0]["Status"] = "Paid"
+    bench.write_workbook(book, "book.xlsx")
+    stats = sync_workbook("book.xlsx", shared, 1)
+
+    assert stats["cases_updated"] == 1 and stats["invoices_updated"] == 1
+    assert plain_copy(shared) == before
+    synced = storage.load_data()
+    assert synced[case_no]["case_title"] == "Changed title"
+    assert synced[case_no]["invoices"][0]["Status"] == "Paid"
+
+
+def test_reconcile_and_settle_leave_the_shared_book_alone(sqlite_book):
+    storage.save_data(sample_book())
+    shared = storage.load_data()
+    before = plain_copy(shared)
+    case_no, inv = next((case_no, inv) for case_no, case in shared.items() for inv in case["invoices"]
+                        if inv.get("Status") == "Outstanding" and inv["insurer amounts(USD)"])
+    insurer, amount = next(iter(inv["insurer amounts(USD)"].items()))
+    with open("statement.csv", "w") as f:
+        f.write(f"insurer,amount,currency,bank\n{insurer},{amount},USD,SXP\n")
+
+    summary, report = reconcile(shared, "statement.csv")
+    data, changes = settle_pending(storage.load_data())
+    storage.save_data(data, changes)
+
+    assert summary["matched"] + summary["ambiguous"] == 1
+    assert plain_copy(shared) == before
+    matched = report[0]
+    verified = storage.lookup_invoice(storage.load_data(), matched["case_no"], matched["invoice_no"])
+    assert matched["matched_insurer"] in verified["verified_insurers"]
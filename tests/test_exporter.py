@@ -0,0 +1,38 @@
+import json
+
+import pytest
+
+import bench
+import exporter
+import storage
+from importer import import_workbook
+from records import json_default
+
+
+def by_invoice_no(book):
+    return {case_no: dict(case, invoices={inv["invoice_no"]: inv for inv in case["invoices"]})
+            for case_no, case in json.loads(json.dumps(book, default=json_default)).items()}
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_exported_pack_imports_back_to_the_same_book(book_dir, monkeypatch, backend):
+    monkeypatch.setattr(storage, "BACKEND", backend)
+    book = bench.generate_book(40, 2, 6, seed=4)
+    book["ABL-X"] = {"clients": "c", "insured": "i", "case_title": "t", "date_of_loss": "01-Jan-2024",
+                     "insurers": {"Lloyd's": 60.0, "AXA": 40.0}, "invoices": []}
+    storage.save_data(book)
+    # chunks smaller than the book, so rows are streamed in several batches
+    monkeypatch.setattr("sqlite_store.INVOICE_BATCH", 7)
+    result = exporter.export(str(book_dir / "pack.xlsx"), chunk_size=10)
+    assert result["rows"]["invoices"] == sum(len(case["invoices"]) for case in book.values())
+
+    restored = book_dir / "restored"
+    restored.mkdir()
+    monkeypatch.chdir(restored)
+    monkeypatch.setattr(storage, "_store", None)
+    storage.invalidate_cache()
+    storage._notify(None)
+    stats = import_workbook(str(book_dir / "pack.xlsx"), {}, 1)
+
+    assert stats["cases_added"] == len(book) and not stats["duplicate_invoices"]
+    assert by_invoice_no(storage.load_data()) == by_invoice_no(book)
@@ -0,0 +1,29 @@
+import bench
+import storage
+from importer import import_workers, stream_import
+
+
+def test_stream_import_commits_chunks_without_keeping_the_book(book_dir):
+    book = bench.generate_book(30, 2, 4, seed=2)
+    bench.write_workbook(book, "book.xlsx")
+    storage.save_data({})
+    storage.load_data()
+
+    chunks = []
+    stats = stream_import("book.xlsx", chunk_size=10, progress=lambda *args: chunks.append(args[1]))
+
+    assert len(chunks) > 1
+    assert storage.get_store()._data is None
+    loaded = storage.load_data()
+    # the workbook has a row per invoice, so cases without one are not in it
+    assert list(loaded) == [case_no for case_no, case in book.items() if case["invoices"]]
+    assert stats["invoices_added"] == sum(len(case["invoices"]) for case in book.values())
+    assert {case_no: [inv["invoice_no"] for inv in case["invoices"]] for case_no, case in loaded.items()} == \
+        {case_no: [inv["invoice_no"] for inv in book[case_no]["invoices"]] for case_no in loaded}
+
+
+def test_import_workers_falls_back_to_one(monkeypatch):
+    monkeypatch.setenv("IMPORT_WORKERS", "four")
+    assert import_workers() == 1
+    monkeypatch.setenv("IMPORT_WORKERS", "0")
+    assert import_workers() == 0
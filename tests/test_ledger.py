@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+import aging
+import matching
+import memo
+import storage
+from ledger import backfill, get_ledger, missing_receipts
+from settlement import record_payment
+
+
+def write_book(verified=None):
+    inv = {"invoice_no": "I1", "Date of invoice": "2026-09-01", "Status": "Outstanding", "issuing office": "ABL KL",
+           "Total amount(MYR)": 420.0, "Total amount(USD)": 100.0, "exchange rate": 4.2,
+           "insurer amounts(MYR)": {"AXA": 252.0, "Allianz": 168.0},
+           "insurer amounts(USD)": {"AXA": 60.0, "Allianz": 40.0}}
+    if verified:
+        inv["verified_insurers"] = verified
+    book = {"C1": {"clients": "Broker", "insured": "Insured", "case_title": "Title", "date_of_loss": "2026-01-01",
+                   "insurers": {"AXA": 60.0, "Allianz": 40.0}, "invoices": [inv]}}
+    with open(storage.DATA_FILE, "w") as f:
+        json.dump(book, f)
+
+
+def pay(insurer, amount):
+    data = storage.editable_copy(storage.load_data(), "C1")
+    inv = storage.lookup_invoice(data, "C1", "I1")
+    changes = record_payment("C1", inv, insurer, {"Received Amount": amount, "Payment to": "SXP", "currency": "USD"})
+    storage.save_data(data, changes)
+
+
+def invoice():
+    return storage.lookup_invoice(storage.load_data(), "C1", "I1")
+
+
+def outstanding(insurer):
+    rows = aging.get_aging().insurer_summary()
+    return next((row["Total outstanding"] for row in rows if row["Insurer"] == insurer and row["Currency"] == "USD"),
+                0)
+
+
+def test_short_paid_share_stays_open_at_its_balance(book_dir):
+    write_book()
+    matcher = matching.get_matcher()
+    aging.get_aging()
+
+    pay("AXA", 20.0)
+    assert invoice()["Status"] == storage.PARTIALLY_PAID
+    assert matcher.match("USD", "AXA", 40.0)[0] == [("C1", "I1", "AXA", 40.0)]
+    assert outstanding("AXA") == 40.0
+    # rebuilt from the store, the indexes agree with the incremental ones
+    assert matching.PaymentMatcher.from_store(storage.get_store()).match("USD", "AXA", 40.0)[0]
+    assert aging.AgingAggregates.from_store(storage.get_store()).insurer_summary() == \
+        aging.get_aging().insurer_summary()
+
+    pay("AXA", 40.0)
+    assert invoice()["verified_insurers"]["AXA"]["Received Amount"] == 60.0
+    assert matcher.match("USD", "AXA", 40.0) == ([], [])
+    assert outstanding("AXA") == 0
+    pay("Allianz", 40.0)
+    assert invoice()["Status"] == storage.PAID
+
+
+def test_receipt_recorded_again_after_a_failed_save_counts_once(book_dir, monkeypatch):
+    write_book()
+    store = storage.get_store()
+    save = store.save
+
+    def failing_save(data, changes=None):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(store, "save", failing_save)
+    with pytest.raises(OSError):
+        pay("AXA", 20.0)
+    assert "verified_insurers" not in invoice()
+    monkeypatch.setattr(store, "save", save)
+
+    pay("AXA", 20.0)
+    payments = get_ledger()
+    assert len(payments.receipts) == 1
+    assert payments.paid_cents("I1", "USD", "AXA") == 2000
+    assert invoice()["verified_insurers"]["AXA"]["Received Amount"] == 20.0
+    assert backfill(storage.load_data()) == 0
+
+    # the next payment of the share is a new receipt
+    pay("AXA", 20.0)
+    assert payments.paid_cents("I1", "USD", "AXA") == 4000
+    assert invoice()["verified_insurers"]["AXA"]["Received Amount"] == 40.0
+
+
+def test_backfill_appends_each_book_payment_once(book_dir):
+    write_book({"AXA": {"Received Amount": 60.0, "Payment to": "SXP", "currency": "USD", "verified": True}})
+    payments = get_ledger()
+    # two writers working out the missing receipts before either appends
+    first, second = missing_receipts(payments, storage.load_data()), missing_receipts(payments, storage.load_data())
+    assert len(payments.append(first)) == 1
+    assert payments.append(second) == []
+    assert payments.paid_cents("I1", "USD", "AXA") == 6000
+
+
+def test_backfilled_short_payment_shows_what_is_still_owed(book_dir):
+    write_book({"AXA": {"Received Amount": 20.0, "Payment to": "SXP", "currency": "USD", "verified": True}})
+    matcher = matching.get_matcher()
+    # verified before the ledger: nothing left to receive until it is backfilled
+    assert outstanding("AXA") == 0
+    assert memo.outstanding()[1] == aging.aging_report()[1]
+
+    assert backfill(storage.load_data()) == 1
+    assert matcher.match("USD", "AXA", 40.0)[0] == [("C1", "I1", "AXA", 40.0)]
+    assert outstanding("AXA") == 40.0
+    assert memo.outstanding()[1] == aging.aging_report()[1]
+
+
+def test_verifications_from_copies_read_before_each_other_both_count(book_dir):
+    write_book()
+    first = storage.editable_copy(storage.load_data(), "C1")
+    second = storage.editable_copy(storage.load_data(), "C1")
+    payment = {"Received Amount": 60.0, "Payment to": "SXP", "currency": "USD"}
+    storage.save_data(first, record_payment("C1", storage.lookup_invoice(first, "C1", "I1"), "AXA", payment))
+    payment = dict(payment, **{"Received Amount": 40.0})
+    storage.save_data(second, record_payment("C1", storage.lookup_invoice(second, "C1", "I1"), "Allianz", payment))
+
+    assert set(invoice()["verified_insurers"]) == {"AXA", "Allianz"}
+    assert invoice()["Status"] == storage.PAID
@@ -0,0 +1,81 @@
+import random
+
+import pytest
+
+import aging
+import bench
+import matching
+import settlement
+import storage
+from money import to_cents
+
+
+def invoice(invoice_no, status, usd=100.0):
+    inv = {"invoice_no": invoice_no, "Date of invoice": "2026-09-01", "issuing office": "ABL KL",
+           "Total amount(MYR)": usd * 4.2, "Total amount(USD)": usd, "exchange rate": 4.2,
+           "insurer amounts(MYR)": {"AXA": usd * 4.2}, "insurer amounts(USD)": {"AXA": usd}}
+    if status is not storage.OUTSTANDING:
+        inv["Status"] = status
+    return inv
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request, book_dir, monkeypatch):
+    monkeypatch.setattr(storage, "BACKEND", request.param)
+    return request.param
+
+
+def test_views_agree_on_what_is_open(backend):
+    # no Status, a blank one, Outstanding and Paid
+    invoices = [invoice("I1", storage.OUTSTANDING, 10.0), invoice("I2", "", 20.0),
+                invoice("I3", "Outstanding", 30.0), invoice("I4", storage.PAID, 40.0)]
+    storage.save_data({"C1": {"clients": "Broker", "insurers": {"AXA": 100.0}, "invoices": invoices}})
+    is_open = {inv["invoice_no"]: storage.is_open(inv) for inv in invoices}
+    assert is_open == {"I1": True, "I2": True, "I3": True, "I4": False}
+
+    store = storage.get_store()
+    assert [inv["invoice_no"] for _, inv in store.open_invoices()] == ["I1", "I2", "I3"]
+    matched = {invoice_no for _, invoice_no, _, _, _ in store.outstanding_shares("USD")}
+    aged = {invoice_no for _, invoice_no in aging.get_aging().contributions}
+    tracked = {invoice_no for _, invoice_no in settlement.get_tracker().stored}
+    assert matched == aged == tracked == {"I1", "I2", "I3"}
+    for amount in (10.0, 20.0, 30.0):
+        assert matching.get_matcher().match("USD", "AXA", amount)[0]
+    assert matching.get_matcher().match("USD", "AXA", 40.0) == ([], [])
+
+
+def baseline_match(book, currency, keyword, amount):
+    # The scan the payment page used to run: every unverified share of an open
+    # invoice whose insurer contains the keyword, exact to the cent or (USD)
+    # at most USD_CLOSE_MATCH_WINDOW above the received amount. Compared in
+    # cents: its float tolerance took a share a cent off for an exact match.
+    exact, close = [], []
+    for case_no, case in book.items():
+        for inv in case["invoices"]:
+            if not storage.is_open(inv):
+                continue
+            for insurer, share in inv[f"insurer amounts({currency})"].items():
+                if keyword.lower() not in insurer.lower() or insurer in inv.get("verified_insurers", {}):
+                    continue
+                ref = (case_no, inv["invoice_no"], insurer, share)
+                above = to_cents(share) - to_cents(amount)
+                if above == 0:
+                    exact.append(ref)
+                elif currency == "USD" and 0 < above <= matching.USD_CLOSE_MATCH_WINDOW * 100:
+                    close.append(ref)
+    matched = {(case_no, invoice_no) for case_no, invoice_no, _, _ in exact}
+    return exact, [ref for ref in close if ref[:2] not in matched]
+
+
+def test_matcher_finds_what_the_scan_of_the_book_finds(book_dir):
+    book = bench.generate_book(150, 3, 8, seed=2)
+    storage.save_data(book)
+    matcher = matching.get_matcher()
+    rng = random.Random(2)
+    for currency in ("USD", "MYR"):
+        shares = [(insurer, amount) for case in book.values() for inv in case["invoices"]
+                  for insurer, amount in inv[f"insurer amounts({currency})"].items()]
+        for insurer, amount in rng.sample(shares, 25):
+            keyword = " ".join(insurer.split()[:2])
+            for received in (amount, round(amount - 12.5, 2), round(amount + 0.01, 2)):
+                assert matcher.match(currency, keyword, received) == baseline_match(book, currency, keyword, received)
@@ -0,0 +1,33 @@
+import random
+
+from money import allocate, equal_shares, split_amount, to_cents
+
+
+def test_allocate_adds_up_to_the_total():
+    rng = random.Random(3)
+    for _ in range(500):
+        total = rng.randint(0, 10 ** 7)
+        weights = [rng.choice((rng.uniform(0, 100), rng.randint(1, 3), 33.33)) for _ in range(rng.randint(1, 8))]
+        parts = allocate(total, weights)
+        assert sum(parts) == total
+        # every part is within a cent of its exact share
+        exact = [total * weight / sum(weights) for weight in weights]
+        assert all(abs(part - value) < 1 + 1e-6 for part, value in zip(parts, exact))
+
+
+def test_allocate_gives_remainders_to_the_largest_fractions_first():
+    assert allocate(100, [1, 1, 1]) == [34, 33, 33]
+    assert allocate(10, [0.5, 0.3, 0.2]) == [5, 3, 2]
+    assert allocate(7, [2, 5]) == [2, 5]
+    assert allocate(5, [0, 0]) == [0, 0]
+
+
+def test_split_matches_the_invoice_total_to_the_cent():
+    rng = random.Random(8)
+    for _ in range(200):
+        amount = round(rng.uniform(0.01, 10 ** 6), 2)
+        count = rng.randint(1, 7)
+        shares = dict(zip((f"Insurer {i}" for i in range(count)), equal_shares(count)))
+        split = split_amount(amount, shares)
+        assert sum(to_cents(value) for value in split.values()) == to_cents(amount)
+    assert sum(to_cents(share) for share in equal_shares(3)) == 100 * 100
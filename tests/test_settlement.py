@@ -0,0 +1,41 @@
+import storage
+from settlement import record_payment
+
+
+def write_book():
+    inv = {"invoice_no": "I1", "Date of invoice": "2026-09-01", "Status": "Outstanding", "issuing office": "ABL KL",
+           "Total amount(MYR)": 420.0, "Total amount(USD)": 100.0, "exchange rate": 4.2,
+           "insurer amounts(MYR)": {"AXA": 252.0, "Allianz": 168.0},
+           "insurer amounts(USD)": {"AXA": 60.0, "Allianz": 40.0}}
+    storage.save_data({"C1": {"clients": "Broker", "insurers": {"AXA": 60.0, "Allianz": 40.0}, "invoices": [inv]}})
+
+
+def pay(insurer, amount):
+    # Saves one payment and returns the change records it was saved with.
+    data = storage.editable_copy(storage.load_data(), "C1")
+    inv = storage.lookup_invoice(data, "C1", "I1")
+    changes = record_payment("C1", inv, insurer, {"Received Amount": amount, "Payment to": "SXP", "currency": "USD"})
+    storage.save_data(data, changes)
+    return [(record["op"], record.get("status")) for record in changes]
+
+
+def status():
+    return storage.lookup_invoice(storage.load_data(), "C1", "I1")["Status"]
+
+
+def test_verifying_shares_moves_the_status_through_to_paid(book_dir):
+    write_book()
+    # one share paid in full, the other still unverified: no change
+    assert pay("AXA", 60.0) == [("payment_verified", None)]
+    assert status() == storage.OUTSTANDING
+    # the other paid short
+    assert pay("Allianz", 15.0) == [("payment_verified", None), ("status_change", storage.PARTIALLY_PAID)]
+    assert status() == storage.PARTIALLY_PAID
+    # still short after a second receipt
+    assert pay("Allianz", 15.0) == [("payment_verified", None)]
+    assert status() == storage.PARTIALLY_PAID
+    # the rest of it settles the invoice
+    assert pay("Allianz", 10.0) == [("payment_verified", None), ("status_change", storage.PAID)]
+    assert status() == storage.PAID
+    inv = storage.lookup_invoice(storage.load_data(), "C1", "I1")
+    assert inv["verified_insurers"]["Allianz"]["Received Amount"] == 40.0
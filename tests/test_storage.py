@@ -0,0 +1,193 @@
+import json
+
+import pytest
+
+import storage
+from records import InvoiceRecord, plain_copy
+from sqlite_store import SQLiteStore
+from storage import (JsonStore, StoreConflict, case_rename, case_upsert, editable_copy, invoice_upsert,
+                     payment_verified, status_change)
+
+
+def make_case(insurers=None):
+    return {"clients": "Broker", "insured": "Insured", "case_title": "Title", "date_of_loss": "2026-01-01",
+            "insurers": insurers or {"AXA": 60.0, "Allianz": 40.0}, "invoices": []}
+
+
+def make_invoice(invoice_no, usd=100.0):
+    return {"invoice_no": invoice_no, "Date of invoice": "2026-09-01", "Status": "Outstanding",
+            "issuing office": "ABL KL", "Total amount(MYR)": usd * 4.2, "Total amount(USD)": usd,
+            "exchange rate": 4.2, "insurer amounts(MYR)": {"AXA": usd * 2.52, "Allianz": usd * 1.68},
+            "insurer amounts(USD)": {"AXA": usd * 0.6, "Allianz": usd * 0.4}}
+
+
+def json_store(path):
+    return JsonStore(str(path / "cases.json"), str(path / "cases.journal"), str(path / "cases.lock"))
+
+
+def sqlite_store(path):
+    return SQLiteStore(str(path / "cases.db"))
+
+
+@pytest.fixture(params=[json_store, sqlite_store], ids=["json", "sqlite"])
+def open_store(request, tmp_path):
+    return lambda: request.param(tmp_path)
+
+
+def seed(store):
+    store.save({"C1": make_case(), "C2": make_case()})
+
+
+def test_journal_replay_after_crash(tmp_path):
+    store = json_store(tmp_path)
+    seed(store)
+    store.save(editable_copy(store.load(), "C1"), [invoice_upsert("C1", make_invoice("I1"))])
+    store.save(editable_copy(store.load(), "C2"), [invoice_upsert("C2", make_invoice("I2"))])
+    # a writer that died halfway through appending its record
+    torn = json.dumps({"op": "invoice_upsert", "case_no": "C1", "invoice": make_invoice("I3")})
+    with open(store.journal_file, "ab") as f:
+        f.write(torn[:len(torn) // 2].encode())
+
+    replayed = json_store(tmp_path).load()
+    assert [inv["invoice_no"] for inv in replayed["C1"]["invoices"]] == ["I1"]
+    assert [inv["invoice_no"] for inv in replayed["C2"]["invoices"]] == ["I2"]
+
+    # the next write drops the torn record instead of appending after it
+    writer = json_store(tmp_path)
+    writer.save(editable_copy(writer.load(), "C1"), [invoice_upsert("C1", make_invoice("I4"))])
+    book = json_store(tmp_path).load()
+    assert [inv["invoice_no"] for inv in book["C1"]["invoices"]] == ["I1", "I4"]
+    assert plain_copy(book) == plain_copy(writer.load())
+
+
+def test_two_writers_on_different_cases(open_store):
+    seed(open_store())
+    first, second = open_store(), open_store()
+    first_book, second_book = first.load(), second.load()
+
+    first.save(editable_copy(first_book, "C1"), [invoice_upsert("C1", make_invoice("I1"))])
+    # the second writer still holds the book from before the first one saved
+    second.save(editable_copy(second_book, "C2"), [invoice_upsert("C2", make_invoice("I2"))])
+
+    book = open_store().load()
+    assert [inv["invoice_no"] for inv in book["C1"]["invoices"]] == ["I1"]
+    assert [inv["invoice_no"] for inv in book["C2"]["invoices"]] == ["I2"]
+    assert plain_copy(first.refresh()) == plain_copy(book)
+
+
+def test_save_applies_changes_to_the_stores_book(tmp_path):
+    store = json_store(tmp_path)
+    seed(store)
+    book = store.load()
+    # changes are applied whether the caller passes the store's book or a copy
+    store.save(book, [invoice_upsert("C1", make_invoice("I1"))])
+    store.save(editable_copy(store.refresh(), "C1"), [invoice_upsert("C1", make_invoice("I2"))])
+    assert [inv["invoice_no"] for inv in store.refresh()["C1"]["invoices"]] == ["I1", "I2"]
+    assert [inv["invoice_no"] for inv in json_store(tmp_path).load()["C1"]["invoices"]] == ["I1", "I2"]
+
+
+def test_saves_leave_handed_out_books_unchanged(tmp_path):
+    store = json_store(tmp_path)
+    seed(store)
+    book = store.load()
+    before = plain_copy(book)
+    reading = iter(book.items())
+    next(reading)
+    # another session saves while this one is half way through the book
+    store.save(editable_copy(book, "C1"), [invoice_upsert("C1", make_invoice("I1")),
+                                            case_upsert("C3", make_case())])
+    assert len(list(reading)) == 1
+    assert plain_copy(book) == before
+    latest = store.refresh()
+    assert latest is not book
+    assert list(latest) == ["C1", "C2", "C3"]
+    assert [inv["invoice_no"] for inv in latest["C1"]["invoices"]] == ["I1"]
+    # cases the save did not touch are shared, not copied
+    assert latest["C2"] is book["C2"]
+
+
+def test_saved_book_matches_a_reload(open_store):
+    store = open_store()
+    book = {"C1": make_case(), "C2": make_case(), "C3": make_case()}
+    book["C1"]["invoices"] = [make_invoice("I1")]
+    store.save(book)
+    store.load()
+
+    # the new-case form's header-only case, saved over an existing one
+    data = editable_copy(store.refresh(), "C1")
+    data["C1"] = {"clients": "Other broker", "insurers": {"AXA": 100.0}}
+    saved = store.save(data, [case_upsert("C1", data["C1"])])
+    assert saved is not data
+    assert [inv["invoice_no"] for inv in saved["C1"]["invoices"]] == ["I1"]
+    saved = store.save(editable_copy(saved), [case_rename("C2", "C2-new")])
+
+    reloaded = open_store().load()
+    assert list(saved) == list(reloaded) == ["C1", "C2-new", "C3"]
+    assert plain_copy(saved) == plain_copy(reloaded)
+    assert plain_copy(store.refresh()) == plain_copy(reloaded)
+
+
+def test_stale_copy_cannot_replace_a_newer_change(open_store):
+    store = open_store()
+    book = {"C1": make_case(), "C2": make_case()}
+    book["C1"]["invoices"] = [make_invoice("I1")]
+    store.save(book)
+    first, second = open_store(), open_store()
+    first_book, second_book = first.load(), second.load()
+    payment = {"Received Amount": 60.0, "Payment to": "SXP", "currency": "USD", "verified": True}
+
+    first.save(editable_copy(first_book, "C1"), [payment_verified("C1", "I1", "AXA", payment),
+                                                 status_change("C1", "I1", "Partially Paid")])
+    # records that merge into the invoice still apply from the older copy
+    second.save(editable_copy(second_book, "C1"), [payment_verified("C1", "I1", "Allianz", payment)])
+    # the whole invoice as the older copy has it would drop AXA's payment
+    stale = editable_copy(second_book, "C1")
+    with pytest.raises(StoreConflict):
+        second.save(stale, [invoice_upsert("C1", stale["C1"]["invoices"][0])])
+    # cases nobody else changed can still be saved from it
+    stale = editable_copy(second_book, "C2")
+    stale["C2"]["case_title"] = "Renamed"
+    second.save(stale, [case_upsert("C2", stale["C2"])])
+
+    reloaded = open_store().load()
+    assert set(reloaded["C1"]["invoices"][0]["verified_insurers"]) == {"AXA", "Allianz"}
+    assert reloaded["C1"]["invoices"][0]["Status"] == "Partially Paid"
+    assert reloaded["C2"]["case_title"] == "Renamed"
+
+
+def test_pool_is_repacked_as_saves_replace_cases(open_store, monkeypatch):
+    monkeypatch.setattr(storage, "REPACK_POOL_SIZE", 64)
+    store = open_store()
+    book = {"C1": make_case(), "C2": make_case()}
+    book["C1"]["invoices"] = [make_invoice(f"I{i}") for i in range(5)]
+    store.save(book)
+    store.load()
+    packed = len(store._pool)
+    for i in range(50):
+        store.save(editable_copy(store.refresh(), "C1"), [invoice_upsert("C1", make_invoice("I0", usd=i + 1.0))])
+    # every save re-packs C1 (24 amounts) after the 26 of the book's pool
+    assert len(store._pool) <= max(2 * packed, 64) + 24
+    assert plain_copy(store.refresh()) == plain_copy(open_store().load())
+
+
+def test_record_reuses_its_space_at_the_end_of_the_pool():
+    inv = InvoiceRecord(make_invoice("I1"))
+    inv["insurer amounts(USD)"] = {"AXA": 50.0, "Allianz": 30.0, "Zurich": 20.0}
+    assert len(inv.pool) == 5
+    assert inv["insurer amounts(MYR)"] == {"AXA": 252.0, "Allianz": 168.0}
+    assert inv["insurer amounts(USD)"] == {"AXA": 50.0, "Allianz": 30.0, "Zurich": 20.0}
+
+
+def test_apply_appends_without_loading_the_book(tmp_path):
+    json_store(tmp_path).save({"C1": make_case(), "C2": make_case()})
+    writer, other = json_store(tmp_path), json_store(tmp_path)
+    writer.apply([invoice_upsert("C1", make_invoice("I1"))])
+    assert writer._data is None
+    other.save(editable_copy(other.load(), "C2"), [invoice_upsert("C2", make_invoice("I2"))])
+    writer.apply([invoice_upsert("C1", make_invoice("I3"))])
+
+    reader = json_store(tmp_path)
+    book = reader.load()
+    assert [inv["invoice_no"] for inv in book["C1"]["invoices"]] == ["I1", "I3"]
+    assert [inv["invoice_no"] for inv in book["C2"]["invoices"]] == ["I2"]
+    assert reader.version == writer.version == 4